@@ -1,45 +1,228 @@
+import time
+import_start = time.perf_counter()
+import json
+import os
+import threading
 import dash
+import flask
 import pandas as pd
 import plotly.graph_objs as go
-from dash import Input, Output, dcc, html
+from plotly.io.json import to_json_plotly
+from dash import ALL, Input, Output, State, dcc, html
 from dash_bootstrap_templates import load_figure_template
 import dash_bootstrap_components as dbc
 
-from data import get_data
-from util.data import create_crosstab
-from util.plot import get_stacked_bar_traces, get_choropleth_figure
-
-# Retrieve data and initial inputs
-data, data_dict = get_data()
-damage_factor, duration_factor = "ND_DAMAGE", "ND_HOWLONG"
-relevant_factors = ['ND_DAMAGE', 'ND_HOWLONG', 
-                    'ND_UNSANITARY', 'ND_FDSHRTAGE', 'ND_WATER', 'ND_ELCTRC',
-                    'HAZARD_TYPE', 'REGION',
-                    'TENURE', 'LIVQTRRV', 'DWELLTYPE', 'RENT_BIN', 'EEDUC', 'INCOME', 'INCOME_PER',
-                    'HH_BIN', 'AGE_BIN', 'RHISPANIC', 'RRACE','MS', 'GENID_DESCRIBE',
-                    'DOWN', 'WORRY', 'INTEREST', 'ANXIOUS',
-                    'MOBILITY', 'REMEMBERING', 'SELFCARE', 'UNDERSTAND',
-                    'ANYWORK', 'SETTING', 'KINDWORK', 'TWDAYS', 'SCHOOLENROLL',
-                    ]
-factor_values = [factor for factor in relevant_factors if data_dict.loc[factor, 'Type'] in ['Ordinal', 'Nominal']]
-factor_names = [data_dict.loc[factor, 'Name'] for factor in factor_values]
-n_factors = len(factor_values)
-
-# Arrange geographic inputs and default factor
-geo_prefix = ""
-geo_factors = {
-    'DISP_ANY': 'The proportion of households that experienced any disaster displacement',
-    'DISP_LT1MO': 'The proportion of disaster-displaced households that returned in less than 1 month',
-    'DISP_GT1MO': 'The proportion of disaster-displaced households that took longer than 1 month to return',
-    'DISP_NORETURN': 'The proportion of disaster-displaced households that had not returned',
-}
+from factors import (damage_factor, duration_factor, get_factor_values, get_filter_options, get_geo_outcomes,
+                     geo_filter_factor, filter_factors, facet_factors)
+from util.crosstab import crosstab_cache
+from util.figures import (FigureStore, compress_response, encode_body, get_encoded_response, get_figure_key,
+                          get_figure_sizes, get_request_values)
+from util.geo import get_state_table, state_cache
+from util.metrics import CallbackMetrics
+from util.cube import weighted_cube_cache
+from util.plot import compact_figure, get_faceted_bar_figure, get_stacked_bar_traces, get_choropleth_figure
+from util.startup import StartupTimer
+
+# Time each startup phase, from imports to the first callback
+timer = StartupTimer()
+timer.record("imports", time.perf_counter() - import_start)
+
+# Serve precomputed crosstabs if available
+crosstab_file = os.environ.get("HPS_CROSSTABS")
+
+# Serve pre-rendered figures if available; other figures reachable from the
+# dropdowns are stored as they are first rendered (or at warm-up)
+figure_file = os.environ.get("HPS_FIGURES")
+figure_store = FigureStore()
+
+# Send figures with values rounded to display precision and only the parts of
+# the theme template they use, unless full figures are requested
+compact_figures = not os.environ.get("HPS_FULL_FIGURES")
+
+# Record the latency and response size of callbacks; slow callbacks are
+# logged if a threshold (in milliseconds) is set
+slow_callback_ms = os.environ.get("HPS_SLOW_CALLBACK_MS")
+metrics = CallbackMetrics(
+    slow_threshold=float(slow_callback_ms) / 1000 if slow_callback_ms else None,
+    caches={"figure": figure_store} if crosstab_file else {"crosstab": crosstab_cache, "state": state_cache,
+                                                          "cube": weighted_cube_cache, "figure": figure_store},
+)
+
+# Arrange geographic inputs and default factor; the share of all households
+# that were displaced needs non-displaced households, so it is still read
+# from the state summary
+geo_any_factor = 'DISP_ANY'
+geo_any_description = 'The proportion of households that experienced any disaster displacement'
 geo_factor = 'DISP_GT1MO'
-geo = pd.read_csv('st_duration.csv')
 
-# Initialize app
-app = dash.Dash(external_stylesheets=[dbc.themes.FLATLY])
-load_figure_template('FLATLY')
-app.title = "Household displacement in recent US disasters"
+# Inputs of each graph besides the subgroup filters, in the order of the
+# arguments of its plot function, and their initial values
+graph_inputs = {
+    "factor-damage-graph": ["factor-damage-selector", "factor-damage-facet"],
+    "factor-duration-graph": ["factor-duration-selector", "factor-duration-facet"],
+    "geo-duration-graph": ["geo-duration-selector", "geo-filter-selector"],
+}
+graph_defaults = {
+    "factor-damage-graph": [duration_factor, None],
+    "factor-duration-graph": [damage_factor, None],
+    "geo-duration-graph": [geo_factor, None],
+}
+filter_type = "subgroup-filter"
+
+# Data and layout are loaded on first use (or by a background warm-up)
+resources = {}
+resources_lock = threading.RLock()
+warm_up_thread = None
+
+
+def load_resources():
+    """Retrieves the data (or precomputed crosstabs) and initial inputs"""
+    if crosstab_file:
+        from util.cube import load_crosstab_cube
+        from util.geo import get_cube_state_tables
+        with timer.phase("artifact load"):
+            cube = load_crosstab_cube(crosstab_file)
+        loaded = {
+            "cube": cube,
+            "factor_values": [factor["value"] for factor in cube["factors"]],
+            "factor_names": [factor["name"] for factor in cube["factors"]],
+            "geo_factors": cube["states"]["outcomes"],
+            "geo_filter_name": cube["states"]["filter"]["name"],
+            "geo_filter_options": cube["states"]["filter"]["options"],
+            "state_tables": get_cube_state_tables(cube["states"]),
+            # Precomputed crosstabs cover all households and two factors only
+            "filter_options": [],
+            "facet_options": [],
+        }
+    else:
+        from data import get_data
+        # Worker processes can share one memory-mapped copy of the household data
+        data, data_dict = get_data(memory_map=bool(os.environ.get("HPS_MEMORY_MAP")), timer=timer)
+        factor_values, factor_names = get_factor_values(data_dict)
+        geo_outcomes = get_geo_outcomes(data_dict)
+        loaded = {
+            "data": data,
+            "data_dict": data_dict,
+            "factor_values": factor_values,
+            "factor_names": factor_names,
+            "geo_outcomes": geo_outcomes,
+            "geo_factors": {value: description for value, (_, _, description) in geo_outcomes.items()},
+            "geo_filter_name": data_dict.name(geo_filter_factor),
+            "geo_filter_options": list(data_dict.labels(geo_filter_factor).items()),
+            "filter_options": get_filter_options(data_dict),
+            "facet_options": [(factor, data_dict.name(factor)) for factor in facet_factors if factor in data_dict],
+        }
+        from util.filters import BitmapIndex
+        with timer.phase("filter index build"):
+            loaded["filter_index"] = BitmapIndex(data, [factor for factor in filter_factors if factor in data])
+    loaded["geo_factors"] = {geo_any_factor: geo_any_description, **loaded["geo_factors"]}
+    with timer.phase("state summary load"):
+        loaded["geo_any"] = get_state_table(pd.read_csv('st_duration.csv'), geo_any_factor)
+    loaded["figure_keys"] = {get_graph_key(graph, values) for graph, values in get_figure_requests(loaded)}
+    if figure_file:
+        with timer.phase("figure store load"):
+            figure_store.load(figure_file)
+    return loaded
+
+
+def get_resources():
+    """Returns the loaded resources, loading them once on first use"""
+    with resources_lock:
+        if not resources:
+            resources.update(load_resources())
+    return resources
+
+
+def get_figure_requests(resources):
+    # Lists the graph and input values of every figure reachable from the
+    # dropdowns, without subgroup filters or facets
+    requests = []
+    for value in resources["factor_values"]:
+        if value != damage_factor:
+            requests.append(("factor-damage-graph", [value, None]))
+        if value != duration_factor:
+            requests.append(("factor-duration-graph", [value, None]))
+    for value in resources["geo_factors"]:
+        for filter_code in [None] + [code for code, _ in resources["geo_filter_options"]]:
+            requests.append(("geo-duration-graph", [value, filter_code]))
+    return requests
+
+
+def get_graph_key(graph, values, filters=()):
+    # Key of a figure in the figure store
+    return get_figure_key(graph, list(values) + [sorted([factor, sorted(codes)] for factor, codes in filters)])
+
+
+def get_updated_graphs(changed_props):
+    # Graphs whose inputs changed; every graph follows the subgroup filters
+    changed = {prop.rsplit(".", 1)[0] for prop in changed_props}
+    if any(component.startswith("{") and json.loads(component)["type"] == filter_type for component in changed):
+        return list(graph_inputs)
+    return [graph for graph, inputs in graph_inputs.items() if changed.intersection(inputs)]
+
+
+def is_ready():
+    # Whether the data and layout have been loaded
+    return "layout" in resources
+
+
+def get_filters(filter_values, filter_ids):
+    # Pairs the selected codes of the subgroup filter panel with their factors
+    return tuple((filter_id["index"], tuple(values)) for filter_id, values in zip(filter_ids, filter_values) if values)
+
+
+def get_crosstab(main_factor, factor, filters=()):
+    # Returns the proportions and their standard errors (None if unavailable)
+    resources = get_resources()
+    if crosstab_file:
+        from util.cube import get_cube_crosstab
+        cube = resources["cube"]
+        return (get_cube_crosstab(cube, main_factor, factor, samples=True),
+                get_cube_crosstab(cube, main_factor, factor, samples=True, stderr=True))
+    from util.crosstab import cached_crosstab
+    data, data_dict, index = resources["data"], resources["data_dict"], resources["filter_index"]
+    return (cached_crosstab(data, data_dict, main_factor, factor, samples=True, filters=filters, index=index),
+            cached_crosstab(data, data_dict, main_factor, factor, samples=True, stderr=True, filters=filters,
+                            index=index))
+
+
+def get_facets(main_factor, factor, facet_factor, filters=()):
+    # Returns the label, proportions and standard errors (None if
+    # unavailable) of each value of the facet factor, from a weighted cube,
+    # along with the labels of the main factor across all facets, in order;
+    # none for precomputed crosstabs
+    if crosstab_file:
+        return [], []
+    from util.cube import cached_weighted_cube
+    resources = get_resources()
+    data, data_dict = resources["data"], resources["data_dict"]
+    cube = cached_weighted_cube(data, [main_factor, factor, facet_factor], filters=filters,
+                                index=resources["filter_index"])
+    labels = data_dict.labels(facet_factor)
+    facets = []
+    for code in cube.keys[cube.axis(facet_factor)]:
+        facet = cube.slice(facet_factor, code)
+        facets.append((labels.get(int(code), str(code)),
+                       facet.crosstab(data_dict, main_factor, factor, samples=True),
+                       facet.crosstab(data_dict, main_factor, factor, samples=True, stderr=True)))
+    categories = cube.crosstab(data_dict, main_factor, factor).columns.tolist()
+    return facets, categories
+
+
+def get_geo_table(value, filter_code=None, filters=()):
+    # Returns the (shared, read-only) state table of the weighted proportion
+    # of households with an outcome per state
+    resources = get_resources()
+    if crosstab_file:
+        from util.geo import get_state_key
+        return resources["state_tables"][get_state_key(value, filter_code)]
+    from util.geo import cached_state_table
+    outcome, codes, _ = resources["geo_outcomes"][value]
+    if filter_code is not None:
+        filters += ((geo_filter_factor, (filter_code,)),)
+    return cached_state_table(resources["data"], resources["data_dict"], outcome, codes, filters=filters,
+                              index=resources["filter_index"])
+
 
 # Header content
 header_content = [
@@ -78,124 +261,406 @@ footer_content = [
                         ])
                 ]
 
-# Create controls
-control_damage = html.Div(
-            [
-                html.H4("Investigate damage trends with"),
-                dcc.Dropdown(
-                    id="factor-damage-selector",
-                    options=[
-                        {
-                            "label": name,
-                            "value": value,
-                        }
-                        for name, value in zip(factor_names, factor_values) if value != damage_factor
-                        ],
-                    value=duration_factor,
-                    clearable=False,
-                    searchable=True,
-                ),
-            ]
-)
-   
-control_duration = html.Div(
-            [
-                html.H4("Investigate duration trends with"),
-                dcc.Dropdown(
-                    id="factor-duration-selector",
-                    options=[
-                        {
-                            "label": name,
-                            "value": value,
-                        }
-                        for name, value in zip(factor_names, factor_values) if value != duration_factor
-                        ],
-                    value=damage_factor,
-                    clearable=False,
-                    searchable=True,
-                ),
-            ],
-)
 
-control_geo = html.Div(
-    [
-        html.H4("Investigate disaster displacement trends by state"),
-        dcc.Dropdown(
-                            id="geo-duration-selector",
-                            options=[
-                                    {
-                                        "label": geo_factors[key],
-                                        "value": key,
-                                    }
-                                    for key in geo_factors
-                                    ],
-                            value = geo_factor,
-                            clearable = False,
-                            searchable = False,
-                        ),
-    ]
-)
+def build_layout(resources):
+    # Create controls
+    control_damage = html.Div(
+                [
+                    html.H4("Investigate damage trends with"),
+                    dcc.Dropdown(
+                        id="factor-damage-selector",
+                        options=[
+                            {
+                                "label": name,
+                                "value": value,
+                            }
+                            for name, value in zip(resources['factor_names'], resources['factor_values']) if value != damage_factor
+                            ],
+                        value=duration_factor,
+                        clearable=False,
+                        searchable=True,
+                    ),
+                    dcc.Dropdown(
+                        id="factor-damage-facet",
+                        options=[
+                            {
+                                "label": name,
+                                "value": value,
+                            }
+                            for value, name in resources['facet_options']
+                            ],
+                        placeholder="Split by: None",
+                        clearable=True,
+                        searchable=False,
+                        style=None if resources['facet_options'] else {"display": "none"},
+                    ),
+                ]
+    )
+
+    control_duration = html.Div(
+                [
+                    html.H4("Investigate duration trends with"),
+                    dcc.Dropdown(
+                        id="factor-duration-selector",
+                        options=[
+                            {
+                                "label": name,
+                                "value": value,
+                            }
+                            for name, value in zip(resources['factor_names'], resources['factor_values']) if value != duration_factor
+                            ],
+                        value=damage_factor,
+                        clearable=False,
+                        searchable=True,
+                    ),
+                    dcc.Dropdown(
+                        id="factor-duration-facet",
+                        options=[
+                            {
+                                "label": name,
+                                "value": value,
+                            }
+                            for value, name in resources['facet_options']
+                            ],
+                        placeholder="Split by: None",
+                        clearable=True,
+                        searchable=False,
+                        style=None if resources['facet_options'] else {"display": "none"},
+                    ),
+                ],
+    )
+
+    control_geo = html.Div(
+        [
+            html.H4("Investigate disaster displacement trends by state"),
+            dcc.Dropdown(
+                                id="geo-duration-selector",
+                                options=[
+                                        {
+                                            "label": resources['geo_factors'][key],
+                                            "value": key,
+                                        }
+                                        for key in resources['geo_factors']
+                                        ],
+                                value = geo_factor,
+                                clearable = False,
+                                searchable = True,
+                            ),
+            dcc.Dropdown(
+                                id="geo-filter-selector",
+                                options=[
+                                        {
+                                            "label": label,
+                                            "value": code,
+                                        }
+                                        for code, label in resources['geo_filter_options']
+                                        ],
+                                placeholder = f"{resources['geo_filter_name']}: All",
+                                clearable = True,
+                                searchable = False,
+                            ),
+        ]
+    )
+
+    control_filters = html.Div(
+        [
+            html.H4("Filter households"),
+            dbc.Row([
+                dbc.Col(
+                    dcc.Dropdown(
+                        id={"type": filter_type, "index": factor["value"]},
+                        options=[
+                                {
+                                    "label": label,
+                                    "value": code,
+                                }
+                                for code, label in factor["options"]
+                                ],
+                        placeholder=f"{factor['name']}: All",
+                        multi=True,
+                        searchable=False,
+                    ),
+                    md=3,
+                )
+                for factor in resources['filter_options']
+            ]),
+        ]
+    )
+
+    # Create graphs
+    panel_filters = dbc.Card([control_filters], body=True)
+    graph_damage = dbc.Card([control_damage, dcc.Graph(id="factor-damage-graph",
+                                                       figure=get_initial_figure("factor-damage-graph"))], body=True)
+    graph_duration = dbc.Card([control_duration, dcc.Graph(id="factor-duration-graph",
+                                                           figure=get_initial_figure("factor-duration-graph"))], body=True)
+    graph_geo = dbc.Card([control_geo, dcc.Graph(id="geo-duration-graph",
+                                                 figure=get_initial_figure("geo-duration-graph"))], body=True)
+
+    # Create layout
+    layout = dbc.Container(
+        [
+            dbc.Row([
+                dbc.Card(header_content, body=True)
+            ]),
+
+            dbc.Row(
+                dbc.Col(panel_filters),
+            ) if resources['filter_options'] else None,
+            dbc.Row(
+                [
+                    dbc.Col(graph_damage, md=6),
+                    dbc.Col(graph_duration, md=6),
+                ],
+                align="center",
+            ),
+            dbc.Row(
+                dbc.Col(graph_geo),
+            ),
+            dbc.Row([
+                dbc.Card(footer_content, body=True)
+            ]),
+        ],
+        fluid=True,
+    )
+
+    return layout
+
+
+def get_initial_figure(graph):
+    # Figure shown before any dropdown changes, embedded in the layout
+    return get_figure(graph, graph_defaults[graph])
+
+
+def serve_layout():
+    """Layout function of the app; the layout, including the initial
+    figures, is built and serialized once, after loading the resources it
+    needs"""
+    resources = get_resources()
+    with resources_lock:
+        if "layout" not in resources:
+            with timer.phase("layout build"):
+                layout = build_layout(resources)
+                resources["layout_response"] = encode_body(to_json_plotly(layout).encode(), etag=True)
+                resources["layout"] = layout
+    return resources["layout"]
 
-# Create graphs
-graph_damage = dbc.Card([control_damage, dcc.Graph(id="factor-damage-graph")], body=True)
-graph_duration = dbc.Card([control_duration, dcc.Graph(id="factor-duration-graph")], body=True)
-graph_geo = dbc.Card([control_geo, dcc.Graph(id="geo-duration-graph")], body=True)
-
-# Create layout
-app.layout = dbc.Container(
-    [
-        dbc.Row([
-            dbc.Card(header_content, body=True)
-        ]),
-
-        dbc.Row(
-            [
-                dbc.Col(graph_damage, md=6),
-                dbc.Col(graph_duration, md=6),
-            ],
-            align="center",
-        ),
-        dbc.Row(
-            dbc.Col(graph_geo),
-        ),
-        dbc.Row([
-            dbc.Card(footer_content, body=True)
-        ]),
-    ],
-    fluid=True,
-)
 
 # Callback functions
-@app.callback(
-    Output("factor-damage-graph", "figure"), [Input("factor-damage-selector", "value")]
-)
-def plot_damage(factor):
+def plot_damage(factor, facet_factor=None, filters=()):
     damage_colors = ['silver', '#15a74e', '#fcc210', '#9e4825']
-    crosst = create_crosstab(data, data_dict, damage_factor, factor, samples=True)
-    traces = get_stacked_bar_traces(crosst)
+    if facet_factor not in (None, damage_factor, factor):
+        facets, categories = get_facets(damage_factor, factor, facet_factor, filters)
+        if facets:
+            return get_faceted_bar_figure(facets, damage_colors, categories)
+    crosst, stderr = get_crosstab(damage_factor, factor, filters)
+    traces = get_stacked_bar_traces(crosst, stderr)
     layout = go.Layout(barmode='stack', legend_title=crosst.columns.name, colorway=damage_colors,
             xaxis_title=crosst.index.name, yaxis_title='Proportion of households')
     return go.Figure(data=traces, layout=layout)
 
-@app.callback(
-    Output("factor-duration-graph", "figure"), [Input("factor-duration-selector", "value")]
-)
-def plot_duration(factor):
+def plot_duration(factor, facet_factor=None, filters=()):
     damage_colors = ['silver', '#15a74e', '#fcc210', '#9e4825', '#212121']
-    crosst = create_crosstab(data, data_dict, duration_factor, factor, samples=True)
-    traces = get_stacked_bar_traces(crosst)
+    if facet_factor not in (None, duration_factor, factor):
+        facets, categories = get_facets(duration_factor, factor, facet_factor, filters)
+        if facets:
+            return get_faceted_bar_figure(facets, damage_colors, categories)
+    crosst, stderr = get_crosstab(duration_factor, factor, filters)
+    traces = get_stacked_bar_traces(crosst, stderr)
     layout = go.Layout(barmode='stack', legend_title=crosst.columns.name, colorway=damage_colors,
             xaxis_title=crosst.index.name, yaxis_title='Proportion of households')
     return go.Figure(data=traces, layout=layout)
 
-@app.callback(
-    Output("geo-duration-graph", "figure"), [Input("geo-duration-selector", "value")]
-)
-def plot_geo(factor):
+def plot_geo(factor, filter_code=None, filters=()):
 
-    fig = get_choropleth_figure(geo, factor, geo_factors[factor])
+    resources = get_resources()
+    if factor == geo_any_factor:
+        table = resources["geo_any"]
+    else:
+        table = get_geo_table(factor, filter_code, filters)
+    fig = get_choropleth_figure(table, resources["geo_factors"][factor])
+
+    # The share of all households that were displaced is only summarized per
+    # state, so it cannot follow the hazard type or subgroup filters
+    if factor == geo_any_factor and (filter_code is not None or filters):
+        fig.add_annotation(text="Hazard type and subgroup filters are not applied to this outcome",
+                           xref="paper", yref="paper", x=0.5, y=1, yanchor="bottom", showarrow=False,
+                           font_color="#b94a48")
 
     return fig
 
+
+graph_plots = {"factor-damage-graph": plot_damage, "factor-duration-graph": plot_duration,
+               "geo-duration-graph": plot_geo}
+
+
+def get_figure(graph, values, filters=()):
+    # Plots a graph; figures reachable from the dropdowns are also serialized
+    # into the figure store, unless already stored
+    fig = graph_plots[graph](*values, filters=filters)
+    if compact_figures:
+        fig = compact_figure(fig)
+    key = get_graph_key(graph, values, filters)
+    if key in resources.get("figure_keys", ()) and key not in figure_store:
+        figure_store.put(key, graph, to_json_plotly(fig).encode())
+    return fig
+
+
+def update_graphs(damage_value, damage_facet, duration_value, duration_facet, geo_value, geo_filter_code,
+                  filter_values, filter_ids):
+    # Updates the graphs whose inputs changed, in a single request
+    filters = get_filters(filter_values, filter_ids)
+    values = {"factor-damage-graph": [damage_value, damage_facet],
+              "factor-duration-graph": [duration_value, duration_facet],
+              "geo-duration-graph": [geo_value, geo_filter_code]}
+    updated = get_updated_graphs(dash.ctx.triggered_prop_ids)
+    figures = []
+    for graph in graph_inputs:
+        if graph not in updated:
+            figures.append(dash.no_update)
+            continue
+        with metrics.measure_graph(graph):
+            figures.append(get_figure(graph, values[graph], filters))
+    return figures
+
+
+def render_figures():
+    """Renders every figure reachable from the dropdowns into the figure
+    store, except those already stored"""
+    resources = get_resources()
+    for graph, values in get_figure_requests(resources):
+        if get_graph_key(graph, values) not in figure_store:
+            get_figure(graph, values)
+    return figure_store
+
+
+def warm_up_app():
+    # Loads the data, builds the layout and renders the figures
+    serve_layout()
+    with timer.phase("figure render"):
+        render_figures()
+
+
+def start_warm_up():
+    # Warms up the app in a background thread of this process
+    global warm_up_thread
+    warm_up_thread = threading.Thread(target=warm_up_app, name="warm-up", daemon=True)
+    warm_up_thread.start()
+    return warm_up_thread
+
+
+def join_warm_up():
+    # A process forked during the warm-up (e.g., a gunicorn worker of a
+    # preloaded app) would inherit the locks held by its thread but not the
+    # thread itself, so forks wait for a running warm-up to finish; other
+    # forks (e.g., subprocesses) are not held up
+    thread = warm_up_thread
+    if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+        thread.join()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=join_warm_up)
+
+
+def create_app(warm_up=False, expose_metrics=False):
+    """Creates the Dash app without loading any data; the data is loaded on
+    the first page load, or right away in a background thread if warm_up
+
+    Args:
+        warm_up (bool): Whether the data and layout are loaded, and the
+            figures rendered, in the background as soon as the app is created
+        expose_metrics (bool): Whether callback metrics are answered at
+            /metrics (404 otherwise)
+
+    Returns:
+        app (dash.Dash): App whose Flask server answers /health immediately,
+            /ready with 200 once the data and layout are loaded (503 before),
+            and /metrics with callback metrics if exposed; stored
+            figures are answered without running their callback
+    """
+
+    # Health, readiness and metrics are answered before Dash sets up the layout
+    server = flask.Flask(__name__)
+    server.before_request(metrics.start_request)
+    server.after_request(metrics.record_response)
+
+    @server.before_request
+    def report_status():
+        if flask.request.path == "/health":
+            return {"status": "ok"}
+        if flask.request.path == "/ready":
+            if is_ready():
+                return {"status": "ready", "startup": timer.to_dict()}
+            return {"status": "loading", "startup": timer.to_dict()}, 503
+        if flask.request.path == "/metrics":
+            if not expose_metrics:
+                return {"status": "not found"}, 404
+            return flask.Response(metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+    # Answer the layout and callbacks whose figures are all stored with their
+    # serialized responses, without Dash; other responses are compressed
+    @server.before_request
+    def serve_stored_response():
+        if flask.request.path.endswith("_dash-layout"):
+            serve_layout()
+            return get_encoded_response(resources["layout_response"], flask.request)
+        if flask.request.method != "POST" or not flask.request.path.endswith("_dash-update-component"):
+            return
+        start = time.perf_counter()
+        body = flask.request.get_json(silent=True) or {}
+        values = get_request_values(body)
+        filters = tuple((factor, tuple(codes)) for factor, codes in values.get(filter_type, []))
+        entries = []
+        graphs = get_updated_graphs(body.get("changedPropIds", []))
+        for graph in graphs:
+            entry = figure_store.get(get_graph_key(graph, [values.get(i) for i in graph_inputs[graph]], filters))
+            if entry is None:
+                return
+            entries.append(entry)
+        if entries:
+            response = figure_store.get_response(entries, flask.request)
+            metrics.observe_stored(sorted(graphs), time.perf_counter() - start)
+            for entry in entries:
+                metrics.observe_figure(entry["component_id"], len(entry["figure"]))
+            return response
+
+    server.after_request(compress_response)
+
+    # Record the size of each figure computed by a callback from its
+    # response, before it is compressed (hooks run in reverse order)
+    @server.after_request
+    def record_figure_sizes(response):
+        if (flask.request.path.endswith("_dash-update-component") and response.status_code == 200
+                and "Content-Encoding" not in response.headers):
+            for graph, size in get_figure_sizes(response.get_data(), graph_inputs).items():
+                metrics.observe_figure(graph, size)
+        return response
+
+    # Initialize app; callbacks refer to components of the lazy layout, which
+    # already includes the initial figures
+    app = dash.Dash(server=server, external_stylesheets=[dbc.themes.FLATLY],
+                    suppress_callback_exceptions=True, prevent_initial_callbacks=True)
+    load_figure_template('FLATLY')
+    app.title = "Household displacement in recent US disasters"
+    app.layout = serve_layout
+
+    # Register a single instrumented callback updating every graph whose
+    # inputs changed; every graph follows the subgroup filters
+    app.callback(
+        [Output(graph, "figure") for graph in graph_inputs],
+        [Input(component, "value") for inputs in graph_inputs.values() for component in inputs]
+        + [Input({"type": filter_type, "index": ALL}, "value"), State({"type": filter_type, "index": ALL}, "id")]
+    )(metrics.instrument(timer.time_first_call(update_graphs)))
+
+    # Load data and build the layout in the background
+    if warm_up:
+        start_warm_up()
+
+    return app
+
+
+app = create_app(warm_up=bool(os.environ.get("HPS_WARM_UP")), expose_metrics=bool(os.environ.get("HPS_METRICS")))
+server = app.server
+
 if __name__ == "__main__":
-    app.run_server(debug=True)
\ No newline at end of file
+    app.run_server(debug=True)
@@ -0,0 +1,319 @@
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+
+def measure(func, setup=None, repeats=3):
+    """Times a function and traces its peak memory
+
+    Args:
+        func (callable): Function to benchmark
+        setup (callable): Returns the arguments of func; called before each
+            run, outside of the measurements
+        repeats (int): Number of timed runs
+
+    Returns:
+        result (dict): Best wall time in seconds and peak memory allocated
+            by func in MiB (from a separate, traced run)
+    """
+    times = []
+    for _ in range(repeats):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"time": min(times), "peak_mb": peak / 2**20}
+
+
+def measure_payload(get_figure):
+    """Measures the serialized size of a figure, in full and compact form
+
+    Args:
+        get_figure (callable): Returns a new figure
+
+    Returns:
+        result (dict): Size in bytes of the full and compact figure, raw and
+            gzip-compressed
+    """
+    from plotly.io.json import to_json_plotly
+    from util.plot import compact_figure
+
+    result = {}
+    for form, fig in [("full", get_figure()), ("compact", compact_figure(get_figure()))]:
+        payload = to_json_plotly(fig).encode()
+        result[form] = len(payload)
+        result[f"{form}_gzip"] = len(gzip.compress(payload))
+    return result
+
+
+def pandas_crosstab(data, main_factor, curr_factor, weights="HWEIGHT"):
+    """Previous create_crosstab path, kept as the reference of the bincount
+    kernel: copies the households with known values and calls pd.crosstab
+
+    Args:
+        data (pd.DataFrame): Household data
+        main_factor (str): Coded column of the crosstab columns
+        curr_factor (str): Coded column of the crosstab index
+        weights (str): Column of household weights
+
+    Returns:
+        crosst (pd.DataFrame): Row proportions, indexed by code
+    """
+    import pandas as pd
+    from util.data import RMV_VALUES
+
+    factors = [main_factor, curr_factor]
+    df = data[~data[factors].isin(RMV_VALUES).any(axis=1) & data[factors].notna().all(axis=1)].copy()
+    return pd.crosstab(index=df[curr_factor], columns=df[main_factor], values=df[weights], aggfunc="sum",
+                       normalize="index")
+
+
+def get_benchmarks(folder, replicate_weights=False, crosstab_rows=1_200_000):
+    """Lists the benchmarks of the data pipeline and dashboard on synthetic
+    PUF zipfiles
+
+    Args:
+        folder (str): Folder of synthetic PUF CSV zipfiles
+        replicate_weights (bool): Whether replicate weights are read and
+            standard errors benchmarked
+        crosstab_rows (int): Number of households, resampled from the
+            synthetic data, on which both crosstab paths are compared
+
+    Returns:
+        benchmarks (list): Tuples of (name, func, setup)
+        payloads (list): Tuples of (name, func) of functions returning a
+            figure whose serialized size is measured
+    """
+    from parsers.parse_data_dictionary import DataDictionary, parse_data_dictionary
+    from parsers.parse_puf_files import (
+        parse_puf_files, get_puf_columns, is_displaced, custom_puf_handling, get_hazard_type,
+        convert_birth_year_to_age_bin, convert_hh_size_to_bin, convert_rent_to_bin, normalize_income,
+        get_recodes, compile_data_dictionary)
+    from parsers.recode import apply_recodes, compact_columns
+    from factors import duration_factor, filter_factors, get_factor_values, get_geo_outcomes
+    from util.data import create_crosstab, create_crosstab_stderr
+    from util.cube import build_weighted_cube
+    from util.filters import BitmapIndex
+    from util.geo import get_state_proportions, get_state_table
+    from util.plot import compact_figure, get_faceted_bar_figure, get_stacked_bar_traces, get_choropleth_figure
+    import plotly.graph_objs as go
+
+    # Prepare the inputs of each step once
+    data_dict = DataDictionary.from_frame(parse_data_dictionary("Data_Dictionary.xlsx").set_index('Variable'))
+    usecols = get_puf_columns(data_dict)
+
+    def parse():
+        return parse_puf_files(folder, usecols=usecols, row_filter=is_displaced, compact=True,
+                               replicate_weights=replicate_weights)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        puf = parse()
+        data, data_dict_out = custom_puf_handling(puf.copy(), data_dict)
+    recodes = get_recodes(data_dict)
+    factor_values, _ = get_factor_values(data_dict_out)
+    outcome, codes, description = get_geo_outcomes(data_dict_out)["DISP_GT1MO"]
+    crosst = create_crosstab(data, data_dict_out, duration_factor, "TENURE", samples=True)
+    geo = get_state_proportions(data, data_dict_out, outcome, codes)
+    table = get_state_table(geo)
+    cube = build_weighted_cube(data, [duration_factor, "TENURE", "HAZARD_TYPE"])
+    facets = [(str(code), cube.slice("HAZARD_TYPE", code).crosstab(data_dict_out, duration_factor, "TENURE",
+                                                                   samples=True), None)
+              for code in cube.keys[cube.axis("HAZARD_TYPE")]]
+    index = BitmapIndex(data, filter_factors)
+    filters = (("REGION", (2, 3)), ("TENURE_STATUS", (1, 2)))
+
+    # Households resampled to a large sample, for the crosstab kernel
+    resampled = data[[duration_factor, "TENURE", "HWEIGHT"]].sample(crosstab_rows, replace=True, random_state=0)
+
+    # Uncompacted output of custom_puf_handling, for compact_columns
+    uncompacted = apply_recodes(normalize_income(puf.copy())[0], recodes)
+
+    benchmarks = [
+        ("compile_data_dictionary", lambda: compile_data_dictionary("Data_Dictionary.xlsx"), None),
+        ("parse_puf_files", parse, None),
+        ("get_hazard_type", get_hazard_type, lambda: (puf.copy(),)),
+        ("convert_birth_year_to_age_bin", convert_birth_year_to_age_bin, lambda: (puf.copy(),)),
+        ("convert_hh_size_to_bin", convert_hh_size_to_bin, lambda: (puf.copy(),)),
+        ("convert_rent_to_bin", convert_rent_to_bin, lambda: (puf.copy(),)),
+        ("normalize_income", normalize_income, lambda: (puf.copy(),)),
+        ("apply_recodes", apply_recodes, lambda: (puf.copy(), recodes)),
+        ("compact_columns", compact_columns, lambda: (uncompacted.copy(), data_dict_out)),
+        ("custom_puf_handling", custom_puf_handling, lambda: (puf.copy(), data_dict)),
+        ("create_crosstab", lambda: create_crosstab(data, data_dict_out, duration_factor, "TENURE", samples=True),
+         None),
+        ("create_crosstab (all factors)",
+         lambda: [create_crosstab(data, data_dict_out, duration_factor, factor)
+                  for factor in factor_values if factor != duration_factor], None),
+        (f"pd.crosstab ({crosstab_rows:,} rows)", lambda: pandas_crosstab(resampled, duration_factor, "TENURE"),
+         None),
+        (f"create_crosstab ({crosstab_rows:,} rows)",
+         lambda: create_crosstab(resampled, data_dict_out, duration_factor, "TENURE"), None),
+        ("get_state_proportions", lambda: get_state_proportions(data, data_dict_out, outcome, codes), None),
+        ("BitmapIndex", lambda: BitmapIndex(data, filter_factors), None),
+        ("create_crosstab (filtered)",
+         lambda: create_crosstab(data, data_dict_out, duration_factor, "TENURE", samples=True,
+                                 mask=index.get_mask(filters)), None),
+        ("get_state_proportions (filtered)",
+         lambda: get_state_proportions(data, data_dict_out, outcome, codes, filters=filters, index=index), None),
+        ("build_weighted_cube",
+         lambda: build_weighted_cube(data, [duration_factor, "TENURE", "HAZARD_TYPE"]), None),
+        ("get_stacked_bar_traces", lambda: get_stacked_bar_traces(crosst), None),
+        ("get_state_table", lambda: get_state_table(geo), None),
+        ("get_choropleth_figure", lambda: get_choropleth_figure(table, description), None),
+        ("compact_figure", compact_figure, lambda: (get_choropleth_figure(table, description),)),
+    ]
+    if replicate_weights:
+        benchmarks.append(("create_crosstab_stderr",
+                           lambda: create_crosstab_stderr(data, data_dict_out, duration_factor, "TENURE"), None))
+    payloads = [
+        ("stacked bar", lambda: go.Figure(data=get_stacked_bar_traces(crosst), layout=go.Layout(barmode='stack'))),
+        ("faceted bar", lambda: get_faceted_bar_figure(facets, ['silver', '#15a74e', '#fcc210', '#9e4825'])),
+        ("choropleth", lambda: get_choropleth_figure(table, description)),
+    ]
+    return benchmarks, payloads
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Prints the benchmark results, compared against a baseline if given
+
+    Args:
+        results (dict): Output of run_benchmarks
+        baseline (dict): Earlier output of run_benchmarks, or None
+        tolerance (float): Relative slowdown above which a benchmark is
+            reported as a regression
+
+    Returns:
+        regressions (list): Names of benchmarks slower than the baseline
+    """
+    if baseline is not None and baseline["rows"] != results["rows"]:
+        print(f"Baseline was measured with {baseline['rows']:,} rows instead of {results['rows']:,}")
+    regressions = []
+    print(f"{'Benchmark':<32}{'Time (ms)':>12}{'Peak (MiB)':>12}{'Baseline (ms)':>15}{'Ratio':>8}")
+    for name, result in results["benchmarks"].items():
+        line = f"{name:<32}{result['time']*1000:>12,.1f}{result['peak_mb']:>12,.1f}"
+        previous = baseline["benchmarks"].get(name) if baseline is not None else None
+        if previous is not None:
+            ratio = result["time"] / previous["time"]
+            line += f"{previous['time']*1000:>15,.1f}{ratio:>8.2f}"
+            if ratio > 1 + tolerance:
+                line += "  slower"
+                regressions.append(name)
+            elif ratio < 1 - tolerance:
+                line += "  faster"
+        print(line)
+
+    # Figure payloads
+    if results.get("payloads"):
+        print(f"{'Figure':<32}{'Full (B)':>12}{'Compact (B)':>12}{'Full gzip':>12}{'Compact gzip':>14}{'Ratio':>8}")
+    for name, result in results.get("payloads", {}).items():
+        print(f"{name:<32}{result['full']:>12,}{result['compact']:>12,}{result['full_gzip']:>12,}"
+              f"{result['compact_gzip']:>14,}{result['full'] / result['compact']:>8.2f}")
+    return regressions
+
+
+def run_benchmarks(args):
+    from util.synthetic import write_puf_zips
+
+    # Generate synthetic PUF zipfiles, unless a folder is given
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        folder = args.data_folder or tmp_folder
+        if not args.data_folder:
+            start = time.perf_counter()
+            write_puf_zips(folder, args.rows, n_weeks=args.weeks, seed=args.seed,
+                           replicate_weights=args.replicate_weights, displaced_rate=args.displaced_rate)
+            print(f"Generated {args.rows:,} synthetic households in {time.perf_counter() - start:.1f}s")
+
+        # Run each benchmark
+        results = {"rows": args.rows, "python": platform.python_version(), "benchmarks": {}, "payloads": {}}
+        benchmarks, payloads = get_benchmarks(folder, replicate_weights=args.replicate_weights,
+                                              crosstab_rows=args.crosstab_rows)
+        for name, func, setup in benchmarks:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results["benchmarks"][name] = measure(func, setup, repeats=args.repeats)
+
+        # Measure the size of figure payloads
+        for name, get_figure in payloads:
+            results["payloads"][name] = measure_payload(get_figure)
+
+    # Compare against the baseline
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    compare_results(results, baseline, tolerance=args.tolerance)
+
+    # Store results
+    outputs = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for output in filter(None, outputs):
+        folder = os.path.dirname(output)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {output}")
+
+
+def generate_data(args):
+    from util.synthetic import write_puf_zips, write_displaced_households
+
+    # Write synthetic PUF zipfiles or a processed-style displaced households CSV
+    if args.displaced_csv:
+        write_displaced_households(args.displaced_csv, args.rows, seed=args.seed)
+        print(f"Saved {args.rows:,} synthetic displaced households to {args.displaced_csv}")
+    else:
+        zip_paths = write_puf_zips(args.output, args.rows, n_weeks=args.weeks, seed=args.seed,
+                                   replicate_weights=args.replicate_weights, displaced_rate=args.displaced_rate)
+        print(f"Saved {args.rows:,} synthetic households to {len(zip_paths)} zipfiles in {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard on synthetic survey data")
+    subparsers = parser.add_subparsers(required=True)
+
+    # Synthetic data
+    parser_generate = subparsers.add_parser("generate", help="Generate synthetic PUF CSV zipfiles")
+    parser_generate.add_argument("--rows", type=int, default=100_000)
+    parser_generate.add_argument("--weeks", type=int, default=1)
+    parser_generate.add_argument("--seed", type=int, default=0)
+    parser_generate.add_argument("--replicate-weights", action="store_true")
+    parser_generate.add_argument("--displaced-rate", type=float, default=0.1)
+    parser_generate.add_argument("--output", default="synthetic")
+    parser_generate.add_argument("--displaced-csv", help="Write a displaced_households.csv instead")
+    parser_generate.set_defaults(func=generate_data)
+
+    # Benchmarks
+    parser_run = subparsers.add_parser("run", help="Run the benchmarks")
+    parser_run.add_argument("--rows", type=int, default=100_000)
+    parser_run.add_argument("--weeks", type=int, default=1)
+    parser_run.add_argument("--seed", type=int, default=0)
+    parser_run.add_argument("--replicate-weights", action="store_true")
+    parser_run.add_argument("--displaced-rate", type=float, default=0.1)
+    parser_run.add_argument("--crosstab-rows", type=int, default=1_200_000)
+    parser_run.add_argument("--data-folder", help="Use existing PUF CSV zipfiles instead")
+    parser_run.add_argument("--repeats", type=int, default=3)
+    parser_run.add_argument("--baseline", default="artifacts/benchmark_baseline.json")
+    parser_run.add_argument("--save-baseline", action="store_true")
+    parser_run.add_argument("--tolerance", type=float, default=0.2)
+    parser_run.add_argument("--output")
+    parser_run.set_defaults(func=run_benchmarks)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
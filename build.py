@@ -0,0 +1,118 @@
+import argparse
+import os
+
+from factors import main_factors, get_factor_values, get_geo_outcomes, geo_filter_factor
+
+
+def build_data(args):
+    from data import get_data
+
+    # Process the household data into the cache shared by the app workers
+    get_data()
+
+
+def build_dictionary(args):
+    from data import get_data_dictionary
+
+    # Compile the augmented data dictionary from the workbook
+    get_data_dictionary(use_cache=not args.force)
+
+
+def build_crosstabs(args):
+    from data import get_data
+    from util.cube import build_crosstab_cube, save_crosstab_cube
+    from util.geo import build_state_cube
+
+    # Precompute every crosstab and state map shown in the dashboard
+    data, data_dict = get_data()
+    factor_values, _ = get_factor_values(data_dict)
+    cube = build_crosstab_cube(data, data_dict, main_factors, factor_values)
+    cube["states"] = build_state_cube(data, data_dict, get_geo_outcomes(data_dict), geo_filter_factor)
+    save_crosstab_cube(cube, args.output)
+    print(f"Saved crosstabs to {args.output}")
+
+
+def build_figures(args):
+    from app import render_figures
+
+    # Pre-render every figure reachable from the dropdowns, from the household
+    # data (or the crosstab artifact if HPS_CROSSTABS is set)
+    figure_store = render_figures()
+    figure_store.save(args.output)
+    print(f"Saved {len(figure_store):,} figures to {args.output}")
+
+
+def build_ingest(args):
+    from data import data_dict_file, partition_folder, get_data, get_data_dictionary, get_fingerprint
+    from parsers.ingest import ingest_puf_files
+    from util.cube import (build_crosstab_sums, combine_crosstab_sums, load_crosstab_sums, save_crosstab_cube,
+                           save_crosstab_sums)
+    from util.geo import build_state_cube
+
+    def get_sums_file(cycle):
+        return os.path.join(partition_folder, f"{cycle}.sums.npz")
+
+    def refresh_sums(cycle, data, data_dict):
+        # Aggregate each new or changed partition on its own
+        factor_values, _ = get_factor_values(data_dict)
+        save_crosstab_sums(build_crosstab_sums(data, main_factors, factor_values), get_sums_file(cycle))
+
+    # Process new or changed PUF zipfiles into partitions
+    data_dict = get_data_dictionary()
+    manifest, changed = ingest_puf_files(args.data_folder, partition_folder, data_dict,
+                                         fingerprint=get_fingerprint([data_dict_file]),
+                                         replicate_weights=args.replicate_weights, on_partition=refresh_sums)
+    if not changed and os.path.exists(args.output):
+        print(f"{args.output} is up to date")
+        return
+
+    # Combine partitions into the cache shared by the app workers
+    data, data_dict = get_data()
+
+    # Combine the crosstab sums of all partitions; state maps are computed
+    # in a single pass over the combined data
+    factor_values, _ = get_factor_values(data_dict)
+    cycles = [entry["cycle"] for entry in manifest["archives"].values()]
+    partition_sums = [load_crosstab_sums(get_sums_file(cycle)) for cycle in cycles]
+    cube = combine_crosstab_sums(partition_sums, data_dict, main_factors, factor_values)
+    cube["states"] = build_state_cube(data, data_dict, get_geo_outcomes(data_dict), geo_filter_factor)
+    save_crosstab_cube(cube, args.output)
+    print(f"Saved crosstabs to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build artifacts for the dashboard")
+    subparsers = parser.add_subparsers(required=True)
+
+    # Processed data cache
+    parser_data = subparsers.add_parser("data", help="Process the household data into the cache")
+    parser_data.set_defaults(func=build_data)
+
+    # Compiled data dictionary
+    parser_dictionary = subparsers.add_parser("dictionary", help="Compile the data dictionary workbook")
+    parser_dictionary.add_argument("--force", action="store_true", help="Compile even if up to date")
+    parser_dictionary.set_defaults(func=build_dictionary)
+
+    # Crosstab cube
+    parser_crosstabs = subparsers.add_parser("crosstabs", help="Precompute all crosstabs")
+    parser_crosstabs.add_argument("--output", default="artifacts/crosstabs.json")
+    parser_crosstabs.set_defaults(func=build_crosstabs)
+
+    # Pre-rendered figures
+    parser_figures = subparsers.add_parser("figures", help="Pre-render the figures reachable from the dropdowns")
+    parser_figures.add_argument("--output", default="artifacts/figures.json")
+    parser_figures.set_defaults(func=build_figures)
+
+    # Incremental ingestion of PUF zipfiles
+    parser_ingest = subparsers.add_parser("ingest", help="Process new survey cycles and refresh the crosstabs")
+    parser_ingest.add_argument("--data-folder", required=True, help="Folder of PUF CSV zipfiles")
+    parser_ingest.add_argument("--replicate-weights", action="store_true")
+    parser_ingest.add_argument("--output", default="artifacts/crosstabs.json")
+    parser_ingest.set_defaults(func=build_ingest)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,181 @@
+import hashlib
+import json
+import os
 import pandas as pd
 
-from parsers.parse_data_dictionary import parse_data_dictionary
-from parsers.parse_puf_files import custom_puf_handling
+from parsers.ingest import get_manifest_file, load_partitions
+from parsers.parse_data_dictionary import DataDictionary
+from parsers.parse_puf_files import compile_data_dictionary, custom_puf_handling
+from util.startup import StartupTimer
+from util.storage import read_table_file, write_table_file
 
+# Input files
+data_file = "displaced_households.csv"
+data_dict_file = "Data_Dictionary.xlsx"
 
-def get_data():
+# Processed data partitioned by survey cycle (see build.py ingest); used
+# instead of the CSV when present
+partition_folder = "partitions"
 
-    # Load data
-    data = pd.read_csv("displaced_households.csv")
+# Processed data cache; bump the pipeline version whenever custom_puf_handling
+# changes its output so that existing caches are rebuilt
+cache_folder = "cache"
+pipeline_version = 6
 
-    # Read data dictionary
-    data_dict_file = "Data_Dictionary.xlsx"
-    data_dict = parse_data_dictionary(data_dict_file).set_index('Variable')
 
-    # Implement custom data handling
-    data, data_dict = custom_puf_handling(data, data_dict)
+def get_data(use_cache=True, memory_map=False, timer=None):
+    """Loads the processed household data and data dictionary
 
-    return data, data_dict
\ No newline at end of file
+    Args:
+        use_cache (bool): Whether the processed data is read from (and
+            written to) the cache
+        memory_map (bool): Whether the cached columns are memory-mapped
+            read-only instead of copied into memory, so that every worker
+            process serving the app shares a single copy of the data
+        timer (StartupTimer): Records the duration of each loading phase
+
+    Returns:
+        data (pd.DataFrame): Processed household data
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+
+    timer = timer if timer is not None else StartupTimer()
+
+    # Attempt to read processed data from the cache; it may have been pruned
+    # by another process in the meantime, in which case it is rebuilt
+    if use_cache:
+        cache_file = get_cache_file()
+        if os.path.exists(cache_file):
+            try:
+                with timer.phase("cache read"):
+                    return read_cache(cache_file, memory_map=memory_map)
+            except FileNotFoundError:
+                pass
+
+    if os.path.exists(get_manifest_file(partition_folder)):
+        # Combine the partitions, which are already processed
+        with timer.phase("partition load"):
+            data, data_dict = load_partitions(partition_folder)
+    else:
+        # Load data
+        with timer.phase("CSV load"):
+            data = pd.read_csv(data_file)
+
+        # Read data dictionary
+        with timer.phase("dictionary load"):
+            data_dict = get_data_dictionary()
+
+        # Implement custom data handling
+        with timer.phase("recode"):
+            data, data_dict = custom_puf_handling(data, data_dict)
+
+    # Store processed data for the next start
+    if use_cache:
+        write_cache(cache_file, data, data_dict)
+        if memory_map:
+            try:
+                return read_cache(cache_file, memory_map=True)
+            except FileNotFoundError:
+                pass
+
+    return data, data_dict
+
+
+def get_fingerprint(file_paths, block_size=2**20):
+    """Hashes the contents of the input files along with the pipeline version
+
+    Args:
+        file_paths (list): Files whose contents determine the processed data
+        block_size (int): Number of bytes read at a time
+
+    Returns:
+        fingerprint (str): Hexadecimal digest
+    """
+    digest = hashlib.sha256(f"pipeline={pipeline_version}".encode())
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def get_data_dictionary(use_cache=True):
+    """Loads the augmented data dictionary, which is compiled from the
+    workbook once and stored as JSON keyed by the workbook contents
+
+    Args:
+        use_cache (bool): Whether the compiled data dictionary is read from
+            (and written to) the cache
+
+    Returns:
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+    fingerprint = get_fingerprint([data_dict_file])
+    dict_file = os.path.join(cache_folder, f"data_dict_{fingerprint[:16]}.json")
+    if use_cache and os.path.exists(dict_file):
+        try:
+            with open(dict_file) as f:
+                return DataDictionary.from_records(json.load(f))
+        except FileNotFoundError:
+            pass
+
+    # Compile data dictionary from the workbook
+    data_dict = compile_data_dictionary(data_dict_file)
+    if use_cache:
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_file = f"{dict_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(data_dict.to_records(), f, separators=(",", ":"))
+        os.replace(tmp_file, dict_file)
+        prune_cache(dict_file)
+        print(f"Compiled data dictionary to {dict_file}")
+    return data_dict
+
+
+def get_cache_file():
+    """Returns the cache location for the current inputs"""
+    manifest_file = get_manifest_file(partition_folder)
+    inputs = [manifest_file if os.path.exists(manifest_file) else data_file, data_dict_file]
+    fingerprint = get_fingerprint(inputs)
+    return os.path.join(cache_folder, f"households_{fingerprint[:16]}.arrow")
+
+
+def read_cache(cache_file, memory_map=False):
+    """Reads the processed data and data dictionary from the cache (see
+    util.storage.read_table_file)"""
+    return read_table_file(cache_file, memory_map=memory_map)
+
+
+def prune_cache(cache_file):
+    """Removes the cache files of the same kind as cache_file (e.g.,
+    households_*.arrow) that were written for other inputs. The file itself
+    is kept, since other processes with the same inputs may be reading it,
+    and files already removed by another process are skipped
+
+    Args:
+        cache_file (str): Cache file written for the current inputs, named
+            {kind}_{fingerprint}.{extension}
+    """
+    name = os.path.basename(cache_file)
+    prefix, extension = name[:name.rindex("_") + 1], os.path.splitext(name)[1]
+    for file in os.listdir(cache_folder):
+        if file != name and file.startswith(prefix) and file.endswith(extension):
+            try:
+                os.remove(os.path.join(cache_folder, file))
+            except FileNotFoundError:
+                pass
+
+
+def write_cache(cache_file, data, data_dict):
+    """Writes the processed data and data dictionary to an Arrow IPC file
+    atomically, then removes the caches of previous inputs
+
+    Args:
+        cache_file (str): Location of the cache
+        data (pd.DataFrame): Processed household data
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    write_table_file(cache_file, data, data_dict)
+    prune_cache(cache_file)
+    print(f"Cached processed data to {cache_file}")
@@ -0,0 +1,56 @@
+# Outcomes shown in the dashboard
+damage_factor, duration_factor = "ND_DAMAGE", "ND_HOWLONG"
+main_factors = [damage_factor, duration_factor]
+
+# Factors that can be compared against each outcome
+relevant_factors = ['ND_DAMAGE', 'ND_HOWLONG', 
+                    'ND_UNSANITARY', 'ND_FDSHRTAGE', 'ND_WATER', 'ND_ELCTRC',
+                    'HAZARD_TYPE', 'REGION',
+                    'TENURE', 'LIVQTRRV', 'DWELLTYPE', 'RENT_BIN', 'EEDUC', 'INCOME', 'INCOME_PER',
+                    'HH_BIN', 'AGE_BIN', 'RHISPANIC', 'RRACE','MS', 'GENID_DESCRIBE',
+                    'DOWN', 'WORRY', 'INTEREST', 'ANXIOUS',
+                    'MOBILITY', 'REMEMBERING', 'SELFCARE', 'UNDERSTAND',
+                    'ANYWORK', 'SETTING', 'KINDWORK', 'TWDAYS', 'SCHOOLENROLL',
+                    ]
+
+# State-level outcomes: proportion of displaced households whose outcome is
+# one of the given codes
+geo_factors = {
+    'DISP_LT1MO': ('ND_HOWLONG', (1, 2), 'The proportion of disaster-displaced households that returned in less than 1 month'),
+    'DISP_GT1MO': ('ND_HOWLONG', (3, 4), 'The proportion of disaster-displaced households that took longer than 1 month to return'),
+    'DISP_NORETURN': ('ND_HOWLONG', (5,), 'The proportion of disaster-displaced households that had not returned'),
+}
+geo_outcome_factors = ['ND_DAMAGE', 'ND_HOWLONG', 'PROTRACTED', 'PHASE_RETURN', 'RETURN_1', 'RETURN_2', 'RETURN_3']
+geo_filter_factor = 'HAZARD_TYPE'
+
+# Factors of the subgroup filter panel
+filter_factors = ['HAZARD_TYPE', 'REGION', 'TENURE_STATUS', 'INCOME']
+
+# Factors by which the outcome charts can be split into facets
+facet_factors = ['HAZARD_TYPE', 'REGION', 'TENURE_STATUS']
+
+
+def get_factor_values(data_dict):
+    """Returns the categorical factors and their friendly names"""
+    factor_values = [factor for factor in relevant_factors if data_dict.type(factor) in ['Ordinal', 'Nominal']]
+    factor_names = [data_dict.name(factor) for factor in factor_values]
+    return factor_values, factor_names
+
+
+def get_geo_outcomes(data_dict):
+    """Returns the state-level outcomes as {value: (outcome, codes, description)},
+    with one outcome for each category of the geographic outcome factors"""
+    geo_outcomes = dict(geo_factors)
+    for factor in geo_outcome_factors:
+        name = data_dict.name(factor)
+        for code, label in data_dict.labels(factor).items():
+            geo_outcomes[f"{factor}={code}"] = (factor, (code,), f"{name}: {label}")
+    return geo_outcomes
+
+
+def get_filter_options(data_dict):
+    """Returns the subgroup filters as a list of {value, name, options}, with
+    the [code, label] pairs of each filter factor as options"""
+    return [{"value": factor, "name": data_dict.name(factor),
+             "options": [[code, label] for code, label in data_dict.labels(factor).items()]}
+            for factor in filter_factors if factor in data_dict]
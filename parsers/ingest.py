@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+from parsers.parse_puf_files import custom_puf_handling, get_puf_columns, is_displaced, load_puf_zip, puf_file_suffix
+from parsers.recode import compact_columns
+from util.storage import read_table_file, write_table_file
+
+# Record of the PUF zipfiles processed into a partitioned dataset
+manifest_name = "manifest.json"
+
+
+def get_manifest_file(partition_folder):
+    """Location of the manifest of a partitioned dataset"""
+    return os.path.join(partition_folder, manifest_name)
+
+
+def read_manifest(partition_folder):
+    """Reads the manifest of a partitioned dataset
+
+    Args:
+        partition_folder (str): Location of the partitions and manifest
+
+    Returns:
+        manifest (dict): Fingerprint of the processing inputs and an entry
+            per processed zipfile (cycle, partition, size, modification
+            time, SHA-256 and number of rows); empty if there is none yet
+    """
+    manifest_file = get_manifest_file(partition_folder)
+    if not os.path.exists(manifest_file):
+        return {"fingerprint": None, "archives": {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(partition_folder, manifest):
+    """Writes the manifest of a partitioned dataset atomically"""
+    manifest_file = get_manifest_file(partition_folder)
+    tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def get_file_hash(file_path, block_size=2**20):
+    """Hashes the contents of a file with SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_cycle_name(zip_file):
+    """Names the partition of a PUF zipfile after its survey cycle, e.g.
+    HPS_Week63 for HPS_Week63_PUF_CSV.zip"""
+    return zip_file[:-len(puf_file_suffix)]
+
+
+def remove_partition(partition_folder, cycle):
+    """Deletes the partition of a survey cycle along with any file derived
+    from it (e.g., its aggregates), i.e. every file named {cycle}.*"""
+    for file in os.listdir(partition_folder):
+        if file.startswith(f"{cycle}."):
+            os.remove(os.path.join(partition_folder, file))
+
+
+def ingest_puf_files(data_folder, partition_folder, data_dict, fingerprint=None, replicate_weights=False,
+                     on_partition=None):
+    """Incrementally processes PUF CSV zipfiles into a dataset with one
+    partition per survey cycle: zipfiles already listed in the manifest with
+    the same size and hash are skipped, new or changed zipfiles are parsed
+    and processed on their own, and partitions of removed zipfiles are
+    deleted
+
+    Args:
+        data_folder (str): Location where PUF CSV zipfiles are stored
+        partition_folder (str): Location of the partitions and manifest
+        data_dict (DataDictionary): Data dictionary
+        fingerprint (str): Digest of the processing inputs (e.g., data
+            dictionary and pipeline version); every zipfile is processed
+            again if it differs from the one in the manifest
+        replicate_weights (bool): Whether the household replicate weights
+            are kept
+        on_partition (callable): Called as on_partition(cycle, data,
+            data_dict) after each partition is written, e.g. to refresh the
+            aggregates of that partition
+
+    Returns:
+        manifest (dict): Updated manifest
+        changed (list): Survey cycles that were added, updated or removed
+    """
+    os.makedirs(partition_folder, exist_ok=True)
+    previous = read_manifest(partition_folder)
+    reusable = previous["archives"] if previous["fingerprint"] == fingerprint else {}
+    usecols = get_puf_columns(data_dict)
+
+    # Find all available PUF zip files
+    puf_zip_files = sorted(file for file in os.listdir(data_folder) if file.endswith(puf_file_suffix))
+
+    archives, changed = {}, []
+    for zip_file in puf_zip_files:
+        zip_path = os.path.join(data_folder, zip_file)
+        cycle = get_cycle_name(zip_file)
+        stat = os.stat(zip_path)
+        entry = reusable.get(zip_file)
+        if entry is not None and not os.path.exists(os.path.join(partition_folder, entry["partition"])):
+            entry = None
+
+        # Reuse the partition of an unchanged zipfile; the hash is only
+        # computed if the size or modification time differ
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            archives[zip_file] = entry
+            continue
+        sha256 = get_file_hash(zip_path)
+        if entry is not None and entry["size"] == stat.st_size and entry["sha256"] == sha256:
+            archives[zip_file] = dict(entry, mtime=stat.st_mtime)
+            continue
+
+        # Process the new or changed zipfile on its own
+        puf, elapsed = load_puf_zip(zip_path, usecols=usecols, row_filter=is_displaced, compact=True,
+                                    replicate_weights=replicate_weights)
+        data, data_dict_out = custom_puf_handling(puf, data_dict)
+        remove_partition(partition_folder, cycle)
+        partition = f"{cycle}.arrow"
+        write_table_file(os.path.join(partition_folder, partition), data, data_dict_out)
+        print(f"    {zip_file}: {len(data):,.0f} rows in {elapsed:.2f}s")
+        if on_partition is not None:
+            on_partition(cycle, data, data_dict_out)
+        archives[zip_file] = {"cycle": cycle, "partition": partition, "size": stat.st_size,
+                              "mtime": stat.st_mtime, "sha256": sha256, "rows": len(data)}
+        changed.append(cycle)
+
+    # Remove partitions of zipfiles that are no longer available
+    for zip_file, entry in previous["archives"].items():
+        if zip_file not in archives:
+            remove_partition(partition_folder, entry["cycle"])
+            changed.append(entry["cycle"])
+
+    manifest = {"fingerprint": fingerprint, "archives": archives}
+    write_manifest(partition_folder, manifest)
+    print(f"Ingested {len(archives):,.0f} survey cycles ({len(changed):,.0f} changed)")
+    return manifest, changed
+
+
+def load_partitions(partition_folder):
+    """Combines the partitions listed in the manifest into the processed
+    household data
+
+    Args:
+        partition_folder (str): Location of the partitions and manifest
+
+    Returns:
+        data (pd.DataFrame): Processed household data of every cycle
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+    manifest = read_manifest(partition_folder)
+    entries = [manifest["archives"][zip_file] for zip_file in sorted(manifest["archives"])]
+    if not entries:
+        raise FileNotFoundError(f"No partitions listed in {get_manifest_file(partition_folder)}")
+    partitions = [read_table_file(os.path.join(partition_folder, entry["partition"])) for entry in entries]
+
+    # Combine partitions; cycles may lack some columns or store them with
+    # different integer widths and categories, which are compacted again
+    data_dict = partitions[0][1]
+    data = pd.concat([data for data, _ in partitions], axis=0, ignore_index=True)
+    data = compact_columns(data, data_dict)
+    return data, data_dict
@@ -1,3 +1,5 @@
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
 import pandas as pd
 
 
@@ -55,3 +57,108 @@ def parse_data_dictionary(file_path, drop_bad=True):
 
     # Return result
     return data_dict
+
+
+class Variable(NamedTuple):
+    """Entry of the data dictionary"""
+    variable: str
+    name: str
+    type: str
+    labels: Mapping
+
+
+class DataDictionary:
+    """Immutable registry of the variables in the data dictionary, with
+    constant-time lookups of their names, types and value labels
+
+    Args:
+        variables (iterable): Variable entries, in order
+    """
+
+    __slots__ = ("_variables",)
+
+    def __init__(self, variables):
+        variables = {var.variable: var._replace(labels=MappingProxyType(dict(var.labels))) for var in variables}
+        object.__setattr__(self, "_variables", MappingProxyType(variables))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DataDictionary is immutable")
+
+    def __getitem__(self, variable):
+        return self._variables[variable]
+
+    def __contains__(self, variable):
+        return variable in self._variables
+
+    def __iter__(self):
+        return iter(self._variables)
+
+    def __len__(self):
+        return len(self._variables)
+
+    def __eq__(self, other):
+        return isinstance(other, DataDictionary) and self.to_records() == other.to_records()
+
+    def name(self, variable):
+        """Friendly name of a variable"""
+        return self._variables[variable].name
+
+    def type(self, variable):
+        """Type of a variable, e.g. 'Nominal' or 'Continuous'"""
+        return self._variables[variable].type
+
+    def labels(self, variable):
+        """Read-only mapping of the codes of a variable to their labels"""
+        return self._variables[variable].labels
+
+    def extend(self, entries):
+        """Returns a data dictionary with derived variables added; variables
+        already in the data dictionary only have their labels updated
+
+        Args:
+            entries (list): Dicts with 'target', 'name', 'type' and 'labels'
+
+        Returns:
+            data_dict (DataDictionary): Augmented data dictionary
+        """
+        variables = dict(self._variables)
+        for entry in entries:
+            target = entry['target']
+            if target in variables:
+                variables[target] = variables[target]._replace(labels=entry['labels'])
+            else:
+                variables[target] = Variable(target, entry['name'], entry['type'], entry['labels'])
+        return DataDictionary(variables.values())
+
+    def to_records(self):
+        """Converts the data dictionary into compact JSON-serializable
+        records; labels are stored as [code, label] pairs so that integer
+        codes survive the round trip
+
+        Returns:
+            records (list): [variable, name, type, labels] per variable
+        """
+        return [[var.variable, var.name, var.type, [[code, label] for code, label in var.labels.items()]]
+                for var in self._variables.values()]
+
+    @classmethod
+    def from_records(cls, records):
+        """Rebuilds a data dictionary from records created by to_records"""
+        return cls(Variable(variable, name, type_, {code: label for code, label in labels})
+                   for variable, name, type_, labels in records)
+
+    @classmethod
+    def from_frame(cls, data_dict):
+        """Builds a data dictionary from the output of parse_data_dictionary
+
+        Args:
+            data_dict (pd.DataFrame): Parsed workbook indexed by variable
+
+        Returns:
+            data_dict (DataDictionary): Data dictionary
+        """
+        return cls(
+            Variable(var, None if pd.isna(row['Name']) else row['Name'],
+                     None if pd.isna(row['Type']) else row['Type'], row['Conversion'])
+            for var, row in data_dict.iterrows()
+        )
@@ -1,45 +1,208 @@
+import contextlib
+import io
 import os
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import pandas as pd
 
+from parsers.parse_data_dictionary import DataDictionary, parse_data_dictionary
+from parsers.recode import (BAD_VALUES, MISSING_CODE, apply_recodes, compact_columns, downcast_float, get_bin_codes,
+                            get_bin_labels, is_replicate_weight)
 
-def parse_puf_files(data_folder, drop_bad=True):
+# Suffix of the PUF CSV zipfiles published by the Census Bureau
+puf_file_suffix = "_PUF_CSV.zip"
+
+
+def parse_puf_files(data_folder, drop_bad=True, usecols=None, row_filter=None, chunksize=None,
+                    n_workers=None, compact=True, replicate_weights=False):
     """This function loads all available PUF CSV zip files
 
     Args:
         data_folder (str): Location where PUF CSV zipfiles are stored
+        drop_bad (bool): Whether -88/-99 responses are set to NaN
+        usecols (list): Columns to keep; all columns are kept if None
+        row_filter (callable): Returns a boolean mask of rows to keep
+        chunksize (int): If given, each CSV is streamed in chunks of this
+            many rows, so that only the selected rows and columns are held
+        n_workers (int): If greater than 1, zipfiles are parsed in a pool
+            of this many processes; row_filter must then be picklable
+        compact (bool): Whether columns are losslessly downcast per zipfile,
+            before results are returned from the pool processes
+        replicate_weights (bool): Whether the household replicate weights
+            (HWEIGHT1, HWEIGHT2, ...) are added as float32 columns
 
     Returns:
         puf (pd.DataFrame): DataFrame combining all available PUF CSVs
     """
 
     # Find all available PUF zip files
-    file_suffix = "_PUF_CSV.zip"
-    puf_zip_files = [
-        file for file in os.listdir(data_folder) if file.endswith(file_suffix)
-    ]
+    puf_zip_files = sorted(
+        file for file in os.listdir(data_folder) if file.endswith(puf_file_suffix)
+    )
     puf_zip_paths = [os.path.join(data_folder, file) for file in puf_zip_files]
     n_puf = len(puf_zip_files)
 
     # Initialize data
+    load_zip = partial(load_puf_zip, drop_bad=drop_bad, usecols=usecols, row_filter=row_filter,
+                       chunksize=chunksize, compact=compact, replicate_weights=replicate_weights)
+    if n_workers is not None and n_workers > 1 and n_puf > 1:
+        # Results are returned in the order of the (sorted) zipfiles
+        with ProcessPoolExecutor(max_workers=min(n_workers, n_puf)) as executor:
+            results = list(executor.map(load_zip, puf_zip_paths))
+    else:
+        results = [load_zip(puf_zip_path) for puf_zip_path in puf_zip_paths]
+
+    # Report timing per zipfile
     pufs = [pd.DataFrame() for _ in range(n_puf)]
     for i in range(n_puf):
-        with zipfile.ZipFile(puf_zip_paths[i], "r") as f:
-            puf_name = [
-                name
-                for name in f.namelist()
-                if name.endswith(".csv") and "repwgt" not in name
-            ][0]
-            pufs[i] = pd.read_csv(f.open(puf_name))
+        pufs[i], elapsed = results[i]
+        print(f"    {puf_zip_files[i]}: {len(pufs[i]):,.0f} rows in {elapsed:.2f}s")
 
     # Combine data
     puf = pd.concat(pufs, axis=0)
 
     # Print that 'bad' values are being dropped
     if drop_bad:
-        bad_vals = [-88, -99]
-        puf.replace(bad_vals, float('nan'), inplace=True)
-        print(f"Setting bad_vals ({bad_vals}) = NaN")
+        print(f"Setting bad_vals ({BAD_VALUES}) = NaN")
+
+    # Return result
+    return puf
+
+
+def load_puf_zip(zip_path, compact=True, **kwargs):
+    """Reads a single PUF CSV zipfile and times it; used by both the serial
+    and the process pool paths of parse_puf_files
+
+    Args:
+        zip_path (str): Path to the PUF CSV zipfile
+        compact (bool): Whether columns are losslessly downcast
+        **kwargs: Passed to read_puf_zip
+
+    Returns:
+        puf (pd.DataFrame): Selected rows and columns of the PUF CSV
+        elapsed (float): Time taken in seconds
+    """
+    start = time.perf_counter()
+    try:
+        puf = read_puf_zip(zip_path, **kwargs)
+    except Exception as e:
+        raise RuntimeError(f"Failed to parse {zip_path}") from e
+    if compact:
+        puf = downcast_columns(puf)
+    elapsed = time.perf_counter() - start
+    return puf, elapsed
+
+
+def downcast_columns(df):
+    """Downcasts numeric columns without changing any value: integer
+    columns to the smallest integer type, float columns to float32 where
+    every value survives the round trip
+
+    Args:
+        df (pd.DataFrame): Data to downcast
+
+    Returns:
+        df (pd.DataFrame): Downcast data
+    """
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_integer_dtype(values):
+            df[col] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_float_dtype(values) and values.dtype != np.float32:
+            df[col] = downcast_float(values)
+    return df
+
+
+def get_puf_member(f, repwgt=False):
+    """Finds the main PUF CSV within an opened zipfile, skipping the
+    replicate weights file unless requested
+
+    Args:
+        f (zipfile.ZipFile): Opened PUF CSV zipfile
+        repwgt (bool): Whether the replicate weights file is returned instead
+
+    Returns:
+        puf_name (str): Name of the PUF CSV within the zipfile
+    """
+    puf_name = [
+        name
+        for name in f.namelist()
+        if name.endswith(".csv") and ("repwgt" in name) == repwgt
+    ][0]
+    return puf_name
+
+
+def get_puf_columns(data_dict):
+    """Lists the PUF columns needed downstream: every variable in the data
+    dictionary (which covers the inputs of custom_puf_handling and the raw
+    factors shown in the dashboard) plus the household identifier
+
+    Args:
+        data_dict (DataDictionary): Data dictionary
+
+    Returns:
+        usecols (list): Columns to keep when reading PUF files
+    """
+    return ["SCRAM"] + [var for var in data_dict if var != "SCRAM"]
+
+
+def is_displaced(df):
+    """Row filter keeping only households displaced by a disaster"""
+    return df["ND_DISPLACE"] == 1
+
+
+def read_puf_zip(zip_path, drop_bad=True, usecols=None, row_filter=None, chunksize=None,
+                 replicate_weights=False):
+    """Reads the PUF CSV from a single zipfile
+
+    Args:
+        zip_path (str): Path to the PUF CSV zipfile
+        drop_bad (bool): Whether -88/-99 responses are set to NaN
+        usecols (list): Columns to keep; all columns are kept if None
+        row_filter (callable): Returns a boolean mask of rows to keep
+        chunksize (int): If given, the CSV is streamed in chunks
+        replicate_weights (bool): Whether the household replicate weights
+            are added as float32 columns, matched by SCRAM
+
+    Returns:
+        puf (pd.DataFrame): Selected rows and columns of the PUF CSV
+    """
+
+    # Older survey cycles may lack some columns
+    if usecols is not None:
+        keep = set(usecols)
+        usecols = lambda col: col in keep
+
+    with zipfile.ZipFile(zip_path, "r") as f:
+        puf_name = get_puf_member(f)
+        with f.open(puf_name) as csv:
+            reader = pd.read_csv(csv, usecols=usecols, chunksize=chunksize)
+            # Reduce each chunk as soon as it is read
+            chunks = [reader] if chunksize is None else reader
+            pufs = []
+            for chunk in chunks:
+                if row_filter is not None:
+                    chunk = chunk[row_filter(chunk)]
+                if drop_bad:
+                    chunk = chunk.replace(BAD_VALUES, float('nan'))
+                pufs.append(chunk)
+
+        # Combine chunks
+        puf = pufs[0] if len(pufs) == 1 else pd.concat(pufs, axis=0)
+
+        # Add replicate weights of the selected households
+        if replicate_weights:
+            repwgt_name = get_puf_member(f, repwgt=True)
+            with f.open(repwgt_name) as csv:
+                reader = pd.read_csv(csv, chunksize=chunksize,
+                                     usecols=lambda col: col == "SCRAM" or is_replicate_weight(col))
+                chunks = [reader] if chunksize is None else reader
+                repwgts = [chunk[chunk["SCRAM"].isin(puf["SCRAM"])] for chunk in chunks]
+            repwgt = pd.concat(repwgts, axis=0).set_index("SCRAM").astype(np.float32)
+            puf = puf.join(repwgt, on="SCRAM")
 
     # Return result
     return puf
@@ -51,45 +214,198 @@ def custom_puf_handling(puf, data_dict):
     in_cols = puf.columns.tolist()
 
     # Get hazard type
-    puf, data_dict = get_hazard_type(puf, data_dict)
+    puf, hazard_entry = get_hazard_type(puf)
 
     # Bin continuous or discrete datasets
-    puf, data_dict = convert_birth_year_to_age_bin(puf, data_dict)
-    puf, data_dict = convert_hh_size_to_bin(puf, data_dict)
-    puf, data_dict = convert_rent_to_bin(puf, data_dict)
+    puf, age_entry = convert_birth_year_to_age_bin(puf)
+    puf, hh_entry = convert_hh_size_to_bin(puf)
+    puf, rent_entry = convert_rent_to_bin(puf)
 
     # Normalize household income
-    puf, data_dict = normalize_income(puf, data_dict)
-
-    # Rebin columns for tenure and living quarters, etc
-    puf, data_dict = rebin_livqtr_column(puf, data_dict)
-    puf, data_dict = rebin_tenure_column(puf, data_dict)
-    puf, data_dict = rebin_race(puf, data_dict)
+    puf, income_entry = normalize_income(puf)
 
-    # Get school enrollment variable
-    puf, data_dict = rebin_school_enroll(puf, data_dict)
+    # Rebin and create dummy columns in a single pass
+    recodes = get_recodes(data_dict)
+    puf = apply_recodes(puf, recodes)
 
-    # Create dummy columns for living quarters
-    puf, data_dict = append_livqtr_columns(puf, data_dict)
-
-    # Create columns for retun, protracted displacement
-    puf, data_dict = append_returned_column(puf, data_dict)
-    puf, data_dict = append_protracted_column(puf, data_dict)
-    puf, data_dict = append_recovery_column(puf, data_dict)
-    puf, data_dict = append_phase_column(puf, data_dict)
-    puf, data_dict = append_phase_return_column(puf, data_dict)
-    # Create columns for return time windows
-    puf, data_dict = append_return_window_columns(puf, data_dict)
+    # Add derived variables to data dictionary
+    entries = [hazard_entry, age_entry, hh_entry, rent_entry, income_entry] + recodes
+    data_dict = data_dict.extend(entries)
 
     # Determine new columns
     out_cols = puf.columns.tolist()
     new_cols = [col for col in out_cols if col not in in_cols]
     print(f"Added new columns: {new_cols}")
 
+    # Store coded columns as small integers
+    puf = compact_columns(puf, data_dict)
+
     return puf, data_dict
 
 
-def get_hazard_type(df, data_dict):
+def compile_data_dictionary(file_path):
+    """Parses the data dictionary workbook and adds the variables derived by
+    custom_puf_handling, whose entries do not depend on the households
+
+    Args:
+        file_path (str): Location of the data dictionary workbook
+
+    Returns:
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+    data_dict = DataDictionary.from_frame(parse_data_dictionary(file_path).set_index('Variable'))
+
+    # Derive the new variables of an empty PUF
+    empty = pd.DataFrame({col: pd.Series(dtype=float) for col in get_puf_columns(data_dict)})
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, data_dict = custom_puf_handling(empty, data_dict)
+    return data_dict
+
+
+def get_school_enroll_code(df):
+    # Combine TENROLLPUB, TENROLLPRV
+    # 0) Neither
+    # 1) Public only
+    # 2) Private only
+    # 3) Public and private
+    return (df['TENROLLPUB'] > 0).astype(int) + 2*(df['TENROLLPRV'] > 0).astype(int)
+
+
+def get_recodes(data_dict):
+    """Lists the derived variables that are recoded from a single source, as
+    used by apply_recodes; add an entry here to add a derived variable
+
+    Args:
+        data_dict (DataDictionary): Data dictionary
+
+    Returns:
+        recodes (list): Recode specifications
+    """
+    recodes = [
+        # Rebin LIVQTRRV
+        # LIVQTR_REBIN = 1) Single-family
+        # 2) Detached single-family
+        # 3) Attached single-family
+        # LIVQTR_REBIN = 2) Multi-family
+        # 4) Apartment building, 2 units
+        # 5) Apartment building, 3-4 units
+        # 6) Apartment building, 5+ units
+        # LIVQTR_REBIN = 3) Mobile home
+        # 1) A mobile home
+        # LIVQTR_REBIN = 4) Other
+        # 7) Boat, RV, van, etc
+        {'source': 'LIVQTRRV', 'target': 'DWELLTYPE',
+         'mapping': {1: 3, 2: 1, 3: 1, 4: 2, 5: 2, 6: 2, 7: 4},
+         'name': 'Dwelling type', 'type': 'Nominal',
+         'labels': {1: 'Single-family', 2: 'Multi-family', 3: 'Mobile home', 4: 'Other (boat, RV, van, etc.)'}},
+        # Rebin TENURE
+        # TENURE_STATUS = 1) Owned
+        # 1) Owned, free and clear
+        # 2) Owned, with loan/mortgage
+        # TENURE_STATUS = 2) Rented
+        # 3) Rented
+        # TENURE_STATUS = 3) Occupied without payment
+        # 4) Occupied without payment
+        {'source': 'TENURE', 'target': 'TENURE_STATUS',
+         'mapping': {1: 1, 2: 1, 3: 2, 4: 3},
+         'name': 'Tenure status', 'type': 'Nominal',
+         'labels': {1: 'Owned', 2: 'Rented', 3: 'Occupied without payment'}},
+        # Rebin RRACE
+        # RACIAL_MINORITY = 1) No
+        # 1) White
+        # RACIAL_MINORITY = 2) Yes
+        # 2) Black
+        # 3) Asian
+        # 4) Other/Mixed
+        {'source': 'RRACE', 'target': 'RMINORITY',
+         'mapping': {1: 1, 2: 2, 3: 2, 4: 2},
+         'name': 'Racial minority', 'type': 'Nominal',
+         'labels': {1: 'No', 2: 'Yes'}},
+        # Rebin SCHOOLENROLL based on TENROLLPUB, TENROLLPRV
+        # 1) None
+        # 2) Public school
+        # 3) Private school
+        # 4) Public and private
+        {'source': get_school_enroll_code, 'target': 'SCHOOLENROLL',
+         'mapping': {0: 1, 1: 2, 2: 3, 3: 4},
+         'name': 'School enrollment', 'type': 'Nominal',
+         'labels': {1: 'None', 2: 'Public school', 3: 'Private school', 4: 'Public and private'}},
+        # Transform LIVQTRRV into dummy variables
+        # LIVQTR_OTHER = 1) Yes, 0) No
+        # 7) Boat, RV, van, etc
+        {'source': 'LIVQTRRV', 'target': 'LIVQTR_OTHER',
+         'mapping': {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 1},
+         'name': 'Dwelling type: Boat, RV, van, etc.', 'type': 'Nominal',
+         'labels': {0: 'No', 1: 'Yes'}},
+        # LIVQTR_MOBILE = 1) Yes, 0) No
+        # 1) A mobile home
+        {'source': 'LIVQTRRV', 'target': 'LIVQTR_MOBILE',
+         'mapping': {1: 1, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0},
+         'name': 'Dwelling type: Mobile home', 'type': 'Nominal',
+         'labels': {0: 'No', 1: 'Yes'}},
+        # LIVQTR_SINGLE = 1) Yes, 0) No
+        # 2) Detached single-family
+        # 3) Attached single-family
+        {'source': 'LIVQTRRV', 'target': 'LIVQTR_SINGLE',
+         'mapping': {1: 0, 2: 1, 3: 1, 4: 0, 5: 0, 6: 0, 7: 0},
+         'name': 'Dwelling type: Single-family', 'type': 'Nominal',
+         'labels': {0: 'No', 1: 'Yes'}},
+        # LIVQTR_MULTI = 1) Yes, 0) No
+        # 4) Apartment building, 2 units
+        # 5) Apartment building, 3-4 units
+        # 6) Apartment building, 5+ units
+        {'source': 'LIVQTRRV', 'target': 'LIVQTR_MULTI',
+         'mapping': {1: 0, 2: 0, 3: 0, 4: 1, 5: 1, 6: 1, 7: 0},
+         'name': 'Dwelling type: Multi-family', 'type': 'Nominal',
+         'labels': {0: 'No', 1: 'Yes'}},
+        # Create new variables for return from ND_HOWLONG
+        # 1) Less than a week
+        # 2) Less than a month
+        # 3) One to six months
+        # 4) More than six months
+        # 5) Never returned
+        # RETURNED --> 1: Did not return; 0: Returned
+        {'source': 'ND_HOWLONG', 'target': 'RETURNED',
+         'mapping': {1: 0, 2: 0, 3: 0, 4: 0, 5: 1},
+         'name': 'Returned', 'type': 'Nominal',
+         'labels': {0: 'Returned', 1: 'Did not return'}},
+        # PROTRACTED --> 1: Protracted displacement; 0: Returned within 6 months
+        {'source': 'ND_HOWLONG', 'target': 'PROTRACTED',
+         'mapping': {1: 0, 2: 0, 3: 0, 4: 1, 5: 1},
+         'name': 'Protracted displacement', 'type': 'Nominal',
+         'labels': {0: 'Not protracted', 1: 'Protracted'}},
+        # RECOVERY --> 1: Displacement > 1 month; 0: Displacement < 1 month or no return
+        {'source': 'ND_HOWLONG', 'target': 'RECOVERY',
+         'mapping': {1: 0, 2: 0, 3: 1, 4: 1, 5: 0},
+         'name': 'Recovery phase displacement', 'type': 'Nominal',
+         'labels': {0: 'Recovery phase', 1: 'Emergency phase or no return'}},
+        # PHASE --> 0: Emergency phase displacement; 1: Recovery phase or no return
+        {'source': 'ND_HOWLONG', 'target': 'PHASE',
+         'mapping': {1: 0, 2: 0, 3: 1, 4: 1, 5: 1},
+         'name': 'Displacement phase', 'type': 'Nominal',
+         'labels': {0: 'Emergency phase', 1: 'Recovery phase or no return'}},
+        # PHASE_RETURN --> 0: Emergency phase displacement; 1: Recovery phase displacement, 2: Never returned
+        {'source': 'ND_HOWLONG', 'target': 'PHASE_RETURN',
+         'mapping': {1: 0, 2: 0, 3: 1, 4: 1, 5: 2},
+         'name': 'Displacement phase', 'type': 'Nominal',
+         'labels': {0: 'Emergency phase', 1: 'Recovery phase', 2: 'Not returned'}},
+    ]
+    # Create columns for return time windows
+    # RETURN_{i} --> 1: Returned within window i of ND_HOWLONG; 0: Did not
+    nd_howlong = range(1, 6)
+    nd_dummy = range(1, 4) # 1, 2, 3
+    for i in nd_dummy:
+        window = data_dict.labels('ND_HOWLONG')[i].lower()
+        recodes.append(
+            {'source': 'ND_HOWLONG', 'target': f'RETURN_{i}',
+             'mapping': {j: 1 if j <= i else 0 for j in nd_howlong},
+             'name': f'Returned within {window}', 'type': 'Nominal',
+             'labels': {0: 'Did not', 1: f'Returned within {window}'}}
+        )
+    return recodes
+
+
+def get_hazard_type(df):
     # Define HAZARD_TYPE
     # ND_TYPE{i}:
     # 1) Hurricane
@@ -108,31 +424,21 @@ def get_hazard_type(df, data_dict):
         5: 'Other',
         6: 'Multiple'
     }
-    # Gather hazard types
-    idx = df.ND_DISPLACE == 1
-    df[new_col] = float('nan')
-    def get_disaster_type(row):    
-        result = row[row == 1].index.tolist()
-        if len(result) == 0:
-            out = float('nan')
-        elif len(result) == 1:
-            out = int(result[0][-1])
-        else:
-            out = 6
-        return out
-    values = df[idx][ref_cols].apply(get_disaster_type, axis=1)
-    df.loc[idx, new_col] = values.values
-    # Update data dictionary
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = "Hazard type"
-        new_row.at[new_col, 'Conversion'] = nd_conv
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def normalize_income(df, data_dict):
+    # Gather hazard types as a bitmask of the selected ND_TYPE{i}
+    idx = (df.ND_DISPLACE == 1).to_numpy()
+    selected = df[ref_cols].to_numpy() == 1
+    bitmask = selected.astype(np.int64) @ (1 << np.arange(ntype))
+    # Look up hazard type from bitmask: none, exactly one, or multiple types
+    lookup = np.full(1 << ntype, 6, dtype=float)
+    lookup[0] = float('nan')
+    lookup[1 << np.arange(ntype)] = np.arange(1, ntype+1)
+    df[new_col] = np.where(idx, lookup[bitmask], float('nan'))
+    # Arrange data dictionary entry
+    entry = {'target': new_col, 'name': 'Hazard type', 'type': 'Nominal', 'labels': nd_conv}
+    return df, entry
+
+
+def normalize_income(df):
     # Normalize INCOME by THHLD_NUMPER
     # 1) Less than $25,000  
     # 2) \$25,000 - $34,999  
@@ -155,388 +461,68 @@ def normalize_income(df, data_dict):
         7: 200000,
         8: 300000,
     }
-    # Select bins for new column
-    rebin = [0, 10000, 20000, 30000, 50000, 100000, 150000, 1e16]
-    n_bin = len(rebin)-1
+    # Select bins for new column, i.e. [lower, upper)
+    rebin = [0, 10000, 20000, 30000, 50000, 100000, 150000, float('inf')]
     # Calculate values
-    df[new_col] = df[numerator].replace(income_mid) / df[denominator]
-    # Initialize conversion dictionary
-    rebin_conv = dict.fromkeys(range(1, n_bin+1))
-    for i in range(n_bin):
-        # Get lower and upper bound
-        lower, upper = rebin[i], rebin[i+1]-1
-        # Arrange conversion dictionary
-        if i == 0:
-            rebin_conv[i+1] = f"Less than \${(upper+1):,.0f}"
-        elif i == n_bin-1:
-            rebin_conv[i+1] = f"\${lower:,.0f} and above"
-        else:
-            rebin_conv[i+1] = f"\${lower:,.0f} - \${upper:,.0f}"
-        # Determine bins
-        idx = (df[new_col] >= lower) & (df[new_col] < upper)
-        df.loc[idx, new_col] = i+1
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Ordinal'
-        new_row.loc[new_col, 'Name'] = 'Income per household member'
-        new_row.at[new_col, 'Conversion'] = rebin_conv
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def rebin_race(df, data_dict):
-    # Rebin RRACE
-    # RACIAL_MINORITY = 1) No
-    # 1) White
-    # RACIAL_MINORITY = 2) Yes
-    # 2) Black
-    # 3) Asian
-    # 4) Other/Mixed
-    ref_col = "RRACE"
-    new_col = "RMINORITY"
-    rebin_map = {1: 1, 2: 2, 3: 2, 4: 2}
-    rebin_conversion = {1: 'No', 2: 'Yes'}
-    rebin_name = "Racial minority"
-    df[new_col] = df[ref_col].replace(rebin_map)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = rebin_name
-        new_row.at[new_col, 'Conversion'] = rebin_conversion
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def rebin_school_enroll(df, data_dict):
-    # Rebin SCHOOLENROLL
-    # 1) None
-    # 2) Public school
-    # 3) Private school
-    # 4) Public and private
-    # Based on TENROLLPUB, TENROLLPRV
-    new_col = "SCHOOLENROLL"
-    idx_pub = df['TENROLLPUB'] > 0
-    idx_prv = df['TENROLLPRV'] > 0
-    df[new_col] = float('nan')
-    df.loc[(~idx_pub)&(~idx_prv), new_col] = 1
-    df.loc[(idx_pub)&(~idx_prv), new_col] = 2
-    df.loc[(~idx_pub)&(idx_prv), new_col] = 3
-    df.loc[(idx_pub)&(idx_prv), new_col] = 4
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = "School enrollment"
-        new_row.at[new_col, 'Conversion'] = {1: 'None',
-                                              2: 'Public school',
-                                              3: 'Private school',
-                                              4: 'Public and private'}
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def rebin_tenure_column(df, data_dict):
-    # Rebin TENURE
-    # TENURE_STATUS = 1) Owned
-    # 1) Owned, free and clear
-    # 2) Owned, with loan/mortgage
-    # TENURE_STATUS = 2) Rented
-    # 3) Rented
-    # TENURE_STATUS = 3) Occupied without payment
-    # 4) Occupied without payment
-    ref_col = "TENURE"
-    new_col = "TENURE_STATUS"
-    rebin_map = {1: 1, 2: 1, 3: 2, 4: 3}
-    rebin_conversion = {1: 'Owned', 2: 'Rented', 3: 'Occupied without payment'}
-    rebin_name = "Tenure status"
-    df[new_col] = df[ref_col].replace(rebin_map)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = rebin_name
-        new_row.at[new_col, 'Conversion'] = rebin_conversion
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def rebin_livqtr_column(df, data_dict):
-    # Rebin LIVQTRRV
-    # LIVQTR_REBIN = 1) Single-family
-    # 2) Detached single-family
-    # 3) Attached single-family
-    # LIVQTR_REBIN = 2) Multi-family
-    # 4) Apartment building, 2 units
-    # 5) Apartment building, 3-4 units
-    # 6) Apartment building, 5+ units
-    # LIVQTR_REBIN = 3) Mobile home
-    # 1) A mobile home
-    # LIVQTR_REBIN = 4) Other
-    # 7) Boat, RV, van, etc
-    ref_col = "LIVQTRRV"
-    new_col = "DWELLTYPE"
-    rebin_map = {1: 3, 2: 1, 3: 1, 4: 2, 5: 2, 6: 2, 7: 4}
-    rebin_conversion = {1: 'Single-family', 2: 'Multi-family', 3: 'Mobile home', 4: 'Other (boat, RV, van, etc.)'}
-    rebin_name = "Dwelling type"
-    df[new_col] = df[ref_col].replace(rebin_map)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = rebin_name
-        new_row.at[new_col, 'Conversion'] = rebin_conversion
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_livqtr_columns(df, data_dict):
-    # Transform LIVQTRRV into dummy variables
-    # LIVQTR_MOBILE = 1) Yes, 0) No
-    # 1) A mobile home
-    # LIVQTR_OTHER = 1) Yes, 0) No
-    # 7) Boat, RV, van, etc
-    # LIVQTR_SINGLE = 1) Yes, 0) No
-    # 2) Detached single-family
-    # 3) Attached single-family
-    # LIVQTR_MULTI = 1) Yes, 0) No
-    # 4) Apartment building, 2 units
-    # 5) Apartment building, 3-4 units
-    # 6) Apartment building, 5+ units
-    ref_col = "LIVQTRRV"
-    dummy_map = {
-        "LIVQTR_OTHER":  {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 1},
-        "LIVQTR_MOBILE":  {1: 1, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0},
-        "LIVQTR_SINGLE": {1: 0, 2: 1, 3: 1, 4: 0, 5: 0, 6: 0, 7: 0},
-        "LIVQTR_MULTI":  {1: 0, 2: 0, 3: 0, 4: 1, 5: 1, 6: 1, 7: 0},
-    }
-    dummy_name = {
-        "LIVQTR_OTHER":  "Dwelling type: Boat, RV, van, etc.",
-        "LIVQTR_MOBILE":  "Dwelling type: Mobile home",
-        "LIVQTR_SINGLE": "Dwelling type: Single-family",
-        "LIVQTR_MULTI":  "Dwelling type: Multi-family",
-    }
-    for dummy_col in dummy_map:
-        df[dummy_col] = df[ref_col].replace(dummy_map[dummy_col])
-        if dummy_col not in data_dict.index:
-            new_row = pd.DataFrame(index=[dummy_col], columns=data_dict.columns)
-            new_row.loc[dummy_col, 'Type'] = 'Nominal'
-            new_row.loc[dummy_col, 'Name'] = dummy_name[dummy_col]
-            new_row.at[dummy_col, 'Conversion'] = {0: 'No', 1: 'Yes'}
-            data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_return_window_columns(df, data_dict):
-    # ND_HOWLONG
-    # 1) Less than a week
-    # 2) Less than a month
-    # 3) One to six months
-    # 4) More than six months
-    # 5) Never returned
-    nd_howlong = range(1,6)
-    nd_dummy = range(1,4) # 1, 2, 3
-    for i in nd_dummy:
-        new_col = f"RETURN_{i}"
-        map_dict = {j: 1 if j <= i else 0 for j in nd_howlong}
-        df[new_col] = df["ND_HOWLONG"].replace(map_dict)
-        if new_col not in data_dict.index:
-            window = data_dict.loc['ND_HOWLONG', 'Conversion'][i]
-            new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-            new_row.loc[new_col, 'Type'] = 'Nominal'
-            new_row.loc[new_col, 'Name'] = f'Returned within {window.lower()}'
-            new_row.at[new_col, 'Conversion'] = {0: 'Did not', 1: f'Returned within {window.lower()}'}
-            data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_returned_column(df, data_dict):
-    # Create new variable for return from ND_HOWLONG
-    # 1) Less than a week
-    # 2) Less than a month
-    # 3) One to six months
-    # 4) More than six months
-    # 5) Never returned
-    # RETURN --> 1: Did not return; 0: Returned
-    new_col = "RETURNED"
-    map_dict = {1: 0, 2: 0, 3: 0, 4: 0, 5: 1}
-    df[new_col] = df["ND_HOWLONG"].replace(map_dict)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = 'Returned'
-        new_row.at[new_col, 'Conversion'] = {0: 'Returned', 1: 'Did not return'}
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_protracted_column(df, data_dict):
-    # Create new variable for return from ND_HOWLONG
-    # 1) Less than a week
-    # 2) Less than a month
-    # 3) One to six months
-    # 4) More than six months
-    # 5) Never returned
-    # PROTRACTED --> 1: Protracted displacement; 0: Returned within 6 months
-    new_col = "PROTRACTED"
-    map_dict = {1: 0, 2: 0, 3: 0, 4: 1, 5: 1}
-    df[new_col] = df["ND_HOWLONG"].replace(map_dict)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = 'Protracted displacement'
-        new_row.at[new_col, 'Conversion'] = {0: 'Not protracted', 1: 'Protracted'}
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_recovery_column(df, data_dict):
-    # Create new variable for return from ND_HOWLONG
-    # 1) Less than a week
-    # 2) Less than a month
-    # 3) One to six months
-    # 4) More than six months
-    # 5) Never returned
-    # RECOVERY --> 1: Displacement > 1 month; 0: Displacement < 1 month or no return
-    new_col = "RECOVERY"
-    map_dict = {1: 0, 2: 0, 3: 1, 4: 1, 5: 0}
-    df[new_col] = df["ND_HOWLONG"].replace(map_dict)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = 'Recovery phase displacement'
-        new_row.at[new_col, 'Conversion'] = {0: 'Recovery phase', 1: 'Emergency phase or no return'}
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_phase_column(df, data_dict):
-    # Create new variable for emergency displacement from ND_HOWLONG
-    # 1) Less than a week
-    # 2) Less than a month
-    # 3) One to six months
-    # 4) More than six months
-    # 5) Never returned
-    # PROTRACTED --> 0: Emergency phase displacement; 1: Recovery phase or no return
-    new_col = "PHASE"
-    map_dict = {1: 0, 2: 0, 3: 1, 4: 1, 5: 1}
-    df[new_col] = df["ND_HOWLONG"].replace(map_dict)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = 'Displacement phase'
-        new_row.at[new_col, 'Conversion'] = {0: 'Emergency phase', 1: 'Recovery phase or no return'}
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def append_phase_return_column(df, data_dict):
-    # Create new variable for emergency displacement from ND_HOWLONG
-    # 1) Less than a week
-    # 2) Less than a month
-    # 3) One to six months
-    # 4) More than six months
-    # 5) Never returned
-    # PROTRACTED --> 0: Emergency phase displacement; 1: Recovery phase displacement, 2: Never returned
-    new_col = "PHASE_RETURN"
-    map_dict = {1: 0, 2: 0, 3: 1, 4: 1, 5: 2}
-    df[new_col] = df["ND_HOWLONG"].replace(map_dict)
-    if new_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[new_col], columns=data_dict.columns)
-        new_row.loc[new_col, 'Type'] = 'Nominal'
-        new_row.loc[new_col, 'Name'] = 'Displacement phase'
-        new_row.at[new_col, 'Conversion'] = {0: 'Emergency phase', 1: 'Recovery phase', 2: 'Not returned'}
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    return df, data_dict
-
-
-def convert_birth_year_to_age_bin(df, data_dict):
+    income_per = df[numerator].replace(income_mid) / df[denominator]
+    # Determine bins
+    codes = get_bin_codes(income_per, rebin, right=False, start=1)
+    df[new_col] = np.where(codes != MISSING_CODE, codes, float('nan'))
+    # Arrange conversion dictionary
+    rebin_conv = get_bin_labels(rebin, fmt="\\${lo:,.0f} - \\${hi:,.0f}", first="Less than \\${upper:,.0f}",
+                                last="\\${lo:,.0f} and above", right=False, step=1, start=1)
+    # Arrange data dictionary entry
+    entry = {'target': new_col, 'name': 'Income per household member', 'type': 'Ordinal',
+             'labels': rebin_conv}
+    return df, entry
+
+
+def convert_birth_year_to_age_bin(df):
     # Survey baseline year
     survey_year = 2022
-    # Determine bins
+    # Determine bins, i.e. (lower, upper]
     age_bins = [0, 24, 34, 44, 54, 64, 74, 1000]
-    # Determine index of bins
-    n_bins = len(age_bins) - 1
-    age_idx = range(n_bins)
     # Create friendly strings for bins
-    age_strs = [f'{age_bins[i]+1} - {age_bins[i+1]}' for i in range(n_bins)]
-    age_strs[0] = f'{age_bins[1]} or less'
-    age_strs[-1] = f'{age_bins[-2]+1}+'
-    conversion = {age_idx[i]: age_strs[i] for i in range(n_bins)}
+    conversion = get_bin_labels(age_bins, first='{hi} or less', last='{lo}+', step=1)
     # Add new column for age bins
     age_col = 'AGE_BIN'
     birthyear_col = 'TBIRTH_YEAR'
-    df[age_col] = survey_year - df[birthyear_col].astype(int)
-    for i in range(n_bins):
-        idx = (df[age_col] > age_bins[i]) & (df[age_col] <= age_bins[i+1])
-        df.loc[idx, age_col] = age_idx[i]
-    # Adjust data dictionary
-    if age_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[age_col], columns=data_dict.columns)
-        new_row.loc[age_col, 'Type'] = 'Ordinal'
-        new_row.loc[age_col, 'Name'] = 'Age'
-        new_row.at[age_col, 'Conversion'] = conversion
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    else:
-        data_dict.at[age_col, 'Conversion'] = conversion
+    codes = get_bin_codes(survey_year - df[birthyear_col], age_bins)
+    df[age_col] = np.where(codes != MISSING_CODE, codes, float('nan'))
+    # Arrange data dictionary entry
+    entry = {'target': age_col, 'name': 'Age', 'type': 'Ordinal', 'labels': conversion}
     # Return result
-    return df, data_dict
+    return df, entry
 
 
-def convert_hh_size_to_bin(df, data_dict):
-    # Determine bins
+def convert_hh_size_to_bin(df):
+    # Determine bins, i.e. (lower, upper]
     hh_bins = [0, 1, 2, 4, 7, 1000]
-    # Determine index of bins
-    n_bins = len(hh_bins) - 1
-    hh_idx = range(n_bins)
     # Create friendly strings for bins
-    hh_strs = [f'{hh_bins[i]+1} - {hh_bins[i+1]}' for i in range(n_bins)]
-    hh_strs[0] = '1'
-    hh_strs[1] = '2'
-    hh_strs[-1] = f'{hh_bins[-2]+1}+'
-    conversion = {hh_idx[i]: hh_strs[i] for i in range(n_bins)}
-    # Add new column for age bins
+    conversion = get_bin_labels(hh_bins, single='{hi}', last='{lo}+', step=1)
+    # Add new column for household size bins
     hh_bin_col = 'HH_BIN'
     hh_col = 'THHLD_NUMPER'
-    df[hh_bin_col] = float('nan')
-    for i in range(n_bins):
-        idx = (df[hh_col] > hh_bins[i]) & (df[hh_col] <= hh_bins[i+1])
-        df.loc[idx, hh_bin_col] = hh_idx[i]
-    # Adjust data dictionary
-    if hh_bin_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[hh_bin_col], columns=data_dict.columns)
-        new_row.loc[hh_bin_col, 'Type'] = 'Ordinal'
-        new_row.loc[hh_bin_col, 'Name'] = 'Household size'
-        new_row.at[hh_bin_col, 'Conversion'] = conversion
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    else:
-        data_dict.at[hh_bin_col]['Conversion'] = conversion
+    codes = get_bin_codes(df[hh_col], hh_bins)
+    df[hh_bin_col] = np.where(codes != MISSING_CODE, codes, float('nan'))
+    # Arrange data dictionary entry
+    entry = {'target': hh_bin_col, 'name': 'Household size', 'type': 'Ordinal', 'labels': conversion}
     # Return result
-    return df, data_dict
+    return df, entry
 
 
-def convert_rent_to_bin(df, data_dict):
-    # Determine bins
+def convert_rent_to_bin(df):
+    # Determine bins, i.e. (lower, upper]
     rent_bins = [0, 400, 800, 1200, 2000, 10000]
-    # Determine index of bins
-    n_bins = len(rent_bins) - 1
-    rent_idx = range(n_bins)
     # Create friendly strings for bins
-    rent_strs = [f'\${rent_bins[i]:,.0f} - \${rent_bins[i+1]:,.0f}' for i in range(n_bins)]
-    rent_strs[0] = f'Less than \${rent_bins[2]:,.0f}'
-    rent_strs[-1] = f'\${rent_bins[-2]:,.0f} or more'
-    conversion = {rent_idx[i]: rent_strs[i] for i in range(n_bins)}
-    # Add new column for age bins
+    conversion = get_bin_labels(rent_bins, fmt='\\${lo:,.0f} - \\${hi:,.0f}', first='Less than \\${upper:,.0f}',
+                                last='\\${lo:,.0f} or more')
+    # Add new column for rent bins
     rent_bin_col = 'RENT_BIN'
     rent_col = 'TRENTAMT'
-    df[rent_bin_col] = float('nan')
-    for i in range(n_bins):
-        idx = (df[rent_col] > rent_bins[i]) & (df[rent_col] <= rent_bins[i+1])
-        df.loc[idx, rent_bin_col] = rent_idx[i]
-    # Adjust data dictionary
-    if rent_bin_col not in data_dict.index:
-        new_row = pd.DataFrame(index=[rent_bin_col], columns=data_dict.columns)
-        new_row.loc[rent_bin_col, 'Type'] = 'Ordinal'
-        new_row.loc[rent_bin_col, 'Name'] = 'Rent (per month)'
-        new_row.at[rent_bin_col, 'Conversion'] = conversion
-        data_dict = pd.concat([data_dict, new_row], axis=0)
-    else:
-        data_dict.loc[rent_bin_col]['Conversion'] = conversion
+    codes = get_bin_codes(df[rent_col], rent_bins)
+    df[rent_bin_col] = np.where(codes != MISSING_CODE, codes, float('nan'))
+    # Arrange data dictionary entry
+    entry = {'target': rent_bin_col, 'name': 'Rent (per month)', 'type': 'Ordinal', 'labels': conversion}
     # Return result
-    return df, data_dict
\ No newline at end of file
+    return df, entry
@@ -0,0 +1,203 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Unknown/unreported survey responses
+BAD_VALUES = [-88, -99]
+
+# Code for missing, unknown or out-of-range values
+MISSING_CODE = -1
+
+
+def is_replicate_weight(col):
+    """Whether a column holds household replicate weights, e.g. HWEIGHT12"""
+    return re.fullmatch(r"HWEIGHT\d+", col) is not None
+
+
+def compile_recodes(recodes):
+    """Compiles recode specifications into integer lookup tables, with one
+    table per source so that every target derived from the same source is
+    gathered in a single pass
+
+    Args:
+        recodes (list): Recode specifications, each a dict with 'source'
+            (column name, or callable returning codes from the DataFrame),
+            'target', 'mapping', 'name', 'type' and 'labels'
+
+    Returns:
+        compiled (list): Tuples of (source, targets, offset, table), where
+            table[j, code-offset] is the value of targets[j]; codes missing
+            from a mapping map to themselves and the last column holds NaN
+    """
+
+    # Group recodes by source, keeping the order of first appearance
+    groups = {}
+    for recode in recodes:
+        groups.setdefault(recode['source'], []).append(recode)
+
+    # Arrange lookup tables
+    compiled = []
+    for source, group in groups.items():
+        keys = [key for recode in group for key in recode['mapping']]
+        offset = min(keys)
+        n_codes = max(keys) - offset + 1
+        table = np.empty((len(group), n_codes+1))
+        table[:, :n_codes] = np.arange(offset, offset+n_codes)
+        table[:, n_codes] = np.nan
+        for j, recode in enumerate(group):
+            for key, value in recode['mapping'].items():
+                table[j, key-offset] = value
+        targets = [recode['target'] for recode in group]
+        compiled.append((source, targets, offset, table))
+    return compiled
+
+
+def apply_recodes(df, recodes):
+    """Applies recode specifications to a DataFrame. Values without an entry
+    in a mapping (e.g., NaN) are carried over unchanged, as with
+    pd.Series.replace
+
+    Args:
+        df (pd.DataFrame): Data to recode
+        recodes (list): Recode specifications (see compile_recodes)
+
+    Returns:
+        df (pd.DataFrame): Data with the target columns added
+    """
+    recoded_cols = {}
+    for source, targets, offset, table in compile_recodes(recodes):
+        # Convert source values to indices of the lookup table; NaN and
+        # values outside the table point to the last (NaN) column
+        values = source(df) if callable(source) else df[source]
+        values = values.to_numpy(dtype=float)
+        n_codes = table.shape[1] - 1
+        codes = values - offset
+        valid = (codes >= 0) & (codes < n_codes) & (codes == np.floor(codes))
+        codes = np.where(valid, codes, n_codes).astype(np.intp)
+        # Gather all targets at once
+        recoded = np.take(table, codes, axis=1)
+        # Carry over values outside the table, e.g. unknown codes
+        carry = ~valid & ~np.isnan(values)
+        if carry.any():
+            recoded[:, carry] = values[carry]
+        for j, target in enumerate(targets):
+            recoded_cols[target] = recoded[j]
+
+    # Add columns in the order of the specifications
+    for recode in recodes:
+        df[recode['target']] = recoded_cols[recode['target']]
+    return df
+
+
+def get_bin_codes(values, edges, right=True, start=0):
+    """Assigns values to bins with a single binary search over sorted edges
+
+    Args:
+        values (array-like): Values to bin
+        edges (list): Sorted bin edges
+        right (bool): Whether bins are closed on the right, i.e. (lo, hi],
+            or on the left, i.e. [lo, hi)
+        start (int): Code of the first bin
+
+    Returns:
+        codes (np.ndarray): Bin codes, with MISSING_CODE for NaN and for
+            values outside the edges
+    """
+    values = np.asarray(values, dtype=float)
+    n_bins = len(edges) - 1
+    codes = np.searchsorted(edges, values, side='left' if right else 'right') - 1
+    codes = np.where((codes >= 0) & (codes < n_bins), codes + start, MISSING_CODE)
+    return codes.astype(np.int8)
+
+
+def get_bin_labels(edges, fmt='{lo} - {hi}', first=None, last=None, single=None,
+                   right=True, step=0, start=0):
+    """Creates friendly strings for the bins defined by get_bin_codes
+
+    Args:
+        edges (list): Sorted bin edges
+        fmt (str): Template for each bin, formatted with the displayed bounds
+            'lo' and 'hi' and the raw edges 'lower' and 'upper'
+        first (str): Template for the first bin, if different
+        last (str): Template for the last bin, if different
+        single (str): Template for bins where 'lo' equals 'hi', if different
+        right (bool): Whether bins are closed on the right
+        step (int): Resolution of the values; the open bound of each bin is
+            moved by this amount so that displayed bounds are inclusive
+        start (int): Code of the first bin
+
+    Returns:
+        labels (dict): Bin code to friendly string
+    """
+    n_bins = len(edges) - 1
+    labels = {}
+    for i in range(n_bins):
+        lower, upper = edges[i], edges[i+1]
+        lo, hi = (lower + step, upper) if right else (lower, upper - step)
+        if i == 0 and first is not None:
+            template = first
+        elif i == n_bins - 1 and last is not None:
+            template = last
+        elif lo == hi and single is not None:
+            template = single
+        else:
+            template = fmt
+        labels[i+start] = template.format(lo=lo, hi=hi, lower=lower, upper=upper)
+    return labels
+
+
+def downcast_float(values):
+    """Casts float values to float32 if every value (including NaN) survives
+    the round trip, and keeps them unchanged otherwise
+
+    Args:
+        values (pd.Series or np.ndarray): Float values
+
+    Returns:
+        values (pd.Series or np.ndarray): float32 or original values
+    """
+    as_float32 = values.astype(np.float32)
+    if np.array_equal(np.asarray(as_float32), np.asarray(values), equal_nan=True):
+        return as_float32
+    return values
+
+
+def compact_columns(df, data_dict):
+    """Stores the household table compactly: coded (nominal/ordinal) columns
+    as the smallest integer type with MISSING_CODE for NaN and -88/-99,
+    other numeric columns from the data dictionary and replicate weights as
+    float32 where every value survives the round trip (see downcast_float),
+    and the household identifier as a categorical
+
+    Args:
+        df (pd.DataFrame): Household data
+        data_dict (DataDictionary): Data dictionary
+
+    Returns:
+        df (pd.DataFrame): Compacted household data
+    """
+    for col in df.columns:
+        if col == 'SCRAM':
+            df[col] = df[col].astype('category')
+            continue
+        if is_replicate_weight(col):
+            df[col] = downcast_float(df[col].astype(float, copy=False))
+            continue
+        if col not in data_dict or not pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        values = df[col].to_numpy(dtype=float)
+        if data_dict.type(col) in ['Nominal', 'Ordinal']:
+            # Coded columns must hold whole numbers to be compacted
+            missing = np.isnan(values) | np.isin(values, BAD_VALUES)
+            codes = values[~missing]
+            if not np.array_equal(codes, np.floor(codes)):
+                continue
+            limit = max(np.abs(codes).max(initial=0), abs(MISSING_CODE))
+            dtype = next((dtype for dtype in [np.int8, np.int16, np.int32] if limit <= np.iinfo(dtype).max),
+                         np.int64)
+            df[col] = np.where(missing, MISSING_CODE, values).astype(dtype)
+        else:
+            # Household weights, counts and amounts are only stored as float32
+            # if no precision is lost
+            df[col] = downcast_float(values)
+    return df
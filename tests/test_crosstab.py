@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from parsers.parse_data_dictionary import DataDictionary, Variable
+from util.data import RMV_VALUES, create_crosstab, get_joint_index, weighted_crosstab
+
+n_households = 5003
+
+
+def make_households(seed=0):
+    # Coded factors with unknown/unreported values, in the dtypes of the
+    # compacted household data
+    rng = np.random.default_rng(seed)
+    bad = rng.random(n_households) < 0.05
+    return pd.DataFrame({
+        'ND_HOWLONG': np.where(bad, -99, rng.integers(1, 6, n_households)).astype(np.int8),
+        'TENURE': rng.choice([1, 2, 3, 4, -88, -99], n_households, p=[0.3, 0.3, 0.2, 0.1, 0.05, 0.05]).astype(np.int8),
+        'INCOME': np.where(rng.random(n_households) < 0.05, np.nan, rng.integers(1, 9, n_households)),
+        'SPARSE': rng.choice([1, 5, 9, -1], n_households).astype(np.int16),
+        'WIDE': rng.integers(0, 250, n_households).astype(np.int16),
+        'HWEIGHT': rng.lognormal(np.log(1500), 0.8, n_households),
+    })
+
+
+def make_data_dict(data):
+    # Labels for some of the codes; unlabelled codes keep their code
+    variables = []
+    for col in data.columns.drop('HWEIGHT'):
+        labels = {code: f"{col} {code}" for code in range(1, 4)}
+        variables.append(Variable(col, f"Name of {col}", 'Nominal', labels))
+    return DataDictionary(variables)
+
+
+def get_crosstab_reference(data, data_dict, main_factor, curr_factor, weights="HWEIGHT", samples=False):
+    # Previous implementation of create_crosstab, with pd.crosstab
+    df = data[~data[[main_factor, curr_factor]].isin(RMV_VALUES).any(axis=1)]
+    df = df.dropna(subset=[main_factor, curr_factor]).astype({main_factor: int, curr_factor: int})
+    crosst = pd.crosstab(index=df[curr_factor], columns=df[main_factor], values=df[weights], aggfunc="sum",
+                         normalize="index")
+    main_map, curr_map = data_dict.labels(main_factor), data_dict.labels(curr_factor)
+    index = [curr_map.get(key, key) for key in crosst.index]
+    if samples:
+        sample_sizes = df.groupby(curr_factor)[weights].count()
+        index = [f"{label}\n(n={N:,.0f})" for label, N in zip(index, sample_sizes.loc[crosst.index])]
+    crosst.index = pd.Index(index, name=data_dict.name(curr_factor))
+    crosst.columns = pd.Index([main_map.get(key, key) for key in crosst.columns], name=data_dict.name(main_factor))
+    return crosst
+
+
+factor_pairs = [
+    ('ND_HOWLONG', 'TENURE'),
+    ('ND_HOWLONG', 'INCOME'),
+    ('TENURE', 'INCOME'),
+    ('INCOME', 'SPARSE'),
+    ('WIDE', 'TENURE'),
+    ('WIDE', 'WIDE'),
+]
+
+
+@pytest.mark.parametrize("main_factor, curr_factor", factor_pairs)
+@pytest.mark.parametrize("samples", [False, True])
+def test_crosstab_matches_pandas(main_factor, curr_factor, samples):
+    data = make_households()
+    data_dict = make_data_dict(data)
+    crosst = create_crosstab(data, data_dict, main_factor, curr_factor, samples=samples)
+    expected = get_crosstab_reference(data, data_dict, main_factor, curr_factor, samples=samples)
+    pd.testing.assert_frame_equal(crosst, expected, check_index_type=False, check_column_type=False)
+
+
+@pytest.mark.parametrize("main_factor, curr_factor", factor_pairs)
+def test_crosstab_with_mask_matches_pandas(main_factor, curr_factor):
+    data = make_households()
+    data_dict = make_data_dict(data)
+    mask = data['TENURE'].isin([1, 2]).to_numpy() & (np.arange(len(data)) % 3 > 0)
+    crosst = create_crosstab(data, data_dict, main_factor, curr_factor, samples=True, mask=mask)
+    expected = get_crosstab_reference(data[mask], data_dict, main_factor, curr_factor, samples=True)
+    pd.testing.assert_frame_equal(crosst, expected, check_index_type=False, check_column_type=False)
+
+
+@pytest.mark.parametrize("row_range, col_range, dtype", [
+    ((0, 99), (-50, 120), np.int8),
+    ((0, 99), (-50, 200), np.int16),
+    ((0, 253), (0, 127), np.int16),
+    ((0, 254), (0, 127), np.int16),
+    ((-99, 180), (-99, 180), np.int16),
+    ((0, 200), (0, 200), np.int16),
+    ((-99, 30000), (-99, 5), np.int16),
+])
+def test_joint_index_matches_int64(row_range, col_range, dtype):
+    # Tables on either side of the 16-bit bound of the joint index, with
+    # negative codes
+    rng = np.random.default_rng(1)
+    row_codes = rng.integers(row_range[0], row_range[1] + 1, 999)
+    col_codes = rng.integers(col_range[0], col_range[1] + 1, 999)
+    row_codes[:2], col_codes[:2] = row_range, col_range
+    joint, row_min, col_min, n_rows, n_cols = get_joint_index(row_codes.astype(dtype), col_codes.astype(dtype), None)
+    expected = (row_codes.astype(np.int64) - row_range[0]) * n_cols + (col_codes - col_range[0])
+    np.testing.assert_array_equal(joint, expected)
+    assert (row_min, col_min) == (row_range[0], col_range[0])
+    assert (n_rows, n_cols) == (row_range[1] - row_range[0] + 1, col_range[1] - col_range[0] + 1)
+
+
+def test_joint_index_spill_cell():
+    row_codes = np.array([1, 2, 3, -99, 2], dtype=np.int8)
+    col_codes = np.array([4, 5, -88, 4, 6], dtype=np.int8)
+    valid = (row_codes > 0) & (col_codes > 0)
+    joint, _, _, n_rows, n_cols = get_joint_index(row_codes, col_codes, valid)
+    np.testing.assert_array_equal(joint[~valid], n_rows * n_cols)
+    assert (joint[valid] < n_rows * n_cols).all()
+
+
+def test_crosstab_excludes_spill_cell():
+    rng = np.random.default_rng(2)
+    row_codes = rng.choice([1, 2, 3, -99], 1000).astype(np.int8)
+    col_codes = rng.choice([1, 2, -88], 1000).astype(np.int8)
+    weights = rng.random(1000)
+    valid = (row_codes > 0) & (col_codes > 0)
+    sums, counts, row_keys, col_keys = weighted_crosstab(row_codes, col_codes, weights, valid)
+    assert counts.sum() == valid.sum()
+    assert np.isclose(sums.sum(), weights[valid].sum())
+    np.testing.assert_array_equal(row_keys, [1, 2, 3])
+    np.testing.assert_array_equal(col_keys, [1, 2])
+
+
+def test_crosstab_drops_unobserved_codes():
+    # Codes 2-4 never occur, and code 7 only occurs in excluded rows
+    row_codes = np.array([1, 5, 5, 1, 7, 1])
+    col_codes = np.array([10, 10, 30, 30, -99, 20])
+    weights = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    sums, counts, row_keys, col_keys = weighted_crosstab(row_codes, col_codes, weights, col_codes > 0)
+    np.testing.assert_array_equal(row_keys, [1, 5])
+    np.testing.assert_array_equal(col_keys, [10, 20, 30])
+    np.testing.assert_array_equal(sums, [[1.0, 6.0, 4.0], [2.0, 0.0, 3.0]])
+    np.testing.assert_array_equal(counts, [[1, 1, 1], [1, 0, 1]])
+
+
+def test_crosstab_without_households():
+    row_codes = np.array([1, 2], dtype=np.int8)
+    sums, counts, row_keys, col_keys = weighted_crosstab(row_codes, row_codes, np.ones(2), np.zeros(2, dtype=bool))
+    assert sums.shape == counts.shape == (0, 0)
+    assert len(row_keys) == len(col_keys) == 0
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from parsers.parse_data_dictionary import DataDictionary, Variable
+from util.cube import (build_crosstab_cube, build_crosstab_sums, build_weighted_cube, combine_crosstab_sums,
+                       get_cube_crosstab)
+from util.data import create_crosstab, create_crosstab_stderr
+
+n_households = 4001
+n_replicates = 8
+
+
+def make_households(seed=0):
+    # Coded factors with unknown/unreported values (except HAZARD_TYPE),
+    # with replicate weights
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'ND_HOWLONG': rng.choice([1, 2, 3, 4, 5, -99], n_households).astype(np.int8),
+        'TENURE': rng.choice([1, 2, 3, 4, -88], n_households, p=[0.4, 0.3, 0.2, 0.05, 0.05]).astype(np.int8),
+        'INCOME': np.where(rng.random(n_households) < 0.05, np.nan, rng.integers(1, 9, n_households)),
+        'HAZARD_TYPE': rng.choice([1, 2, 3, 5, 6], n_households).astype(np.int8),
+        'HWEIGHT': rng.lognormal(np.log(1500), 0.8, n_households),
+    })
+    for i in range(n_replicates):
+        data[f'HWEIGHT{i+1}'] = data['HWEIGHT'] * rng.uniform(0.3, 1.7, n_households)
+    return data
+
+
+def make_data_dict(data):
+    variables = [Variable(col, f"Name of {col}", 'Nominal', {code: f"{col} {code}" for code in range(1, 10)})
+                 for col in data.columns if not col.startswith('HWEIGHT')]
+    return DataDictionary(variables)
+
+
+factors = ['ND_HOWLONG', 'TENURE', 'HAZARD_TYPE']
+
+
+@pytest.mark.parametrize("stderr", [False, True])
+@pytest.mark.parametrize("main_factor, curr_factor", [('ND_HOWLONG', 'TENURE'), ('TENURE', 'ND_HOWLONG')])
+def test_marginalized_cube_matches_crosstab(main_factor, curr_factor, stderr):
+    data = make_households()
+    data_dict = make_data_dict(data)
+    cube = build_weighted_cube(data, factors)
+    create = create_crosstab_stderr if stderr else create_crosstab
+    expected = create(data, data_dict, main_factor, curr_factor, samples=True)
+    for crosst in [cube.crosstab(data_dict, main_factor, curr_factor, samples=True, stderr=stderr),
+                   cube.marginalize('HAZARD_TYPE').crosstab(data_dict, main_factor, curr_factor, samples=True,
+                                                            stderr=stderr)]:
+        pd.testing.assert_frame_equal(crosst, expected, check_exact=False, rtol=1e-5)
+
+
+@pytest.mark.parametrize("stderr", [False, True])
+@pytest.mark.parametrize("code", [1, 3, 6])
+def test_sliced_cube_matches_filtered_crosstab(code, stderr):
+    data = make_households()
+    data_dict = make_data_dict(data)
+    cube = build_weighted_cube(data, factors)
+    mask = data['HAZARD_TYPE'].to_numpy() == code
+    create = create_crosstab_stderr if stderr else create_crosstab
+    expected = create(data, data_dict, 'ND_HOWLONG', 'TENURE', samples=True, mask=mask)
+    crosst = cube.slice('HAZARD_TYPE', code).crosstab(data_dict, 'ND_HOWLONG', 'TENURE', samples=True, stderr=stderr)
+    pd.testing.assert_frame_equal(crosst, expected, check_exact=False, rtol=1e-5)
+    pd.testing.assert_frame_equal(crosst, create(data[mask], data_dict, 'ND_HOWLONG', 'TENURE', samples=True),
+                                  check_exact=False, rtol=1e-5)
+
+
+def test_filtered_cube_matches_filtered_crosstab():
+    data = make_households()
+    data_dict = make_data_dict(data)
+    mask = data['TENURE'].isin([1, 2]).to_numpy()
+    cube = build_weighted_cube(data, factors, mask=mask)
+    expected = create_crosstab(data, data_dict, 'ND_HOWLONG', 'HAZARD_TYPE', samples=True, mask=mask)
+    pd.testing.assert_frame_equal(cube.crosstab(data_dict, 'ND_HOWLONG', 'HAZARD_TYPE', samples=True), expected)
+
+
+def test_sliced_cube_without_code():
+    data = make_households()
+    cube = build_weighted_cube(data, factors).slice('HAZARD_TYPE', 4)
+    assert cube.factors == ('ND_HOWLONG', 'TENURE')
+    assert cube.sums.sum() == 0 and cube.counts.sum() == 0 and cube.rep_sums.sum() == 0
+
+
+@pytest.mark.parametrize("bounds", [[0, 4001], [0, 1500, 4001], [0, 10, 1000, 2500, 4001]])
+def test_partitioned_sums_match_whole(bounds):
+    # Partitions of uneven sizes, some of which miss codes of the factors
+    data = make_households()
+    data_dict = make_data_dict(data)
+    data.loc[(data.index < 1500) & (data['INCOME'] == 8), 'INCOME'] = 7
+    main_factors, factor_values = ['ND_HOWLONG'], ['TENURE', 'INCOME', 'HAZARD_TYPE']
+    parts = [build_crosstab_sums(data.iloc[start:end], main_factors, factor_values)
+             for start, end in zip(bounds[:-1], bounds[1:])]
+    cube = combine_crosstab_sums(parts, data_dict, main_factors, factor_values)
+    expected = build_crosstab_cube(data, data_dict, main_factors, factor_values)
+    assert cube['factors'] == expected['factors']
+    for curr_factor in factor_values:
+        entry = cube['crosstabs']['ND_HOWLONG'][curr_factor]
+        expected_entry = expected['crosstabs']['ND_HOWLONG'][curr_factor]
+        for key in ['index_name', 'index', 'columns_name', 'columns', 'counts']:
+            assert entry[key] == expected_entry[key]
+        np.testing.assert_allclose(entry['proportions'], expected_entry['proportions'])
+        np.testing.assert_allclose(entry['stderr'], expected_entry['stderr'], rtol=1e-5)
+
+        # Both match the crosstab over all households
+        crosst = create_crosstab(data, data_dict, 'ND_HOWLONG', curr_factor, samples=True)
+        pd.testing.assert_frame_equal(get_cube_crosstab(cube, 'ND_HOWLONG', curr_factor, samples=True), crosst,
+                                      check_exact=False, rtol=1e-5)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from util.filters import BitmapIndex, get_filter_mask, normalize_filters
+
+# Not a multiple of 8, so that the last byte of each bitmap is partly padding
+n_households = 1003
+
+
+def make_households(seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'REGION': rng.integers(1, 5, n_households).astype(np.int8),
+        'TENURE': rng.choice([1, 2, 3, 4, -88, -99], n_households).astype(np.int8),
+        'INCOME': np.where(rng.random(n_households) < 0.1, np.nan, rng.integers(1, 9, n_households)),
+        'HAZARD_TYPE': rng.integers(1, 7, n_households).astype(np.int16),
+    })
+
+
+def get_mask_reference(data, filters):
+    mask = pd.Series(True, index=data.index)
+    for factor, codes in filters:
+        mask &= data[factor].isin(codes)
+    return mask.to_numpy()
+
+
+filter_cases = [
+    (),
+    (("REGION", (2,)),),
+    (("REGION", (1, 3, 4)),),
+    (("TENURE", (1, 2)), ("REGION", (2, 3))),
+    (("INCOME", (1, 5, 8)), ("TENURE", (3,)), ("HAZARD_TYPE", (2, 6))),
+    (("REGION", (9,)),),
+    (("REGION", (2, 9)), ("INCOME", (7,))),
+]
+
+
+@pytest.mark.parametrize("filters", filter_cases)
+@pytest.mark.parametrize("indexed", [[], ["REGION", "TENURE"], ["REGION", "TENURE", "INCOME", "HAZARD_TYPE"]])
+def test_filter_mask_matches_isin(filters, indexed):
+    data = make_households()
+    index = BitmapIndex(data, indexed) if indexed else None
+    mask = get_filter_mask(data, filters, index=index)
+    assert mask.dtype == bool and mask.shape == (n_households,)
+    np.testing.assert_array_equal(mask, get_mask_reference(data, filters))
+
+
+@pytest.mark.parametrize("filters", filter_cases)
+def test_bitmap_index_matches_isin(filters):
+    data = make_households()
+    index = BitmapIndex(data, ["REGION", "TENURE", "INCOME", "HAZARD_TYPE"])
+    np.testing.assert_array_equal(index.get_mask(filters), get_mask_reference(data, filters))
+    assert len(index.get_bitmap(filters)) == (n_households + 7) // 8
+
+
+def test_bitmap_index_excludes_unreported_values():
+    data = make_households()
+    index = BitmapIndex(data, ["TENURE", "INCOME"])
+    assert set(index.bitmaps["TENURE"]) == {1, 2, 3, 4}
+    assert set(index.bitmaps["INCOME"]) == set(range(1, 9))
+
+
+def test_normalize_filters():
+    filters = [("TENURE", [2, 1]), ("REGION", []), ("INCOME", (3,))]
+    assert normalize_filters(filters) == (("INCOME", (3,)), ("TENURE", (1, 2)))
+    assert normalize_filters([]) == ()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from parsers.parse_puf_files import get_hazard_type
+
+ref_cols = [f'ND_TYPE{i+1}' for i in range(5)]
+
+
+def get_hazard_type_rowwise(df):
+    # Previous row-wise implementation of get_hazard_type
+    idx = df.ND_DISPLACE == 1
+    out = pd.Series(float('nan'), index=df.index)
+    def get_disaster_type(row):
+        result = row[row == 1].index.tolist()
+        if len(result) == 0:
+            return float('nan')
+        elif len(result) == 1:
+            return int(result[0][-1])
+        return 6
+    if idx.any():
+        out[idx] = df[idx][ref_cols].apply(get_disaster_type, axis=1).values
+    return out
+
+
+def make_frame(flags, displaced=None):
+    df = pd.DataFrame(flags, columns=ref_cols)
+    df['ND_DISPLACE'] = 1 if displaced is None else displaced
+    return df
+
+
+@pytest.mark.parametrize("flags, expected", [
+    ([2, 2, 2, 2, 2], float('nan')),
+    ([-99, -99, -99, -99, -99], float('nan')),
+    ([-88, -88, -88, -88, -88], float('nan')),
+    ([1, 2, 2, 2, 2], 1),
+    ([2, 2, 1, -99, 2], 3),
+    ([-88, 2, 2, 2, 1], 5),
+    ([1, 2, 1, 2, 2], 6),
+    ([1, 1, 1, 1, 1], 6),
+    ([1, -99, -88, 1, 2], 6),
+])
+def test_hazard_type_cases(flags, expected):
+    df, _ = get_hazard_type(make_frame([flags]))
+    np.testing.assert_array_equal(df['HAZARD_TYPE'].to_numpy(), [expected])
+
+
+def test_hazard_type_not_displaced():
+    df, _ = get_hazard_type(make_frame([[1, 2, 2, 2, 2], [1, 1, 2, 2, 2]], displaced=[2, -99]))
+    assert df['HAZARD_TYPE'].isna().all()
+
+
+def test_hazard_type_matches_rowwise():
+    # Every combination of flags, sentinels and displacement answers
+    rng = np.random.default_rng(0)
+    flags = rng.choice([1, 2, -88, -99], size=(2000, 5), p=[0.3, 0.5, 0.1, 0.1])
+    df = make_frame(flags, displaced=rng.choice([1, 2, -99], size=2000, p=[0.8, 0.1, 0.1]))
+    expected = get_hazard_type_rowwise(df)
+    df, entry = get_hazard_type(df.copy())
+    np.testing.assert_array_equal(df['HAZARD_TYPE'].to_numpy(), expected.to_numpy())
+    assert entry['target'] == 'HAZARD_TYPE'
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from parsers.parse_data_dictionary import DataDictionary
+from parsers.parse_puf_files import convert_birth_year_to_age_bin, convert_rent_to_bin, get_recodes
+from parsers.recode import MISSING_CODE, apply_recodes, get_bin_codes, get_bin_labels
+from util.synthetic import generate_households, get_synthetic_data_dict
+
+
+def make_recode(source, target, mapping):
+    return {'source': source, 'target': target, 'mapping': mapping, 'name': target, 'type': 'Nominal',
+            'labels': {}}
+
+
+def get_recodes_reference(df, recodes):
+    # Series.replace of each recode, as before compile_recodes
+    return {recode['target']: (recode['source'](df) if callable(recode['source']) else df[recode['source']])
+            .astype(float).replace(recode['mapping']) for recode in recodes}
+
+
+values_cases = [
+    [1, 2, 3, 4, 5],
+    [1, 2, 7, 99, -1],
+    [-99, -88, 1, 3, 2],
+    [1.0, np.nan, 3.0, np.nan, 2.0],
+    [1.5, 2.0, -0.5, 3.25, 1e9],
+    [np.nan, np.nan, np.nan, np.nan, np.nan],
+]
+
+
+@pytest.mark.parametrize("values", values_cases)
+def test_recodes_match_replace(values):
+    # Unknown codes, sentinels, NaN and non-integer values are carried over
+    df = pd.DataFrame({'SOURCE': values})
+    mappings = {'ONE': {1: 10, 2: 10, 3: 20}, 'TWO': {2: 1, 3: 2, 5: np.nan}, 'THREE': {-99: -1, 1: 5}}
+    recodes = [make_recode('SOURCE', target, mapping) for target, mapping in mappings.items()]
+    df = apply_recodes(df, recodes)
+    for target, mapping in mappings.items():
+        expected = pd.Series(values, dtype=float).replace(mapping)
+        np.testing.assert_array_equal(df[target].to_numpy(), expected.to_numpy())
+    assert list(df.columns) == ['SOURCE', 'ONE', 'TWO', 'THREE']
+
+
+def test_recodes_of_several_sources():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'A': rng.choice([1, 2, 3, 4, -99, np.nan], 1000), 'B': rng.integers(-5, 30, 1000)})
+    recodes = [
+        make_recode('A', 'A_BIN', {1: 1, 2: 1, 3: 2}),
+        make_recode('B', 'B_BIN', {b: b // 10 for b in range(0, 25)}),
+        make_recode('A', 'A_FLAG', {4: 1}),
+        make_recode(lambda df: df['A'] * 10 + df['B'], 'AB', {10: 1, 21: 2, 42: 3}),
+    ]
+    expected = get_recodes_reference(df, recodes)
+    df = apply_recodes(df, recodes)
+    for target, values in expected.items():
+        np.testing.assert_array_equal(df[target].to_numpy(), values.to_numpy())
+    assert list(df.columns) == ['A', 'B', 'A_BIN', 'B_BIN', 'A_FLAG', 'AB']
+
+
+def test_puf_recodes_match_replace():
+    # Every derived variable of the dashboard, on synthetic households that
+    # follow the data dictionary (with -88/-99 codes)
+    frame = get_synthetic_data_dict()
+    recodes = get_recodes(DataDictionary.from_frame(frame))
+    df = generate_households(2000, data_dict=frame, n_extra=0)
+    expected = get_recodes_reference(df, recodes)
+    df = apply_recodes(df, recodes)
+    for target, values in expected.items():
+        np.testing.assert_array_equal(df[target].to_numpy(), values.to_numpy(), err_msg=target)
+
+
+bin_edges = [
+    [0, 400, 800, 1200, 2000, 10000],
+    [0, 24, 34, 44, 54, 64, 74, 1000],
+    [-10.5, 0, 0.25, 3],
+]
+
+
+@pytest.mark.parametrize("edges", bin_edges)
+@pytest.mark.parametrize("right", [True, False])
+@pytest.mark.parametrize("start", [0, 1])
+def test_bin_codes_match_cut(edges, right, start):
+    # Random values, every edge, values just inside and outside each edge,
+    # out-of-range values and NaN
+    rng = np.random.default_rng(0)
+    edges_array = np.array(edges, dtype=float)
+    values = np.concatenate([
+        rng.uniform(edges[0] - 5, edges[-1] + 5, 1000),
+        edges_array, np.nextafter(edges_array, -np.inf), np.nextafter(edges_array, np.inf),
+        [-np.inf, np.inf, np.nan, edges[0] - 1e6, edges[-1] + 1e6],
+    ])
+    codes = get_bin_codes(values, edges, right=right, start=start)
+    expected = pd.cut(values, edges, right=right, labels=False)
+    np.testing.assert_array_equal(codes, np.where(np.isnan(expected), MISSING_CODE, expected + start))
+
+
+def test_bin_codes_of_series():
+    values = pd.Series([0, 1, 24, 25, np.nan, 1000, 1001], index=[5, 3, 1, 0, 2, 4, 6])
+    codes = get_bin_codes(values, [0, 24, 34, 1000])
+    np.testing.assert_array_equal(codes, [MISSING_CODE, 0, 0, 1, MISSING_CODE, 2, MISSING_CODE])
+
+
+@pytest.mark.parametrize("edges", bin_edges)
+@pytest.mark.parametrize("right", [True, False])
+def test_bin_labels_match_cut(edges, right):
+    # Bin i+start of get_bin_codes is category i of pd.cut
+    labels = get_bin_labels(edges, fmt='{lower}|{upper}', right=right, start=1)
+    categories = pd.cut([], edges, right=right).categories
+    assert list(labels) == list(range(1, len(categories) + 1))
+    bounds = [tuple(float(bound) for bound in label.split('|')) for label in labels.values()]
+    assert bounds == [(interval.left, interval.right) for interval in categories]
+
+
+def test_bin_labels_with_step():
+    labels = get_bin_labels([0, 1, 2, 4, 7, 1000], single='{hi}', last='{lo}+', step=1)
+    assert labels == {0: '1', 1: '2', 2: '3 - 4', 3: '5 - 7', 4: '8+'}
+    labels = get_bin_labels([0, 10, 20, 30], right=False, step=1, first='Under {upper}')
+    assert labels == {0: 'Under 10', 1: '10 - 19', 2: '20 - 29'}
+
+
+def test_rent_bins():
+    df, entry = convert_rent_to_bin(pd.DataFrame({'TRENTAMT': [0, 1, 400, 401, 1999, 2000, 2001, 10001, -99, np.nan]}))
+    np.testing.assert_array_equal(df['RENT_BIN'].to_numpy(), [np.nan, 0, 0, 1, 3, 3, 4, np.nan, np.nan, np.nan])
+    assert entry['labels'] == {
+        0: 'Less than \\$400',
+        1: '\\$400 - \\$800',
+        2: '\\$800 - \\$1,200',
+        3: '\\$1,200 - \\$2,000',
+        4: '\\$2,000 or more',
+    }
+
+
+def test_age_bins():
+    df, entry = convert_birth_year_to_age_bin(pd.DataFrame({'TBIRTH_YEAR': [2000, 1998, 1997, 1948, 1947, np.nan]}))
+    np.testing.assert_array_equal(df['AGE_BIN'].to_numpy(), [0, 0, 1, 5, 6, np.nan])
+    assert entry['labels'][0] == '24 or less' and entry['labels'][1] == '25 - 34' and entry['labels'][6] == '75+'
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from parsers.parse_data_dictionary import DataDictionary, Variable
+from util.cube import build_weighted_cube
+from util.data import create_crosstab_stderr, get_replicate_sums, weighted_cube
+
+n_households = 3001
+n_replicates = 80
+
+
+def make_households(seed=0):
+    # Coded factors with unreported values (except REGION), with replicate
+    # weights
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'ND_HOWLONG': rng.choice([1, 2, 3, 4, -99], n_households).astype(np.int8),
+        'TENURE': rng.choice([1, 2, 3, -88], n_households, p=[0.4, 0.3, 0.25, 0.05]).astype(np.int8),
+        'HAZARD_TYPE': np.where(rng.random(n_households) < 0.05, np.nan, rng.integers(1, 7, n_households)),
+        'REGION': rng.integers(1, 5, n_households).astype(np.int8),
+        'HWEIGHT': rng.lognormal(np.log(1500), 0.8, n_households),
+    })
+    factors = rng.uniform(0.3, 1.7, (n_households, n_replicates))
+    replicates = pd.DataFrame(data['HWEIGHT'].to_numpy()[:, None] * factors,
+                              columns=[f'HWEIGHT{i+1}' for i in range(n_replicates)])
+    return pd.concat([data, replicates], axis=1)
+
+
+def make_data_dict(data):
+    variables = [Variable(col, col, 'Nominal', {}) for col in data.columns if not col.startswith('HWEIGHT')]
+    return DataDictionary(variables)
+
+
+def get_proportions(df, main_factor, curr_factor, weights):
+    sums = df.groupby([curr_factor, main_factor])[weights].sum().unstack(fill_value=0)
+    return sums.div(sums.sum(axis=1), axis=0)
+
+
+def get_stderr_rowwise(data, main_factor, curr_factor):
+    # Successive difference replication, one replicate at a time:
+    # sqrt(4/R * sum((p_r - p)^2))
+    df = data[(data[[main_factor, curr_factor]] > 0).all(axis=1)]
+    proportions = get_proportions(df, main_factor, curr_factor, 'HWEIGHT')
+    variance = sum((get_proportions(df, main_factor, curr_factor, f'HWEIGHT{i+1}') - proportions)**2
+                   for i in range(n_replicates))
+    return np.sqrt(4 / n_replicates * variance)
+
+
+@pytest.mark.parametrize("main_factor, curr_factor", [
+    ('ND_HOWLONG', 'TENURE'),
+    ('ND_HOWLONG', 'HAZARD_TYPE'),
+    ('HAZARD_TYPE', 'TENURE'),
+])
+def test_stderr_matches_rowwise(main_factor, curr_factor):
+    data = make_households()
+    data_dict = make_data_dict(data)
+    expected = get_stderr_rowwise(data, main_factor, curr_factor).to_numpy()
+
+    stderr = create_crosstab_stderr(data, data_dict, main_factor, curr_factor)
+    np.testing.assert_allclose(stderr.to_numpy(), expected, rtol=1e-4, atol=1e-7)
+
+    cube = build_weighted_cube(data, [main_factor, curr_factor, 'REGION'])
+    stderr = cube.crosstab(data_dict, main_factor, curr_factor, stderr=True)
+    np.testing.assert_allclose(stderr.to_numpy(), expected, rtol=1e-4, atol=1e-7)
+
+
+def test_stderr_with_mask_matches_rowwise():
+    data = make_households()
+    data_dict = make_data_dict(data)
+    mask = data['HWEIGHT'].to_numpy() > 1000
+    stderr = create_crosstab_stderr(data, data_dict, 'ND_HOWLONG', 'TENURE', mask=mask)
+    expected = get_stderr_rowwise(data[mask], 'ND_HOWLONG', 'TENURE').to_numpy()
+    np.testing.assert_allclose(stderr.to_numpy(), expected, rtol=1e-4, atol=1e-7)
+
+
+@pytest.mark.parametrize("max_cells", [2**22, 1000, 1])
+def test_replicate_sums_match_bincount(max_cells):
+    # One np.bincount per replicate, whatever the number of households per
+    # chunk; excluded households are in the spill cell
+    rng = np.random.default_rng(3)
+    joint = rng.integers(0, 13, 500)
+    rep_weights = rng.random((500, 7))
+    rep_sums = get_replicate_sums(joint, 12, rep_weights, max_cells=max_cells)
+    expected = np.column_stack([np.bincount(joint, weights=rep, minlength=13)[:12] for rep in rep_weights.T])
+    np.testing.assert_allclose(rep_sums, expected)
+
+
+def test_cube_replicate_sums_match_weighted_cube():
+    rng = np.random.default_rng(4)
+    codes = [rng.integers(1, 4, 500), rng.integers(-1, 5, 500), rng.integers(0, 3, 500)]
+    rep_weights = rng.random((500, 7))
+    valid = codes[1] >= 0
+    sums, _, _, rep_sums = weighted_cube(codes, rng.random(500), valid=valid, rep_weights=rep_weights)
+    assert rep_sums.shape == sums.shape + (7,)
+    for r in range(rep_weights.shape[1]):
+        expected, _, _, _ = weighted_cube(codes, rep_weights[:, r], valid=valid)
+        np.testing.assert_allclose(rep_sums[..., r], expected)
@@ -0,0 +1,90 @@
+import contextlib
+import contextvars
+import threading
+import weakref
+from collections import OrderedDict
+
+# Hits and misses of the cache lookups made by the current request (each
+# request runs in its own thread, hence its own context), if tracked
+cache_lookups = contextvars.ContextVar("cache_lookups", default=None)
+
+
+def record_lookup(hit):
+    """Counts a cache lookup towards the lookups tracked in this context"""
+    lookups = cache_lookups.get()
+    if lookups is not None:
+        lookups["hits" if hit else "misses"] += 1
+
+
+@contextlib.contextmanager
+def track_lookups():
+    """Tracks the cache lookups made within the block, e.g. by a callback,
+    regardless of lookups made concurrently by other requests; lookups are
+    also counted by any enclosing block
+
+    Yields:
+        lookups (dict): Number of hits and misses, updated as they occur
+    """
+    parent = cache_lookups.get()
+    lookups = {"hits": 0, "misses": 0}
+    token = cache_lookups.set(lookups)
+    try:
+        yield lookups
+    finally:
+        cache_lookups.reset(token)
+        if parent is not None:
+            parent["hits"] += lookups["hits"]
+            parent["misses"] += lookups["misses"]
+
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used cache with hit, miss and
+    eviction counters. Entries can be tied to a source object (e.g., the
+    household DataFrame) so that the cache empties itself when a different
+    source is used"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._source = None
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def bind(self, source):
+        """Clears the cache if entries were computed from another source"""
+        with self._lock:
+            if self._source is None or self._source() is not source:
+                self._entries.clear()
+                self._source = weakref.ref(source)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                record_lookup(True)
+                return self._entries[key]
+            self.misses += 1
+            record_lookup(False)
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._source = None
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,34 @@
+from util.cache import LRUCache
+from util.data import create_crosstab, create_crosstab_stderr
+from util.filters import get_filter_mask, normalize_filters
+
+# Crosstabs of the household data, shared across requests
+crosstab_cache = LRUCache(maxsize=256)
+
+
+def cached_crosstab(
+    data, data_dict, main_factor, curr_factor, weights="HWEIGHT", samples=False, stderr=False, filters=(),
+    index=None
+):
+    """Memoized create_crosstab (or create_crosstab_stderr), optionally for
+    a subgroup; the cache is emptied whenever a different DataFrame is
+    passed, e.g. after the dataset is reloaded
+
+    Args:
+        filters (tuple): Subgroup filters (see util.filters.get_filter_mask)
+        index (BitmapIndex): Bitmaps of the household data, used to combine
+            the filters
+
+    Returns:
+        crosst (pd.DataFrame): Copy of the cached crosstab
+    """
+    crosstab_cache.bind(data)
+    filters = normalize_filters(filters)
+    key = (main_factor, curr_factor, weights, samples, stderr, filters)
+    crosst = crosstab_cache.get(key, default=False)
+    if crosst is False:
+        create = create_crosstab_stderr if stderr else create_crosstab
+        mask = get_filter_mask(data, filters, index=index) if filters else None
+        crosst = create(data, data_dict, main_factor, curr_factor, weights=weights, samples=samples, mask=mask)
+        crosstab_cache.put(key, crosst)
+    return None if crosst is None else crosst.copy()
@@ -0,0 +1,321 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from util.cache import LRUCache
+from util.data import (get_codes, get_replicate_columns, get_sdr_stderr, label_crosstab, replicate_crosstab,
+                       weighted_crosstab, weighted_cube)
+from util.filters import get_filter_mask, normalize_filters
+
+# Weighted cubes of the household data, shared across requests
+weighted_cube_cache = LRUCache(maxsize=64)
+
+
+def build_crosstab_cube(data, data_dict, main_factors, factor_values, weights="HWEIGHT"):
+    """Precomputes the crosstab of every main factor with every other factor
+
+    Args:
+        data (pd.DataFrame): Household data
+        data_dict (DataDictionary): Data dictionary
+        main_factors (list): Outcomes shown in the dashboard
+        factor_values (list): Factors that can be compared against each outcome
+        weights (str): Column of household weights
+
+    Returns:
+        cube (dict): JSON-serializable weighted proportions, sample sizes and
+            labels for each (main factor, factor) pair, along with standard
+            errors if the data has replicate weights
+    """
+    sums = build_crosstab_sums(data, main_factors, factor_values, weights=weights)
+    return combine_crosstab_sums([sums], data_dict, main_factors, factor_values)
+
+
+def build_crosstab_sums(data, main_factors, factor_values, weights="HWEIGHT"):
+    """Sums the weights (and replicate weights) in each cell of every
+    crosstab of the cube; unlike proportions, the sums of separate
+    partitions of the households add up to the sums of the whole
+
+    Args:
+        data (pd.DataFrame): Household data
+        main_factors (list): Outcomes shown in the dashboard
+        factor_values (list): Factors that can be compared against each outcome
+        weights (str): Column of household weights
+
+    Returns:
+        sums (dict): Arrays keyed by "{main_factor}/{curr_factor}/{name}",
+            where name is one of rows, columns, sums, counts and replicates
+            (only if the data has replicate weights)
+    """
+    rep_cols = get_replicate_columns(data)
+    rep_weights = data[rep_cols].to_numpy(dtype=np.float32) if rep_cols else None
+    w = data[weights].to_numpy()
+    codes = {factor: get_codes(data, factor) for factor in set(main_factors) | set(factor_values)}
+    arrays = {}
+    for main_factor in main_factors:
+        main_codes, main_valid = codes[main_factor]
+        for curr_factor in factor_values:
+            if curr_factor == main_factor:
+                continue
+            curr_codes, curr_valid = codes[curr_factor]
+            valid = main_valid & curr_valid
+            sums, counts, row_keys, col_keys = weighted_crosstab(curr_codes, main_codes, w, valid)
+            key = f"{main_factor}/{curr_factor}"
+            arrays.update({f"{key}/rows": row_keys, f"{key}/columns": col_keys,
+                           f"{key}/sums": sums, f"{key}/counts": counts})
+            if rep_weights is not None and valid.any():
+                arrays[f"{key}/replicates"] = replicate_crosstab(curr_codes, main_codes, rep_weights, valid,
+                                                                 row_keys, col_keys)
+    return arrays
+
+
+def combine_crosstab_sums(partition_sums, data_dict, main_factors, factor_values):
+    """Builds a crosstab cube from the crosstab sums of one or more
+    partitions of the households, e.g. one per survey cycle
+
+    Args:
+        partition_sums (list): Outputs of build_crosstab_sums
+        data_dict (DataDictionary): Data dictionary
+        main_factors (list): Outcomes shown in the dashboard
+        factor_values (list): Factors that can be compared against each outcome
+
+    Returns:
+        cube (dict): Crosstab cube, as returned by build_crosstab_cube
+    """
+    cube = {
+        "factors": [{"value": factor, "name": data_dict.name(factor)} for factor in factor_values],
+        "crosstabs": {main_factor: {} for main_factor in main_factors},
+    }
+    for main_factor in main_factors:
+        for curr_factor in factor_values:
+            if curr_factor == main_factor:
+                continue
+            key = f"{main_factor}/{curr_factor}"
+            parts = [part for part in partition_sums if f"{key}/sums" in part]
+
+            # Add up the sums of each partition over the union of codes
+            empty = np.zeros(0, dtype=np.int64)
+            row_keys = np.unique(np.concatenate([empty] + [part[f"{key}/rows"] for part in parts]))
+            col_keys = np.unique(np.concatenate([empty] + [part[f"{key}/columns"] for part in parts]))
+            shape = (len(row_keys), len(col_keys))
+            sums, counts = np.zeros(shape), np.zeros(shape, dtype=np.int64)
+            with_replicates = [part for part in parts if f"{key}/replicates" in part]
+            rep_sums = None
+            if with_replicates and len(with_replicates) == len(parts):
+                rep_sums = np.zeros(shape + (with_replicates[0][f"{key}/replicates"].shape[2],))
+            for part in parts:
+                cells = np.ix_(np.searchsorted(row_keys, part[f"{key}/rows"]),
+                               np.searchsorted(col_keys, part[f"{key}/columns"]))
+                sums[cells] += part[f"{key}/sums"]
+                counts[cells] += part[f"{key}/counts"]
+                if rep_sums is not None:
+                    rep_sums[cells] += part[f"{key}/replicates"]
+
+            # Arrange proportions with friendly labels
+            crosst = label_crosstab(sums / sums.sum(axis=1, keepdims=True), data_dict, main_factor, curr_factor,
+                                    row_keys, col_keys, counts)
+            cube["crosstabs"][main_factor][curr_factor] = {
+                "index_name": crosst.index.name,
+                "index": [str(label) for label in crosst.index],
+                "columns_name": crosst.columns.name,
+                "columns": [str(label) for label in crosst.columns],
+                "proportions": crosst.to_numpy().tolist(),
+                "counts": counts.sum(axis=1).tolist(),
+            }
+            if rep_sums is not None:
+                cube["crosstabs"][main_factor][curr_factor]["stderr"] = get_sdr_stderr(sums, rep_sums).tolist()
+    return cube
+
+
+def save_crosstab_sums(sums, file_path):
+    """Writes the crosstab sums of a partition to an .npz file"""
+    np.savez(file_path, **sums)
+
+
+def load_crosstab_sums(file_path):
+    """Reads the crosstab sums of a partition from an .npz file"""
+    with np.load(file_path) as f:
+        return dict(f)
+
+
+def save_crosstab_cube(cube, file_path):
+    """Writes a crosstab cube to a JSON file"""
+    folder = os.path.dirname(file_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(file_path, "w") as f:
+        json.dump(cube, f, separators=(",", ":"))
+
+
+def load_crosstab_cube(file_path):
+    """Reads a crosstab cube from a JSON file"""
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def get_cube_crosstab(cube, main_factor, curr_factor, samples=False, stderr=False):
+    """Rebuilds the output of create_crosstab (or create_crosstab_stderr)
+    from a crosstab cube
+
+    Args:
+        cube (dict): Crosstab cube from build_crosstab_cube
+        main_factor (str): Column variable of the crosstab
+        curr_factor (str): Index variable of the crosstab
+        samples (bool): Whether sample sizes are added to the index labels
+        stderr (bool): Whether standard errors are returned instead
+
+    Returns:
+        crosst (pd.DataFrame): Weighted proportions (or their standard
+            errors) of main_factor for each value of curr_factor; None if
+            standard errors are requested but were not precomputed
+    """
+    entry = cube["crosstabs"][main_factor][curr_factor]
+    if stderr and "stderr" not in entry:
+        return None
+    index = entry["index"]
+    if samples:
+        index = [f"{label}\n(n={N:,.0f})" for label, N in zip(index, entry["counts"])]
+    crosst = pd.DataFrame(
+        entry["stderr" if stderr else "proportions"],
+        index=pd.Index(index, name=entry["index_name"]),
+        columns=pd.Index(entry["columns"], name=entry["columns_name"]),
+    )
+    return crosst
+
+
+class WeightedCube:
+    """Weighted sums and household counts for every combination of the codes
+    of several factors, e.g. duration by tenure by hazard type, from which
+    crosstabs of any two factors are derived without the household data
+
+    Args:
+        factors (tuple): Coded columns, one per axis
+        keys (list): Observed codes of each factor, along each axis
+        sums (np.ndarray): Weighted sums, one axis per factor
+        counts (np.ndarray): Number of households, shape of sums
+        rep_sums (np.ndarray): Replicate sums with an extra last axis of
+            replicates, or None
+    """
+
+    def __init__(self, factors, keys, sums, counts, rep_sums=None):
+        self.factors = tuple(factors)
+        self.keys = list(keys)
+        self.sums, self.counts, self.rep_sums = sums, counts, rep_sums
+
+    def axis(self, factor):
+        return self.factors.index(factor)
+
+    def marginalize(self, *factors):
+        """Sums out the given factors
+
+        Returns:
+            cube (WeightedCube): Cube over the remaining factors
+        """
+        axes = tuple(self.axis(factor) for factor in factors)
+        kept = [i for i in range(len(self.factors)) if i not in axes]
+        return WeightedCube([self.factors[i] for i in kept], [self.keys[i] for i in kept],
+                            self.sums.sum(axis=axes), self.counts.sum(axis=axes),
+                            None if self.rep_sums is None else self.rep_sums.sum(axis=axes))
+
+    def slice(self, factor, code):
+        """Keeps the households with a given code of a factor
+
+        Returns:
+            cube (WeightedCube): Cube over the other factors (empty if the
+                code was not observed)
+        """
+        i = self.axis(factor)
+        matches = np.flatnonzero(self.keys[i] == code)
+        kept = [j for j in range(len(self.factors)) if j != i]
+
+        def take(values):
+            if not len(matches):
+                return np.zeros(values.shape[:i] + values.shape[i+1:], dtype=values.dtype)
+            return np.take(values, matches[0], axis=i)
+        return WeightedCube([self.factors[j] for j in kept], [self.keys[j] for j in kept],
+                            take(self.sums), take(self.counts),
+                            None if self.rep_sums is None else take(self.rep_sums))
+
+    def crosstab(self, data_dict, main_factor, curr_factor, samples=False, stderr=False):
+        """Crosstab of two factors of the cube, marginalized over the others
+
+        Returns:
+            crosst (pd.DataFrame): Weighted proportions (or their standard
+                errors) as returned by create_crosstab; None if standard
+                errors are requested without replicate sums
+        """
+        if stderr and self.rep_sums is None:
+            return None
+        others = [factor for factor in self.factors if factor not in (main_factor, curr_factor)]
+        cube = self.marginalize(*others)
+        order = [cube.axis(curr_factor), cube.axis(main_factor)]
+        sums, counts = cube.sums.transpose(order), cube.counts.transpose(order)
+
+        # Keep observed codes only
+        row_obs, col_obs = counts.sum(axis=1) > 0, counts.sum(axis=0) > 0
+        cells = np.ix_(row_obs, col_obs)
+        sums, counts = sums[cells], counts[cells]
+        row_keys, col_keys = cube.keys[order[0]][row_obs], cube.keys[order[1]][col_obs]
+        if stderr:
+            values = get_sdr_stderr(sums, cube.rep_sums.transpose(order + [2])[cells])
+        else:
+            values = sums / sums.sum(axis=1, keepdims=True)
+        return label_crosstab(values, data_dict, main_factor, curr_factor, row_keys, col_keys, counts,
+                              samples=samples)
+
+
+def build_weighted_cube(data, factors, weights="HWEIGHT", mask=None):
+    """Builds a weighted cube of several factors from the household data
+
+    Args:
+        data (pd.DataFrame): Household data
+        factors (list): Coded columns, one per axis
+        weights (str): Column of household weights
+        mask (np.ndarray): Boolean mask of the households of a subgroup; all
+            households if None
+
+    Returns:
+        cube (WeightedCube): Weighted sums and counts of the households with
+            known values of every factor, along with replicate sums if the
+            data has replicate weights
+    """
+    # Remove unknown/unreported values and households outside the subgroup
+    codes = []
+    valid = np.ones(len(data), dtype=bool) if mask is None else mask.copy()
+    for factor in factors:
+        values, known = get_codes(data, factor)
+        codes.append(values)
+        valid &= known
+    rows = np.flatnonzero(valid)
+    codes = [values[rows] for values in codes]
+
+    # Sum weights (and replicate weights) per cell
+    rep_cols = get_replicate_columns(data)
+    rep_weights = None
+    if rep_cols:
+        rep_weights = np.column_stack([data[col].to_numpy()[rows] for col in rep_cols]).astype(np.float32)
+    sums, counts, keys, rep_sums = weighted_cube(codes, data[weights].to_numpy()[rows], rep_weights=rep_weights)
+    return WeightedCube(factors, keys, sums, counts, rep_sums)
+
+
+def cached_weighted_cube(data, factors, weights="HWEIGHT", filters=(), index=None):
+    """Memoized build_weighted_cube, optionally for a subgroup; the cache is
+    emptied whenever a different DataFrame is passed
+
+    Args:
+        filters (tuple): Subgroup filters (see util.filters.get_filter_mask)
+        index (BitmapIndex): Bitmaps of the household data, used to combine
+            the filters
+
+    Returns:
+        cube (WeightedCube): Cached cube, which is not modified by its methods
+    """
+    weighted_cube_cache.bind(data)
+    filters = normalize_filters(filters)
+    key = (tuple(factors), weights, filters)
+    cube = weighted_cube_cache.get(key)
+    if cube is None:
+        mask = get_filter_mask(data, filters, index=index) if filters else None
+        cube = build_weighted_cube(data, factors, weights=weights, mask=mask)
+        weighted_cube_cache.put(key, cube)
+    return cube
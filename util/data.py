@@ -1,21 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
+from parsers.recode import BAD_VALUES, MISSING_CODE, is_replicate_weight
 
-def create_correlation_matx(data, corr_tol=0.7, absolute=True, method="spearman"):
-    # TODO: Consider weights?
+# Unknown/unreported values removed from crosstabs
+RMV_VALUES = BAD_VALUES + [MISSING_CODE]
+
+
+def create_correlation_matx(data, corr_tol=0.7, absolute=True, method="spearman", weights="HWEIGHT",
+                            block_size=64, n_workers=None):
+    """Calculates the weighted correlation between every pair of numeric
+    columns, with missing values excluded pairwise, and lists the columns
+    correlated with an earlier column beyond a tolerance
+
+    Each column is ranked once (over its own known values) rather than for
+    every pair of columns, and the pairwise sums behind the correlations are
+    matrix products over blocks of columns, computed in a thread pool
+
+    Args:
+        data (pd.DataFrame): Household data
+        corr_tol (float): Correlation above which columns are listed
+        absolute (bool): Whether absolute values of correlations are returned
+        method (str): 'spearman' (weighted ranks) or 'pearson'
+        weights (str): Column of household weights; unweighted if None or
+            not in the data
+        block_size (int): Number of columns per block
+        n_workers (int): Number of threads; see ThreadPoolExecutor
+
+    Returns:
+        corr_matx (pd.DataFrame): Correlation matrix
+        upper (pd.DataFrame): Upper triangle of corr_matx (NaN elsewhere)
+        lower (pd.DataFrame): Lower triangle of corr_matx, with the diagonal
+        to_drop (list): Columns exceeding the tolerance
+    """
+    # Treat missing codes as NaN
+    data = data.select_dtypes("number")
+    w = data[weights].to_numpy(dtype=float) if weights in data.columns else np.ones(len(data))
+    values = data.to_numpy(dtype=float)
+    coded = np.array([pd.api.types.is_integer_dtype(dtype) for dtype in data.dtypes])
+    values[:, coded] = np.where(values[:, coded] == MISSING_CODE, np.nan, values[:, coded])
+    valid = ~np.isnan(values) & (w > 0)[:, None]
+    w = np.where(w > 0, w, 0)
+
+    # Rank each column once
+    if method == "spearman":
+        for i in range(values.shape[1]):
+            values[valid[:, i], i] = get_weighted_ranks(values[valid[:, i], i], w[valid[:, i]])
+    elif method != "pearson":
+        raise ValueError(f"Unsupported correlation method: {method}")
 
     # Determine (absolute value of) correlations
-    corr_matx = data.corr(method=method)
+    corr = get_pairwise_correlation(values, valid, w, block_size=block_size, n_workers=n_workers)
     if absolute:
-        corr_matx = corr_matx.abs()
+        corr = np.abs(corr)
+    corr_matx = pd.DataFrame(corr, index=data.columns, columns=data.columns)
 
     # Get upper and lower triangle
-    upper = corr_matx.where(np.triu(np.ones(corr_matx.shape), k=1).astype(bool))
-    lower = corr_matx.where(np.tril(np.ones(corr_matx.shape)).astype(bool))
+    upper_mask = np.triu(np.ones(corr.shape, dtype=bool), k=1)
+    upper = pd.DataFrame(np.where(upper_mask, corr, np.nan), index=data.columns, columns=data.columns)
+    lower = pd.DataFrame(np.where(~upper_mask, corr, np.nan), index=data.columns, columns=data.columns)
 
     # Find features with correlation greater than a given threshold
-    to_drop = [column for column in upper.columns if any(upper[column].abs() > corr_tol)]
+    exceeds = (np.abs(np.where(upper_mask, corr, 0)) > corr_tol).any(axis=0)
+    to_drop = data.columns[exceeds].tolist()
     drop_str = '\n'.join([f'    {drop}' for drop in to_drop])
     print(f"These {len(to_drop):,.0f} columns exceed the tolerance of {corr_tol:.0%}:\n{drop_str}")
 
@@ -23,48 +71,393 @@ def create_correlation_matx(data, corr_tol=0.7, absolute=True, method="spearman"
     return corr_matx, upper, lower, to_drop
 
 
+def get_weighted_ranks(values, weights):
+    """Ranks values by their weighted mid-cumulative share, i.e. the share
+    of the total weight below each value plus half of the weight of its
+    ties; with equal weights, this is the average rank rescaled to (0, 1)
 
-def create_crosstab(
-    data, data_dict, main_factor, curr_factor, weights="HWEIGHT", samples=False
-):
-    # Extract relevant variable name maps
-    varname_map = {
-        main_factor: data_dict.loc[main_factor, "Name"],
-        curr_factor: data_dict.loc[curr_factor, "Name"],
-    }
+    Args:
+        values (np.ndarray): Known values
+        weights (np.ndarray): Positive weights
+
+    Returns:
+        ranks (np.ndarray): Weighted ranks within (0, 1)
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    tie_weights = np.bincount(inverse, weights=weights, minlength=len(uniques))
+    cumulative = np.cumsum(tie_weights) - tie_weights / 2
+    return cumulative[inverse] / tie_weights.sum()
+
+
+def get_pairwise_correlation(values, valid, weights, block_size=64, n_workers=None):
+    """Weighted Pearson correlation between every pair of columns over the
+    rows known in both, from matrix products of the values and the masks of
+    known values: for columns x and y, with m the rows known in both,
+    r = cov_m(x, y) / sqrt(var_m(x) var_m(y))
+
+    Args:
+        values (np.ndarray): Values, shape (n, p); NaN where unknown
+        valid (np.ndarray): Boolean mask of known values, shape (n, p)
+        weights (np.ndarray): Row weights, shape (n,)
+        block_size (int): Number of columns per block of the output
+        n_workers (int): Number of threads; see ThreadPoolExecutor
+
+    Returns:
+        corr (np.ndarray): Correlation matrix, shape (p, p); NaN for pairs
+            with fewer than two rows known in both or without variance
+    """
+    mask = valid.astype(float)
+    x = np.where(valid, values, 0)
+
+    def sum_block(start):
+        # Weighted sums over the rows known in both columns of each pair
+        cols = slice(start, start + block_size)
+        mask_w, x_w = mask[:, cols] * weights[:, None], x[:, cols] * weights[:, None]
+        return mask_w.T @ mask, x_w.T @ mask, (x_w * x[:, cols]).T @ mask, x_w.T @ x
+
+    # Sum blocks of columns against all columns; BLAS releases the GIL
+    starts = range(0, values.shape[1], block_size)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        blocks = list(executor.map(sum_block, starts))
+    if not blocks:
+        return np.zeros((0, 0))
+    total, sum_x, sum_xx, sum_xy = [np.concatenate(sums, axis=0) for sums in zip(*blocks)]
+
+    # The sums of the second column of each pair are those of the first
+    # column of the transposed pair
+    sum_y, sum_yy = sum_x.T, sum_xx.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sum_xy - sum_x * sum_y / total
+        var_x = sum_xx - sum_x**2 / total
+        var_y = sum_yy - sum_y**2 / total
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+
+    # Pairs with fewer than two distinct values in either column are undefined
+    corr[(var_x <= 1e-12 * np.abs(sum_xx)) | (var_y <= 1e-12 * np.abs(sum_yy))] = np.nan
+
+    # Columns with variance are perfectly correlated with themselves
+    diagonal = np.diag(corr).copy()
+    np.fill_diagonal(corr, np.where(np.isnan(diagonal), np.nan, 1.0))
+    return corr
+
+
+def get_codes(data, factor):
+    """Returns the integer codes of a factor and a mask of known values,
+    without copying the DataFrame
+
+    Args:
+        data (pd.DataFrame): Household data
+        factor (str): Coded column
+
+    Returns:
+        codes (np.ndarray): Integer codes (arbitrary where unknown), in the
+            integer type of the column, e.g. int8 for compacted columns
+        valid (np.ndarray): Boolean mask of known values
+    """
+    values = data[factor].to_numpy()
+    valid = np.ones(len(values), dtype=bool)
+    for rmv_value in RMV_VALUES:
+        valid &= values != rmv_value
+    if values.dtype.kind == "f":
+        valid &= ~np.isnan(values)
+        values = np.where(valid, values, MISSING_CODE).astype(np.int64)
+    return values, valid
+
+
+def get_joint_index(row_codes, col_codes, valid):
+    """Maps each (row, column) pair of integer codes to a cell of a dense
+    table over the range of codes; excluded rows are sent to an extra cell
+
+    Args:
+        row_codes (np.ndarray): Integer codes of the index variable
+        col_codes (np.ndarray): Integer codes of the column variable
+        valid (np.ndarray): Boolean mask of rows to include; all rows if None
+
+    Returns:
+        joint (np.ndarray): Cell of each row, or n_rows*n_cols if excluded
+        row_min, col_min (int): Codes of the first row and column
+        n_rows, n_cols (int): Shape of the dense table
+    """
+    row_min, col_min = int(row_codes.min()), int(col_codes.min())
+    n_rows = int(row_codes.max()) - row_min + 1
+    n_cols = int(col_codes.max()) - col_min + 1
+    size = n_rows * n_cols
+
+    # Build the index in place, in 16-bit integers if every cell (and every
+    # intermediate value) fits, to limit the memory traffic over households
+    bound = size + abs(col_min) + abs(int(col_codes.max()))
+    joint = row_codes.astype(np.int16 if bound < np.iinfo(np.int16).max else np.intp)
+    joint -= row_min
+    joint *= n_cols
+    joint -= col_min
+    joint += col_codes
+    if valid is not None:
+        np.copyto(joint, size, where=~valid)
+
+    # np.bincount takes platform integers; cast once for all its calls
+    return joint.astype(np.intp, copy=False), row_min, col_min, n_rows, n_cols
+
+
+def weighted_crosstab(row_codes, col_codes, weights, valid=None):
+    """Weighted crosstab kernel: sums weights and counts households for each
+    (row, column) pair of integer codes with two np.bincount passes over a
+    joint index
+
+    Args:
+        row_codes (np.ndarray): Integer codes of the index variable
+        col_codes (np.ndarray): Integer codes of the column variable
+        weights (np.ndarray): Household weights
+        valid (np.ndarray): Boolean mask of rows to include; all rows if None
+
+    Returns:
+        sums (np.ndarray): Weighted sums, shape (n_rows, n_cols)
+        counts (np.ndarray): Number of households, shape (n_rows, n_cols)
+        row_keys (np.ndarray): Observed row codes
+        col_keys (np.ndarray): Observed column codes
+    """
+    if not (len(row_codes) if valid is None else valid.any()):
+        empty = np.zeros((0, 0))
+        return empty, empty.astype(np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    # Sum weights and count households per cell
+    joint, row_min, col_min, n_rows, n_cols = get_joint_index(row_codes, col_codes, valid)
+    size = n_rows * n_cols
+    sums = np.bincount(joint, weights=weights, minlength=size+1)[:size].reshape(n_rows, n_cols)
+    counts = np.bincount(joint, minlength=size+1)[:size].reshape(n_rows, n_cols)
+
+    # Keep observed codes only
+    row_obs = counts.sum(axis=1) > 0
+    col_obs = counts.sum(axis=0) > 0
+    sums, counts = sums[row_obs][:, col_obs], counts[row_obs][:, col_obs]
+    row_keys = np.flatnonzero(row_obs) + row_min
+    col_keys = np.flatnonzero(col_obs) + col_min
+    return sums, counts, row_keys, col_keys
+
+
+def get_replicate_sums(joint, size, rep_weights, max_cells=2**22):
+    """Sums every replicate weight per cell of a joint index at once, as
+    products of a one-hot cell matrix with the (households x replicates)
+    weight matrix, over chunks of households
+
+    Args:
+        joint (np.ndarray): Cell of each household, or size if excluded
+        size (int): Number of cells
+        rep_weights (np.ndarray): Replicate weights, shape (n, n_replicates)
+        max_cells (int): Number of elements of the one-hot matrix of a chunk
+
+    Returns:
+        rep_sums (np.ndarray): Shape (size, n_replicates)
+    """
+    chunksize = max(1, max_cells // (size+1))
+    rep_sums = np.zeros((size+1, rep_weights.shape[1]))
+    for start in range(0, len(joint), chunksize):
+        cells = joint[start:start+chunksize]
+        onehot = np.zeros((size+1, len(cells)), dtype=rep_weights.dtype)
+        onehot[cells, np.arange(len(cells))] = 1
+        rep_sums += onehot @ rep_weights[start:start+chunksize]
+    return rep_sums[:size]
+
+
+def replicate_crosstab(row_codes, col_codes, rep_weights, valid, row_keys, col_keys):
+    """Sums every replicate weight per crosstab cell at once (see
+    get_replicate_sums)
+
+    Args:
+        row_codes (np.ndarray): Integer codes of the index variable
+        col_codes (np.ndarray): Integer codes of the column variable
+        rep_weights (np.ndarray): Replicate weights, shape (n, n_replicates)
+        valid (np.ndarray): Boolean mask of rows to include; all rows if None
+        row_keys (np.ndarray): Row codes to return, from weighted_crosstab
+        col_keys (np.ndarray): Column codes to return, from weighted_crosstab
+
+    Returns:
+        rep_sums (np.ndarray): Shape (len(row_keys), len(col_keys), n_replicates)
+    """
+    joint, row_min, col_min, n_rows, n_cols = get_joint_index(row_codes, col_codes, valid)
+    rep_sums = get_replicate_sums(joint, n_rows * n_cols, rep_weights).reshape(n_rows, n_cols, -1)
+    return rep_sums[row_keys - row_min][:, col_keys - col_min]
+
+
+def weighted_cube(codes, weights, valid=None, rep_weights=None):
+    """n-dimensional weighted_crosstab: sums weights and counts households
+    for every combination of the integer codes of several factors, with a
+    single np.ravel_multi_index and np.bincount passes
+
+    Args:
+        codes (list): Integer codes of each factor
+        weights (np.ndarray): Household weights
+        valid (np.ndarray): Boolean mask of rows to include; all rows if None
+        rep_weights (np.ndarray): Replicate weights, shape
+            (n, n_replicates), summed per cell with get_replicate_sums if
+            given
+
+    Returns:
+        sums (np.ndarray): Weighted sums, one axis per factor
+        counts (np.ndarray): Number of households, shape of sums
+        keys (list): Observed codes of each factor, along each axis
+        rep_sums (np.ndarray): Replicate sums with an extra last axis of
+            replicates, or None
+    """
+    if not (len(weights) if valid is None else valid.any()):
+        shape = (0,) * len(codes)
+        rep_sums = None if rep_weights is None else np.zeros(shape + (rep_weights.shape[1],))
+        return np.zeros(shape), np.zeros(shape, dtype=np.int64), [np.array([], dtype=np.int64)] * len(codes), rep_sums
+
+    # Cell of each household over the range of codes of every factor;
+    # excluded households are sent to an extra cell
+    mins = [int(values.min()) for values in codes]
+    dims = tuple(int(values.max()) - code_min + 1 for values, code_min in zip(codes, mins))
+    size = int(np.prod(dims))
+    joint = np.ravel_multi_index([values.astype(np.intp) - code_min for values, code_min in zip(codes, mins)], dims)
+    if valid is not None:
+        joint[~valid] = size
+
+    # Sum weights and count households per cell
+    sums = np.bincount(joint, weights=weights, minlength=size+1)[:size].reshape(dims)
+    counts = np.bincount(joint, minlength=size+1)[:size].reshape(dims)
+    rep_sums = None
+    if rep_weights is not None:
+        rep_sums = get_replicate_sums(joint, size, rep_weights).reshape(dims + (-1,))
+
+    # Keep observed codes only
+    axes = range(len(dims))
+    observed = [counts.sum(axis=tuple(j for j in axes if j != i)) > 0 for i in axes]
+    cells = np.ix_(*observed)
+    keys = [np.flatnonzero(obs) + code_min for obs, code_min in zip(observed, mins)]
+    return sums[cells], counts[cells], keys, None if rep_sums is None else rep_sums[cells]
+
+
+def get_sdr_stderr(sums, rep_sums):
+    """Standard errors of the row proportions of a crosstab from successive
+    difference replication: sqrt(4/R * sum((p_r - p)^2))
+
+    Args:
+        sums (np.ndarray): Weighted sums, shape (n_rows, n_cols)
+        rep_sums (np.ndarray): Replicate weighted sums, shape
+            (n_rows, n_cols, n_replicates)
+
+    Returns:
+        stderr (np.ndarray): Standard errors, shape (n_rows, n_cols)
+    """
+    proportions = sums / sums.sum(axis=1, keepdims=True)
+    rep_proportions = rep_sums / rep_sums.sum(axis=1, keepdims=True)
+    variance = 4 / rep_sums.shape[2] * ((rep_proportions - proportions[:, :, None])**2).sum(axis=2)
+    return np.sqrt(variance)
+
+
+def get_replicate_columns(data):
+    """Lists the replicate weight columns of the household data"""
+    return [col for col in data.columns if is_replicate_weight(col)]
+
+
+def label_crosstab(values, data_dict, main_factor, curr_factor, row_keys, col_keys, counts, samples=False):
+    """Arranges a crosstab array as a DataFrame with friendly labels
+
+    Args:
+        values (np.ndarray): Crosstab values, shape (n_rows, n_cols)
+        data_dict (DataDictionary): Data dictionary
+        main_factor (str): Column variable of the crosstab
+        curr_factor (str): Index variable of the crosstab
+        row_keys (np.ndarray): Row codes
+        col_keys (np.ndarray): Column codes
+        counts (np.ndarray): Number of households per cell
+        samples (bool): Whether sample sizes are added to the index labels
+
+    Returns:
+        crosst (pd.DataFrame): Labelled crosstab
+    """
     # Extract relevant value maps
-    main_map = data_dict.loc[main_factor, "Conversion"]
-    curr_map = data_dict.loc[curr_factor, "Conversion"]
+    main, curr = data_dict[main_factor], data_dict[curr_factor]
+    main_map, curr_map = main.labels, curr.labels
+    index = [curr_map.get(key, key) for key in row_keys]
+    columns = [main_map.get(key, key) for key in col_keys]
 
-    # Remove unknown/unreported values
-    rmv_values = [-88, -99]
-    rmv_idx = (~data[main_factor].isin(rmv_values)) & (
-        ~data[curr_factor].isin(rmv_values)
+    # Add sample size if requested
+    if samples:
+        index = [f"{label}\n(n={N:,.0f})" for label, N in zip(index, counts.sum(axis=1))]
+
+    return pd.DataFrame(
+        values,
+        index=pd.Index(index, name=curr.name),
+        columns=pd.Index(columns, name=main.name),
     )
-    df = data[rmv_idx].copy()
+
+
+def get_crosstab_codes(data, main_factor, curr_factor, weights="HWEIGHT", mask=None):
+    """Returns the codes and weights of the households entering a crosstab
+
+    Args:
+        data (pd.DataFrame): Household data
+        main_factor (str): Coded column of the crosstab columns
+        curr_factor (str): Coded column of the crosstab index
+        weights (str): Column of household weights
+        mask (np.ndarray): Boolean mask of the households of a subgroup; all
+            households if None
+
+    Returns:
+        main_codes, curr_codes (np.ndarray): Integer codes of both factors
+        w (np.ndarray): Household weights
+        valid (np.ndarray): Boolean mask of known values of both factors, or
+            None if only the households with known values were gathered
+        rows (np.ndarray): Positions of the gathered households, or None
+    """
+    # Remove unknown/unreported values
+    main_codes, main_valid = get_codes(data, main_factor)
+    curr_codes, curr_valid = get_codes(data, curr_factor)
+    valid = main_valid & curr_valid
+    w = data[weights].to_numpy()
+    if mask is None:
+        return main_codes, curr_codes, w, valid, None
+
+    # Gather the known values of a subgroup, so that the crosstab kernel only
+    # passes over its households
+    rows = np.flatnonzero(valid & mask)
+    return main_codes[rows], curr_codes[rows], w[rows], None, rows
+
+
+def create_crosstab(
+    data, data_dict, main_factor, curr_factor, weights="HWEIGHT", samples=False, mask=None
+):
+    # Remove unknown/unreported values and households outside the subgroup
+    main_codes, curr_codes, w, valid, _ = get_crosstab_codes(data, main_factor, curr_factor, weights, mask)
 
     # Arrange crosstab
-    df[main_factor] = df[main_factor].astype("category").map(main_map)
-    df.rename(columns=varname_map, inplace=True)
-    crosst = pd.crosstab(
-        index=df[varname_map[curr_factor]],
-        columns=df[varname_map[main_factor]],
-        values=df[weights],
-        aggfunc="sum",
-        normalize="index",
-    )
+    sums, counts, row_keys, col_keys = weighted_crosstab(curr_codes, main_codes, w, valid=valid)
+    crosst = label_crosstab(sums / sums.sum(axis=1, keepdims=True), data_dict, main_factor, curr_factor,
+                            row_keys, col_keys, counts, samples=samples)
 
-    # Add sample size if requested; otherwise use basic name map
-    if samples:
-        sample_sizes = df.groupby(varname_map[curr_factor])["SCRAM"].agg("count")
-        for key in curr_map:
-            if key not in rmv_values and "\n(n=" not in curr_map[key]:
-                N = float(sample_sizes.loc[key])
-                curr_map[key] = f"{curr_map[key]}\n(n={N:,.0f})"
-        crosst.index = crosst.index.astype("category").map(curr_map)
+    # Return result
+    return crosst
+
+
+def create_crosstab_stderr(
+    data, data_dict, main_factor, curr_factor, weights="HWEIGHT", samples=False, mask=None
+):
+    """Standard errors of the proportions in create_crosstab, from successive
+    difference replication over the household replicate weights
+
+    Returns:
+        stderr (pd.DataFrame): Standard errors labelled as in create_crosstab,
+            or None if the data has no replicate weights (or no households)
+    """
+    rep_cols = get_replicate_columns(data)
+    if not rep_cols:
+        return None
+
+    # Remove unknown/unreported values and households outside the subgroup
+    main_codes, curr_codes, w, valid, rows = get_crosstab_codes(data, main_factor, curr_factor, weights, mask)
+    if not (len(main_codes) if valid is None else valid.any()):
+        return None
+
+    # Calculate proportions for the full sample and for each replicate
+    sums, counts, row_keys, col_keys = weighted_crosstab(curr_codes, main_codes, w, valid)
+    if rows is None:
+        rep_weights = data[rep_cols].to_numpy(dtype=np.float32)
     else:
-        # Rename index
-        crosst.rename(index=curr_map, inplace=True)
+        rep_weights = np.column_stack([data[col].to_numpy()[rows] for col in rep_cols]).astype(np.float32)
+    rep_sums = replicate_crosstab(curr_codes, main_codes, rep_weights, valid, row_keys, col_keys)
+    stderr = label_crosstab(get_sdr_stderr(sums, rep_sums), data_dict, main_factor, curr_factor,
+                            row_keys, col_keys, counts, samples=samples)
 
     # Return result
-    return crosst
+    return stderr
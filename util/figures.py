@@ -0,0 +1,215 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+import flask
+
+from util.cache import record_lookup
+
+# Brotli is optional; responses are only gzip-compressed without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+min_compress_bytes = 1024
+compressible_types = ("application/json", "text/html", "text/css", "application/javascript")
+
+
+def get_figure_key(component_id, values):
+    """Key of a figure from its graph and the values it depends on
+
+    Args:
+        component_id (str): Graph, e.g. "factor-damage-graph"
+        values (list): Input values, where the value of pattern-matching
+            inputs is a list of the [index, value] pairs that are set (see
+            get_request_values)
+
+    Returns:
+        key (str): JSON key
+    """
+    return json.dumps([component_id, values], separators=(",", ":"))
+
+
+def get_request_values(body):
+    """Input values of a Dash callback request by component id; the values
+    of pattern-matching inputs are listed under their type as sorted
+    [index, value] pairs of the components that are set"""
+    values = {}
+    for item in body.get("inputs", []):
+        if isinstance(item, list):
+            if item:
+                values[item[0]["id"]["type"]] = sorted([entry["id"]["index"], sorted(entry["value"])]
+                                                       for entry in item if entry.get("value"))
+        else:
+            values[item["id"]] = item.get("value")
+    return values
+
+
+def get_callback_body(fragments):
+    """Assembles the response of a Dash callback from serialized outputs"""
+    return b'{"multi":true,"response":{' + b",".join(fragments) + b"}}"
+
+
+def get_figure_sizes(body, component_ids):
+    """Sizes of the serialized figures in a Dash callback response (see
+    get_callback_body), found from the position of each output rather than
+    by parsing the response
+
+    Args:
+        body (bytes): Uncompressed response
+        component_ids (list): Graphs that may be in the response
+
+    Returns:
+        sizes (dict): Size in bytes of the figure of each graph found
+    """
+    starts = sorted((body.find(json.dumps(component_id).encode() + b':{"figure":'), component_id)
+                    for component_id in component_ids)
+    starts = [(start, component_id) for start, component_id in starts if start >= 0]
+    # Each output is followed by "}," or, for the last one, by "}}}"
+    ends = [start - 2 for start, _ in starts[1:]] + [len(body) - 3]
+    return {component_id: end - start - len(json.dumps(component_id)) - len(':{"figure":')
+            for (start, component_id), end in zip(starts, ends)}
+
+
+def get_encoding(accept_encoding):
+    """Chooses the preferred content encoding accepted by the client, brotli
+    (if available) over gzip; None for an uncompressed response"""
+    accepted = {part.split(";")[0].strip() for part in (accept_encoding or "").split(",")}
+    if "br" in accepted and brotli is not None:
+        return "br"
+    return "gzip" if "gzip" in accepted else None
+
+
+def compress(body, encoding, fast=False):
+    """Compresses a response body with gzip or brotli"""
+    if encoding == "br":
+        return brotli.compress(body, quality=4 if fast else 11)
+    return gzip.compress(body, compresslevel=6 if fast else 9, mtime=0)
+
+
+def encode_body(body, fast=False, etag=False):
+    """Compresses a response body with every available encoding
+
+    Args:
+        body (bytes): Uncompressed response
+        fast (bool): Whether a faster, lower compression level is used
+        etag (bool): Whether an ETag is computed, for responses to GET
+            requests that the client can revalidate
+
+    Returns:
+        encoded (dict): ETag of the body (or None) and the body in each
+            encoding, None for uncompressed
+    """
+    encodings = {None: body, "gzip": compress(body, "gzip", fast=fast)}
+    if brotli is not None:
+        encodings["br"] = compress(body, "br", fast=fast)
+    return {"etag": hashlib.sha256(body).hexdigest()[:32] if etag else None, "encodings": encodings}
+
+
+def get_encoded_response(encoded, request, mimetype="application/json"):
+    """Builds the response to a request from an encoded body; the client
+    gets the preferred encoding it accepts, or 304 if the body has an ETag
+    and its copy is current
+
+    Args:
+        encoded (dict): Output of encode_body
+        request (flask.Request): Request of the body
+        mimetype (str): Type of the body
+
+    Returns:
+        response (flask.Response): Response with encoding (and ETag)
+    """
+    encoding = get_encoding(request.headers.get("Accept-Encoding"))
+    response = flask.Response(encoded["encodings"][encoding], mimetype=mimetype)
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if encoded["etag"] is None:
+        return response
+    response.set_etag(f"{encoded['etag']}-{encoding}" if encoding else encoded["etag"])
+    return response.make_conditional(request)
+
+
+class FigureStore:
+    """Serialized figures reachable from the dropdowns, rendered once and
+    then served as bytes, without building or serializing the figure again;
+    the response of a single figure is also kept in every encoding"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def put(self, key, component_id, figure):
+        """Stores the serialized figure (JSON bytes) of a graph"""
+        fragment = json.dumps(component_id).encode() + b':{"figure":' + figure + b"}"
+        entry = dict(encode_body(get_callback_body([fragment])), component_id=component_id, figure=figure,
+                     fragment=fragment)
+        with self._lock:
+            self._entries[key] = entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        record_lookup(entry is not None)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": 0}
+
+    def get_response(self, entries, request):
+        """Builds the callback response updating the figures of stored
+        entries; responses of several figures are compressed on the fly"""
+        if len(entries) == 1:
+            return get_encoded_response(entries[0], request)
+        body = get_callback_body([entry["fragment"] for entry in entries])
+        return get_encoded_response(encode_body(body, fast=True), request)
+
+    def save(self, file_path):
+        """Writes the serialized figures to a JSON file"""
+        folder = os.path.dirname(file_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            figures = {key: [entry["component_id"], entry["figure"].decode()] for key, entry in self._entries.items()}
+        with open(file_path, "w") as f:
+            json.dump(figures, f, separators=(",", ":"))
+
+    def load(self, file_path):
+        """Reads the serialized figures written by save"""
+        with open(file_path) as f:
+            figures = json.load(f)
+        for key, (component_id, figure) in figures.items():
+            self.put(key, component_id, figure.encode())
+
+
+def compress_response(response, request=None):
+    """Flask after_request hook compressing text responses (e.g., callback
+    responses not found in a FigureStore) for clients that accept it"""
+    request = request or flask.request
+    if (response.direct_passthrough or response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.mimetype not in compressible_types):
+        return response
+    encoding = get_encoding(request.headers.get("Accept-Encoding"))
+    body = response.get_data()
+    if encoding is None or len(body) < min_compress_bytes:
+        return response
+    response.set_data(compress(body, encoding, fast=True))
+    response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
@@ -0,0 +1,86 @@
+import functools
+import numpy as np
+
+from util.data import get_codes
+
+
+class BitmapIndex:
+    """Packed bitmaps of the households with each code of a set of factors,
+    so that subgroup filters are combined with bitwise AND/OR over one bit
+    per household instead of comparing every household's codes
+
+    Args:
+        data (pd.DataFrame): Household data
+        factors (list): Coded columns offered as subgroup filters
+    """
+
+    def __init__(self, data, factors):
+        self.n_rows = len(data)
+        self.bitmaps = {}
+        for factor in factors:
+            codes, valid = get_codes(data, factor)
+            self.bitmaps[factor] = {int(code): np.packbits(valid & (codes == code))
+                                    for code in np.unique(codes[valid])}
+
+    def __contains__(self, factor):
+        return factor in self.bitmaps
+
+    def get_bitmap(self, filters):
+        """Combines subgroup filters into a packed bitmap: households are
+        kept if, for every factor, they have any of its codes
+
+        Args:
+            filters (tuple): Pairs of (factor, codes) of indexed factors
+
+        Returns:
+            bitmap (np.ndarray): Packed bitmap (np.packbits) of households
+                within the subgroup
+        """
+        bitmap = np.full((self.n_rows + 7) // 8, 0xFF, dtype=np.uint8)
+        for factor, codes in filters:
+            bitmaps = self.bitmaps[factor]
+            selected = [bitmaps[int(code)] for code in codes if int(code) in bitmaps]
+            bitmap &= functools.reduce(np.bitwise_or, selected) if selected else 0
+        return bitmap
+
+    def get_mask(self, filters):
+        """Boolean mask of households within the subgroup (see get_bitmap)"""
+        return np.unpackbits(self.get_bitmap(filters), count=self.n_rows).view(bool)
+
+    def nbytes(self):
+        return sum(bitmap.nbytes for bitmaps in self.bitmaps.values() for bitmap in bitmaps.values())
+
+
+def get_filter_mask(data, filters, index=None):
+    """Combines subgroup filters into a boolean mask of households
+
+    Args:
+        data (pd.DataFrame): Household data
+        filters (tuple): Pairs of (factor, codes); households are kept if the
+            value of every factor is one of its codes
+        index (BitmapIndex): Bitmaps of the household data, used for the
+            factors it covers
+
+    Returns:
+        mask (np.ndarray): Boolean mask of households within the subgroup
+    """
+    indexed = [(factor, codes) for factor, codes in filters if index is not None and factor in index]
+    mask = index.get_mask(indexed) if indexed else np.ones(len(data), dtype=bool)
+    for factor, codes in filters:
+        if index is None or factor not in index:
+            values, valid = get_codes(data, factor)
+            mask &= valid & np.isin(values, [int(code) for code in codes])
+    return mask
+
+
+def normalize_filters(filters):
+    """Orders subgroup filters and drops factors without codes, so that the
+    same subgroup always has the same (hashable) filters, e.g. as a cache key
+
+    Args:
+        filters (iterable): Pairs of (factor, codes)
+
+    Returns:
+        filters (tuple): Sorted pairs of (factor, sorted tuple of codes)
+    """
+    return tuple(sorted((factor, tuple(sorted(codes))) for factor, codes in filters if codes))
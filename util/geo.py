@@ -0,0 +1,193 @@
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from util.cache import LRUCache
+from util.data import get_codes
+from util.filters import get_filter_mask, normalize_filters
+
+# Postal abbreviations used by the choropleth (locationmode 'USA-states')
+state_abbreviations = {
+    'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR', 'California': 'CA',
+    'Colorado': 'CO', 'Connecticut': 'CT', 'Delaware': 'DE', 'District of Columbia': 'DC',
+    'Florida': 'FL', 'Georgia': 'GA', 'Hawaii': 'HI', 'Idaho': 'ID', 'Illinois': 'IL',
+    'Indiana': 'IN', 'Iowa': 'IA', 'Kansas': 'KS', 'Kentucky': 'KY', 'Louisiana': 'LA',
+    'Maine': 'ME', 'Maryland': 'MD', 'Massachusetts': 'MA', 'Michigan': 'MI', 'Minnesota': 'MN',
+    'Mississippi': 'MS', 'Missouri': 'MO', 'Montana': 'MT', 'Nebraska': 'NE', 'Nevada': 'NV',
+    'New Hampshire': 'NH', 'New Jersey': 'NJ', 'New Mexico': 'NM', 'New York': 'NY',
+    'North Carolina': 'NC', 'North Dakota': 'ND', 'Ohio': 'OH', 'Oklahoma': 'OK', 'Oregon': 'OR',
+    'Pennsylvania': 'PA', 'Rhode Island': 'RI', 'South Carolina': 'SC', 'South Dakota': 'SD',
+    'Tennessee': 'TN', 'Texas': 'TX', 'Utah': 'UT', 'Vermont': 'VT', 'Virginia': 'VA',
+    'Washington': 'WA', 'West Virginia': 'WV', 'Wisconsin': 'WI', 'Wyoming': 'WY',
+}
+
+# Memoized state tables of the current household data
+state_cache = LRUCache(maxsize=256)
+
+# Widths (in percentage points) considered for the color bins of a map
+bin_steps = [0.1, 0.2, 0.25, 0.5, 1, 2, 2.5, 5, 10, 20, 25, 50]
+
+
+class StateTable(NamedTuple):
+    """State proportions arranged for a choropleth, as read-only arrays that
+    can be shared between requests"""
+    states: np.ndarray
+    codes: np.ndarray
+    percents: np.ndarray
+    hover: np.ndarray
+    bins: np.ndarray
+
+
+def get_color_bins(values, max_bins=6):
+    """Evenly spaced bin edges with a round width covering the values, e.g.
+    20, 25, ..., 50 for values between 21 and 48
+
+    Args:
+        values (np.ndarray): Values (e.g., percentages between 0 and 100)
+        max_bins (int): Maximum number of bins
+
+    Returns:
+        bins (np.ndarray): Bin edges, at least two
+    """
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return np.array([0.0, 100.0])
+    low, high = values.min(), values.max()
+    step = next((step for step in bin_steps if (high - low) / step <= max_bins), bin_steps[-1])
+    start = np.floor(low / step) * step
+    n_bins = max(int(np.ceil((high - start) / step)), 1)
+    return np.round(start + step * np.arange(n_bins + 1), 6)
+
+
+def get_state_table(geo, factor="Proportion"):
+    """Arranges the state proportions of an outcome for a choropleth: hover
+    text is formatted for all states at once and the color bins are chosen,
+    so that neither is repeated when the map is drawn again
+
+    Args:
+        geo (pd.DataFrame): State name, postal code and proportion of each
+            state (e.g., from get_state_proportions)
+        factor (str): Column of proportions
+
+    Returns:
+        table (StateTable): Read-only state names, postal codes, percentages,
+            hover text and color bin edges
+    """
+    states = geo["State"].to_numpy(dtype=str)
+    percents = geo[factor].to_numpy(dtype=float) * 100
+    hover = np.char.add(np.char.add(np.char.add("<b>", states), ":</b> "), np.char.mod("%.1f%%", percents))
+    table = StateTable(states, geo["Code"].to_numpy(dtype=str), percents, hover, get_color_bins(percents))
+    for values in table:
+        values.setflags(write=False)
+    return table
+
+
+def get_state_proportions(data, data_dict, outcome, codes, filters=(), weights="HWEIGHT", state="EST_ST",
+                          index=None):
+    """Calculates the weighted proportion of households with an outcome in
+    each state, with a single grouped pass over the integer state codes
+
+    Args:
+        data (pd.DataFrame): Household data
+        data_dict (DataDictionary): Data dictionary
+        outcome (str): Coded outcome column
+        codes (tuple): Codes of the outcome counted as positive
+        filters (tuple): Subgroup filters (see get_filter_mask)
+        weights (str): Column of household weights
+        state (str): Coded state column
+        index (BitmapIndex): Bitmaps of the household data, used to combine
+            the filters
+
+    Returns:
+        geo (pd.DataFrame): State name, postal code, weighted proportion and
+            number of households for each state with known outcomes
+    """
+    # Keep households with a known state and outcome within the subgroup
+    state_codes, state_valid = get_codes(data, state)
+    outcome_codes, outcome_valid = get_codes(data, outcome)
+    mask = state_valid & outcome_valid
+    if filters:
+        mask &= get_filter_mask(data, filters, index=index)
+    rows = np.flatnonzero(mask)
+    state_codes, outcome_codes = state_codes[rows].astype(np.intp), outcome_codes[rows]
+    w = data[weights].to_numpy()[rows].astype(float, copy=False)
+
+    # Sum weights of all and of positive households per state; a lookup table
+    # over the few outcome codes avoids sorting the households
+    positive = np.isin(outcome_codes, list(codes), kind="table")
+    totals = np.bincount(state_codes, weights=w)
+    positives = np.bincount(state_codes, weights=w * positive)
+    counts = np.bincount(state_codes)
+
+    # Arrange states with at least one household
+    state_map = {int(key): value for key, value in data_dict.labels(state).items()}
+    keys = [key for key in np.flatnonzero(counts) if key in state_map]
+    names = [state_map[key] for key in keys]
+    geo = pd.DataFrame({
+        "State": names,
+        "Code": [state_abbreviations.get(name) for name in names],
+        "Proportion": positives[keys] / totals[keys],
+        "N": counts[keys].astype(int),
+    }, index=pd.Index(keys, name=state))
+    return geo
+
+
+def cached_state_table(data, data_dict, outcome, codes, filters=(), weights="HWEIGHT", index=None):
+    """Memoized state table (see get_state_table) of get_state_proportions,
+    keyed by (outcome, codes, filters); the cache is emptied whenever a
+    different DataFrame is passed
+
+    Returns:
+        table (StateTable): Cached state table, shared between callers
+    """
+    state_cache.bind(data)
+    filters = normalize_filters(filters)
+    key = (outcome, tuple(codes), filters, weights)
+    table = state_cache.get(key)
+    if table is None:
+        geo = get_state_proportions(data, data_dict, outcome, codes, filters=filters, weights=weights, index=index)
+        table = get_state_table(geo)
+        state_cache.put(key, table)
+    return table
+
+
+def build_state_cube(data, data_dict, geo_outcomes, filter_factor, weights="HWEIGHT"):
+    """Precomputes the state proportions of every geographic outcome, for all
+    households and for each value of a filter factor
+
+    Args:
+        data (pd.DataFrame): Household data
+        data_dict (DataDictionary): Data dictionary
+        geo_outcomes (dict): Outcomes from factors.get_geo_outcomes
+        filter_factor (str): Coded column offered as a subgroup filter
+        weights (str): Column of household weights
+
+    Returns:
+        states (dict): JSON-serializable outcomes, filter values and state
+            proportions keyed by get_state_key
+    """
+    filter_map = data_dict.labels(filter_factor)
+    states = {
+        "outcomes": {value: description for value, (_, _, description) in geo_outcomes.items()},
+        "filter": {"value": filter_factor, "name": data_dict.name(filter_factor),
+                   "options": [[code, label] for code, label in filter_map.items()]},
+        "proportions": {},
+    }
+    for value, (outcome, codes, _) in geo_outcomes.items():
+        for filter_code in [None] + list(filter_map):
+            filters = () if filter_code is None else ((filter_factor, (filter_code,)),)
+            geo = get_state_proportions(data, data_dict, outcome, codes, filters=filters, weights=weights)
+            states["proportions"][get_state_key(value, filter_code)] = geo.to_dict(orient="list")
+    return states
+
+
+def get_state_key(value, filter_code=None):
+    """Key of a geographic outcome and filter value within a state cube"""
+    return value if filter_code is None else f"{value}|{filter_code}"
+
+
+def get_cube_state_tables(states):
+    """State tables (see get_state_table) of every outcome and filter value
+    of a state cube, keyed by get_state_key"""
+    return {key: get_state_table(pd.DataFrame(proportions)) for key, proportions in states["proportions"].items()}
@@ -0,0 +1,208 @@
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+import flask
+
+from util.cache import track_lookups
+
+# Upper bounds of the histogram buckets
+time_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+size_buckets = [1e3, 5e3, 1e4, 2.5e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 5e6]
+
+# Slow callbacks are reported as warnings, e.g. to the error log of gunicorn
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Cumulative histogram in the style of Prometheus"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum, self.count = 0, 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_prometheus(self, name, labels):
+        lines = [f'{name}_bucket{{{labels},le="{bound:g}"}} {count}' for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6g}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class CallbackMetrics:
+    """Records the latency and response size of Dash callbacks, and the
+    compute time of each graph they update
+
+    Compute time is measured around the callback function, and around each
+    graph within it (see measure_graph). The rest of the request (serializing
+    the figure to JSON and Dash overhead) and the size of the response are
+    recorded once Flask has built the response; responses answered from
+    stored figures without running the callback are recorded as well (see
+    observe_stored). The metrics are per process, e.g. per gunicorn worker.
+
+    Args:
+        slow_threshold (float): Callbacks slower than this many seconds are
+            logged along with their input values; disabled if None
+        caches (dict): LRUCache instances by name, whose counters are
+            exported; a callback is a cache hit if none of its lookups missed
+    """
+
+    metrics = {
+        "compute_seconds": ("Time spent computing the callback output", time_buckets),
+        "serialization_seconds": ("Time spent serializing the callback output and in Dash", time_buckets),
+        "response_bytes": ("Size of the callback response", size_buckets),
+    }
+
+    def __init__(self, slow_threshold=None, caches=None):
+        self.slow_threshold = slow_threshold
+        self.caches = caches or {}
+        self.histograms = {}
+        self.figure_sizes = {}
+        self.graph_times = {}
+        self.graph_updates = {}
+        self.graph_cache_results = {}
+        self.cache_results = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def instrument(self, func):
+        """Wraps a callback function so that its compute time is recorded"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            with track_lookups() as lookups:
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    with self._lock:
+                        self.errors[func.__name__] = self.errors.get(func.__name__, 0) + 1
+                    raise
+                finally:
+                    record = {"callback": func.__name__, "compute": time.perf_counter() - start,
+                              "inputs": args, "cache_hit": lookups["misses"] == 0 if self.caches else None}
+                    if flask.has_request_context():
+                        flask.g.callback_metrics = record
+                    else:
+                        self.observe(record)
+        return wrapper
+
+    def record_response(self, response):
+        """Flask after_request hook completing the record of a callback"""
+        record = flask.g.pop("callback_metrics", None)
+        if record is not None:
+            total = time.perf_counter() - flask.g.pop("request_start", time.perf_counter())
+            record["serialization"] = max(total - record["compute"], 0)
+            record["bytes"] = response.calculate_content_length() or 0
+            self.observe(record)
+        return response
+
+    def start_request(self):
+        """Flask before_request hook timing the request"""
+        flask.g.request_start = time.perf_counter()
+
+    def observe(self, record):
+        name = record["callback"]
+        values = {"compute_seconds": record["compute"], "serialization_seconds": record.get("serialization"),
+                  "response_bytes": record.get("bytes")}
+        with self._lock:
+            for metric, value in values.items():
+                if value is not None:
+                    key = (metric, name)
+                    if key not in self.histograms:
+                        self.histograms[key] = Histogram(self.metrics[metric][1])
+                    self.histograms[key].observe(value)
+            if record["cache_hit"] is not None:
+                key = (name, "hit" if record["cache_hit"] else "miss")
+                self.cache_results[key] = self.cache_results.get(key, 0) + 1
+
+        # Log slow callbacks
+        total = record["compute"] + record.get("serialization", 0)
+        if self.slow_threshold is not None and total > self.slow_threshold:
+            logger.warning("Slow callback %s: %.0f ms (compute %.0f ms), %d bytes, inputs %s", name, total*1000,
+                           record["compute"]*1000, record.get("bytes", 0), record["inputs"])
+
+    @contextlib.contextmanager
+    def measure_graph(self, graph):
+        """Records the compute time of the figure of a graph within a
+        callback, and whether its cache lookups all hit"""
+        start = time.perf_counter()
+        with track_lookups() as lookups:
+            yield
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if graph not in self.graph_times:
+                self.graph_times[graph] = Histogram(time_buckets)
+            self.graph_times[graph].observe(elapsed)
+            key = (graph, "computed")
+            self.graph_updates[key] = self.graph_updates.get(key, 0) + 1
+            if self.caches:
+                key = (graph, "hit" if lookups["misses"] == 0 else "miss")
+                self.graph_cache_results[key] = self.graph_cache_results.get(key, 0) + 1
+
+    def observe_stored(self, graphs, lookup_seconds):
+        """Records a callback request answered from stored figures, before
+        the callback runs; its response is recorded by record_response"""
+        with self._lock:
+            for graph in graphs:
+                key = (graph, "stored")
+                self.graph_updates[key] = self.graph_updates.get(key, 0) + 1
+        if flask.has_request_context():
+            flask.g.callback_metrics = {"callback": "stored_figures", "compute": lookup_seconds, "inputs": graphs,
+                                        "cache_hit": True if self.caches else None}
+
+    def observe_figure(self, graph, size):
+        """Records the size of a serialized figure (bytes) of a graph"""
+        with self._lock:
+            if graph not in self.figure_sizes:
+                self.figure_sizes[graph] = Histogram(size_buckets)
+            self.figure_sizes[graph].observe(size)
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for metric, (description, _) in self.metrics.items():
+                name = f"hps_callback_{metric}"
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+                for (key, callback), histogram in sorted(self.histograms.items()):
+                    if key == metric:
+                        lines += histogram.to_prometheus(name, f'callback="{callback}"')
+            lines += ["# HELP hps_figure_bytes Size of each serialized figure, before compression",
+                      "# TYPE hps_figure_bytes histogram"]
+            for graph, histogram in sorted(self.figure_sizes.items()):
+                lines += histogram.to_prometheus("hps_figure_bytes", f'graph="{graph}"')
+            lines += ["# HELP hps_graph_compute_seconds Time spent computing the figure of a graph in a callback",
+                      "# TYPE hps_graph_compute_seconds histogram"]
+            for graph, histogram in sorted(self.graph_times.items()):
+                lines += histogram.to_prometheus("hps_graph_compute_seconds", f'graph="{graph}"')
+            lines += ["# HELP hps_graph_updates_total Figures of a graph computed by a callback or answered from "
+                      "the figure store", "# TYPE hps_graph_updates_total counter"]
+            lines += [f'hps_graph_updates_total{{graph="{graph}",source="{source}"}} {count}'
+                      for (graph, source), count in sorted(self.graph_updates.items())]
+            lines += ["# HELP hps_graph_cache_total Figures computed entirely from cache (hit) or not (miss)",
+                      "# TYPE hps_graph_cache_total counter"]
+            lines += [f'hps_graph_cache_total{{graph="{graph}",result="{result}"}} {count}'
+                      for (graph, result), count in sorted(self.graph_cache_results.items())]
+            lines += ["# HELP hps_callback_cache_total Callbacks served entirely from cache (hit) or not (miss)",
+                      "# TYPE hps_callback_cache_total counter"]
+            lines += [f'hps_callback_cache_total{{callback="{callback}",result="{result}"}} {count}'
+                      for (callback, result), count in sorted(self.cache_results.items())]
+            lines += ["# HELP hps_callback_errors_total Callbacks that raised an exception",
+                      "# TYPE hps_callback_errors_total counter"]
+            lines += [f'hps_callback_errors_total{{callback="{callback}"}} {count}'
+                      for callback, count in sorted(self.errors.items())]
+        for counter in ["hits", "misses", "evictions"]:
+            lines += [f"# HELP hps_cache_{counter}_total Cache {counter}", f"# TYPE hps_cache_{counter}_total counter"]
+            lines += [f'hps_cache_{counter}_total{{cache="{name}"}} {cache.stats()[counter]}'
+                      for name, cache in self.caches.items()]
+        return "\n".join(lines) + "\n"
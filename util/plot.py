@@ -1,39 +1,104 @@
+import functools
+import numpy as np
 import plotly.graph_objs as go
+import plotly.io as pio
+from plotly.colors import get_colorscale, sample_colorscale
+from plotly.subplots import make_subplots
 import textwrap
 
 
-# Utility function to get stacked bars
-def get_stacked_bar_traces(crosst):
+# Utility function to get the legend name of a category label
+def get_trace_name(label):
+    return label.split("(").pop(0)
+
+
+# Utility function to get stacked bars; if standard errors are given, the
+# hover text also shows the 95% confidence interval of each proportion
+def get_stacked_bar_traces(crosst, stderr=None):
     x = crosst.index.tolist()
     y = crosst.columns.tolist()
-    traces = [go.Bar(x=x, y=crosst[yi].values, name=yi.split("(").pop(0),
-                    texttemplate="%{y:,.1%}", textposition='inside',
-                    hovertemplate=f"<b>{crosst.columns.name}</b><br>"+yi.split("(").pop(0)+": %{y:,.1%}<extra></extra>") for yi in y]
+    traces = []
+    for yi in y:
+        name = get_trace_name(yi)
+        hovertemplate = f"<b>{crosst.columns.name}</b><br>"+"%{fullData.name}: %{y:,.1%}"
+        customdata = None
+        if stderr is not None:
+            margin = 1.96 * stderr[yi].values
+            customdata = np.column_stack([(crosst[yi].values - margin).clip(0, 1),
+                                          (crosst[yi].values + margin).clip(0, 1)])
+            hovertemplate += "<br>95% CI: %{customdata[0]:,.1%} - %{customdata[1]:,.1%}"
+        traces.append(go.Bar(x=x, y=crosst[yi].values, name=name, customdata=customdata,
+                             texttemplate="%{y:,.1%}", textposition='inside',
+                             hovertemplate=hovertemplate+"<extra></extra>"))
     return traces
 
 
-def get_choropleth_figure(df, factor, factor_str):
+# Utility function to get stacked bars side by side for each facet, e.g. each
+# hazard type; categories keep the same color and legend entry in every facet,
+# even if some facets lack them, following the order of all the categories
+# (by default, the order in which they first appear)
+def get_faceted_bar_figure(facets, colors, categories=None):
+    fig = make_subplots(rows=1, cols=len(facets), shared_yaxes=True, horizontal_spacing=0.02,
+                        subplot_titles=[label for label, _, _ in facets])
+    if categories is None:
+        categories = list(dict.fromkeys(label for _, crosst, _ in facets for label in crosst.columns))
+    names = [get_trace_name(label) for label in categories]
+    shown = set()
+    for i, (_, crosst, stderr) in enumerate(facets):
+        for trace in get_stacked_bar_traces(crosst, stderr):
+            if trace.name not in names:
+                names.append(trace.name)
+            trace.update(marker_color=colors[names.index(trace.name) % len(colors)], legendgroup=trace.name,
+                         showlegend=trace.name not in shown)
+            shown.add(trace.name)
+            fig.add_trace(trace, row=1, col=i+1)
+    crosst = facets[0][1]
+    fig.update_layout(barmode='stack', legend_title=crosst.columns.name)
+    fig.update_xaxes(title_text=crosst.index.name, row=1, col=(len(facets) + 1) // 2)
+    fig.update_yaxes(title_text='Proportion of households', row=1, col=1)
+    return fig
+
+
+@functools.lru_cache(maxsize=32)
+def get_binned_colorscale(colorscale, n_bins):
+    """Discretizes a named colorscale into n_bins uniform colors, sampled at
+    the bin centers, as a stepped Plotly colorscale"""
+    colors = sample_colorscale(get_colorscale(colorscale), [(i + 0.5) / n_bins for i in range(n_bins)])
+    return tuple((bound, color) for i, color in enumerate(colors) for bound in [i / n_bins, (i + 1) / n_bins])
 
-    # Arrange hover text
-    df['hover'] = df.apply(lambda x: f"<b>{x.State}:</b> {x[factor]:.1%}", axis=1)
 
+def get_choropleth_figure(table, factor_str):
+    """Maps the proportion of households with an outcome in each state
+
+    Args:
+        table (StateTable): State table (see util.geo.get_state_table),
+            which is not modified
+        factor_str (str): Description of the outcome
+
+    Returns:
+        fig (go.Figure): Choropleth of the states, with one color per bin
+    """
     # Handle legend title
     split_text = textwrap.wrap(factor_str, 
                             width=30)
 
-    # TODO: Discretize colors
+    # Color states by bin
+    n_bins = len(table.bins) - 1
 
     # Create main figure
     fig = go.Figure(data=go.Choropleth(
-        locations=df['Code'], 
-        z = df[factor].mul(100), 
+        locations=table.codes, 
+        z = table.percents, 
+        zmin = table.bins[0],
+        zmax = table.bins[-1],
         locationmode = 'USA-states', 
         marker_line_color='silver',
-        colorscale = 'YlGn',
+        colorscale = get_binned_colorscale('YlGn', n_bins),
         hoverinfo = "text",
-        text = df['hover'],
+        text = table.hover,
         colorbar_title = '<br>'.join(split_text),
         colorbar_ticksuffix = '%',
+        colorbar_tickvals = table.bins,
     ))
 
     # Update projection system
@@ -58,4 +123,63 @@ def get_choropleth_figure(df, factor, factor_str):
         ),
     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+
+# Layout settings of the theme template used by bar charts and maps; the
+# rest (e.g., 3D scenes, polar and ternary axes) is not sent with figures
+template_layout_keys = ['annotationdefaults', 'autotypenumbers', 'coloraxis', 'colorway', 'font', 'geo',
+                        'hoverlabel', 'hovermode', 'paper_bgcolor', 'plot_bgcolor', 'shapedefaults', 'title',
+                        'xaxis', 'yaxis']
+
+# Trace attributes moved into the template when every trace of a type shares them
+shared_trace_attributes = ['hovertemplate', 'texttemplate', 'textposition']
+
+
+@functools.lru_cache(maxsize=16)
+def get_compact_template(template_name, trace_types):
+    """Subset of a figure template with its layout settings for bar charts
+    and maps and its defaults for the given trace types only"""
+    template = pio.templates[template_name].to_plotly_json()
+    return {"layout": {key: value for key, value in template["layout"].items() if key in template_layout_keys},
+            "data": {trace_type: template["data"][trace_type] for trace_type in trace_types
+                     if trace_type in template["data"]}}
+
+
+def compact_figure(fig, decimals=4):
+    """Shrinks the serialized figure: numbers are rounded to display
+    precision, attributes shared by every trace of a type are sent once in
+    the figure template, and the theme template is limited to what the
+    figure uses
+
+    Args:
+        fig (go.Figure): Figure, modified in place
+        decimals (int): Decimals kept in numeric arrays (x, y, z, customdata)
+
+    Returns:
+        fig (go.Figure): Compact figure
+    """
+    # Round numeric arrays
+    for trace in fig.data:
+        for attr in ['x', 'y', 'z', 'customdata']:
+            values = trace[attr] if attr in trace else None
+            if values is not None and np.asarray(values).dtype.kind == 'f':
+                trace[attr] = np.round(np.asarray(values), decimals)
+
+    # Move attributes shared by every trace of a type into the template
+    trace_types = tuple(sorted({trace.type for trace in fig.data}))
+    base = get_compact_template(pio.templates.default, trace_types)
+    template = {"layout": base["layout"], "data": {}}
+    for trace_type in trace_types:
+        traces = [trace for trace in fig.data if trace.type == trace_type]
+        shared = {}
+        for attr in shared_trace_attributes:
+            values = {trace[attr] for trace in traces if attr in trace}
+            if len(values) == 1 and all(trace[attr] is not None for trace in traces):
+                shared[attr] = values.pop()
+        for trace in traces:
+            trace.update({attr: None for attr in shared})
+        defaults = base["data"].get(trace_type) or [{}]
+        template["data"][trace_type] = [dict(default, **shared) for default in defaults]
+    fig.layout.template = template
+    return fig
@@ -0,0 +1,55 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Records the duration of named startup phases (e.g., imports, CSV load,
+    layout build) so that cold starts can be broken down"""
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+        print(f"    {name}: {seconds:.2f}s")
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block as a startup phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def time_first_call(self, func, name="first callback"):
+        """Wraps a function so that its first call across all wrapped
+        functions is recorded as a startup phase, followed by a report"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if name in self.phases:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            if name not in self.phases:
+                self.record(name, time.perf_counter() - start)
+                self.report()
+            return result
+        return wrapper
+
+    def report(self):
+        """Prints the duration of each phase and the total"""
+        with self._lock:
+            phases = list(self.phases.items())
+        lines = '\n'.join([f"    {name}: {seconds:.2f}s" for name, seconds in phases])
+        total = sum(seconds for _, seconds in phases)
+        print(f"Startup phases ({total:.2f}s in total):\n{lines}")
+
+    def to_dict(self):
+        with self._lock:
+            return {name: round(seconds, 4) for name, seconds in self.phases.items()}
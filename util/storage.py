@@ -0,0 +1,71 @@
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from parsers.parse_data_dictionary import DataDictionary
+
+
+def read_table_file(file_path, memory_map=False):
+    """Reads processed household data and its data dictionary from an Arrow
+    IPC file
+
+    Args:
+        file_path (str): Location of the file
+        memory_map (bool): Whether columns are memory-mapped; numeric columns
+            without missing values then point directly into the file pages,
+            which the operating system shares between processes
+
+    Returns:
+        data (pd.DataFrame): Processed household data (read-only columns if
+            memory-mapped)
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+    if memory_map:
+        # One block per column so that pandas does not copy columns into
+        # consolidated 2D blocks; categoricals (e.g., SCRAM) stay in Arrow
+        # memory rather than being materialized as Python strings
+        table = pa.ipc.open_file(pa.memory_map(file_path)).read_all()
+        data = table.to_pandas(split_blocks=True, types_mapper=get_mapped_dtype)
+    else:
+        table = feather.read_table(file_path)
+        data = table.to_pandas()
+    records = json.loads(table.schema.metadata[b"data_dict"])
+    return data, DataDictionary.from_records(records)
+
+
+def get_mapped_dtype(arrow_type):
+    """Keeps dictionary-encoded columns as Arrow-backed pandas columns"""
+    if pa.types.is_dictionary(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    return None
+
+
+def write_table_file(file_path, data, data_dict):
+    """Writes processed household data and its data dictionary to an Arrow
+    IPC file that can be memory-mapped by read_table_file
+
+    Args:
+        file_path (str): Location of the file
+        data (pd.DataFrame): Processed household data
+        data_dict (DataDictionary): Augmented data dictionary
+    """
+    # Keep NaN as a float value rather than a null, so that float columns can
+    # be memory-mapped without being filled again on read
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type) and table.column(i).null_count:
+            table = table.set_column(i, field, pa.array(data[field.name].to_numpy(), from_pandas=False))
+
+    # Store data dictionary within the schema metadata
+    metadata = dict(table.schema.metadata)
+    metadata[b"data_dict"] = json.dumps(data_dict.to_records())
+    table = table.replace_schema_metadata(metadata)
+
+    # Write atomically so that concurrent workers never read a partial file;
+    # each column is a single uncompressed buffer so that it can be
+    # memory-mapped without being concatenated or decompressed
+    tmp_file = f"{file_path}.{os.getpid()}.tmp"
+    feather.write_feather(table, tmp_file, compression="uncompressed", chunksize=max(len(data), 1))
+    os.replace(tmp_file, file_path)
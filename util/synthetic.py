@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from parsers.parse_data_dictionary import parse_data_dictionary
+
+# Survey responses that are only asked of disaster-displaced households
+displacement_prefix = "ND_"
+
+# Number of household replicate weights in each PUF
+n_replicates = 80
+
+
+def get_synthetic_data_dict(data_dict_file="Data_Dictionary.xlsx"):
+    """Reads the data dictionary, keeping the -99/-88 codes"""
+    return parse_data_dictionary(data_dict_file, drop_bad=False).set_index('Variable')
+
+
+def get_code_probabilities(codes, rng):
+    """Draws uneven response probabilities for a set of codes"""
+    return rng.dirichlet(np.full(len(codes), 2.0))
+
+
+def generate_column(row, n_rows, rng, bad_rate=0.03):
+    """Generates synthetic responses for one variable of the data dictionary
+
+    Args:
+        row (pd.Series): Data dictionary row with 'Type' and 'Conversion'
+        n_rows (int): Number of households
+        rng (np.random.Generator): Random number generator
+        bad_rate (float): Share of -99/-88 responses, for variables whose
+            values list them
+
+    Returns:
+        values (np.ndarray): Synthetic responses
+    """
+    conversion = row['Conversion'] if isinstance(row['Conversion'], dict) else {}
+    keys = [str(key) for key in conversion]
+
+    if keys and all(key.lstrip('-').isdigit() for key in keys):
+        # Coded responses (including quoted codes such as '01'), with -99
+        # (not selected) and -88 (missing) sentinels where listed
+        codes = np.array([int(key) for key in keys if int(key) > 0])
+        values = rng.choice(codes, n_rows, p=get_code_probabilities(codes, rng))
+        sentinels = [int(key) for key in keys if int(key) in (-99, -88)]
+        if sentinels:
+            bad = rng.random(n_rows) < bad_rate
+            values = np.where(bad, rng.choice(sentinels, n_rows), values)
+        return values
+
+    if len(keys) == 1 and " to " in keys[0]:
+        # Ranges such as '1 to 40'; narrow ranges (counts) are skewed low
+        lo, hi = [int(bound) for bound in keys[0].split(" to ")]
+        if row['Type'] == 'Continuous':
+            values = np.round(rng.lognormal(np.log(1000), 0.7, n_rows))
+        elif hi - lo > 60:
+            values = rng.integers(lo, hi + 1, n_rows)
+        else:
+            values = lo + rng.poisson(1.5, n_rows)
+        return np.clip(values, lo, hi).astype(np.int64)
+
+    # Weights and other unbounded amounts
+    return np.round(rng.lognormal(np.log(1500), 0.8, n_rows), 4)
+
+
+def generate_households(n_rows, data_dict=None, seed=0, displaced_rate=0.1, bad_rate=0.03, n_extra=40,
+                        prefix="V"):
+    """Generates a synthetic Household Pulse Survey PUF that follows the codes
+    listed in the data dictionary
+
+    Args:
+        n_rows (int): Number of households
+        data_dict (pd.DataFrame): Data dictionary indexed by variable, parsed
+            with drop_bad=False; read from Data_Dictionary.xlsx if None
+        seed (int): Seed of the random number generator
+        displaced_rate (float): Share of households displaced by a disaster;
+            displacement questions of the others are -99 (not selected)
+        bad_rate (float): Share of -99/-88 responses per variable
+        n_extra (int): Number of filler columns absent from the data
+            dictionary, as the real PUFs hold many more variables
+        prefix (str): Prefix of the household identifiers (SCRAM)
+
+    Returns:
+        puf (pd.DataFrame): Synthetic households
+    """
+    rng = np.random.default_rng(seed)
+    if data_dict is None:
+        data_dict = get_synthetic_data_dict()
+
+    # Generate responses for each variable of the data dictionary
+    columns = {"SCRAM": [f"{prefix}{i:09d}" for i in range(n_rows)]}
+    for var, row in data_dict.iterrows():
+        columns[var] = generate_column(row, n_rows, rng, bad_rate=bad_rate)
+
+    # Displaced households select one or more hazards; ND_HOWLONG and the
+    # other displacement questions are only asked of them
+    displaced = rng.random(n_rows) < displaced_rate
+    columns['ND_DISPLACE'] = np.where(displaced, 1, 2)
+    for i in range(1, 6):
+        columns[f'ND_TYPE{i}'] = np.where(rng.random(n_rows) < 0.3, 1, -99)
+    for var in columns:
+        if var.startswith(displacement_prefix) and var != 'ND_DISPLACE':
+            columns[var] = np.where(displaced, columns[var], -99)
+
+    # Add filler columns
+    for i in range(n_extra):
+        columns[f"EXTRA{i+1}"] = rng.integers(-99, 5, n_rows)
+    return pd.DataFrame(columns)
+
+
+def generate_replicate_weights(puf, seed=0):
+    """Generates household replicate weights (HWEIGHT1, HWEIGHT2, ...) that
+    vary around the household weights"""
+    rng = np.random.default_rng(seed)
+    factors = rng.choice([1 - 2**-0.5, 1, 1 + 2**-0.5], (len(puf), n_replicates), p=[0.25, 0.5, 0.25])
+    weights = np.round(puf['HWEIGHT'].to_numpy()[:, None] * factors, 4)
+    columns = {f"HWEIGHT{r+1}": weights[:, r] for r in range(n_replicates)}
+    return pd.concat([puf[['SCRAM']], pd.DataFrame(columns, index=puf.index)], axis=1)
+
+
+def write_puf_zips(folder, n_rows, n_weeks=1, seed=0, replicate_weights=False, block_size=250_000, **kwargs):
+    """Writes synthetic PUF CSV zipfiles, as downloaded from the Census
+    Bureau, that can be read by parse_puf_files
+
+    Args:
+        folder (str): Output folder
+        n_rows (int): Total number of households, split evenly across weeks
+        n_weeks (int): Number of zipfiles (survey weeks)
+        seed (int): Seed of the random number generator
+        replicate_weights (bool): Whether the replicate weights file holds
+            weights (only a header otherwise)
+        block_size (int): Number of households generated at a time, so that
+            large files are written with bounded memory
+        **kwargs: Passed to generate_households
+
+    Returns:
+        zip_paths (list): Locations of the zipfiles
+    """
+    os.makedirs(folder, exist_ok=True)
+    data_dict = kwargs.pop("data_dict", None)
+    data_dict = data_dict if data_dict is not None else get_synthetic_data_dict()
+    repwgt_header = "SCRAM," + ",".join(f"HWEIGHT{r+1}" for r in range(n_replicates)) + "\n"
+    zip_paths = []
+    for week in range(n_weeks):
+        rows = n_rows // n_weeks + (week < n_rows % n_weeks)
+        zip_path = os.path.join(folder, f"HPS_Week{week+1:02d}_PUF_CSV.zip")
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as f, \
+             tempfile.TemporaryFile() as repwgt_file:
+
+            # Stream blocks of households into the PUF CSV; only one member
+            # can be written at a time, so replicate weights are staged
+            repwgt_file.write(repwgt_header.encode())
+            with f.open(f"pulse_puf_{week+1:02d}.csv", "w") as puf_csv:
+                for block, start in enumerate(range(0, rows, block_size)):
+                    block_seed = [seed, week, block]
+                    puf = generate_households(min(block_size, rows - start), data_dict=data_dict,
+                                              seed=block_seed, prefix=f"W{week+1:02d}B{block:04d}V", **kwargs)
+                    write_csv(puf, puf_csv, header=block == 0)
+                    if replicate_weights:
+                        write_csv(generate_replicate_weights(puf, seed=block_seed), repwgt_file, header=False)
+
+            # Add replicate weights file
+            repwgt_file.seek(0)
+            with f.open(f"pulse_repwgt_puf_{week+1:02d}.csv", "w") as repwgt_csv:
+                shutil.copyfileobj(repwgt_file, repwgt_csv)
+        zip_paths.append(zip_path)
+    return zip_paths
+
+
+def write_csv(df, sink, header=True):
+    """Writes a DataFrame as CSV to a binary file object with pyarrow, which
+    is much faster than DataFrame.to_csv"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pacsv.write_csv(table, sink, write_options=pacsv.WriteOptions(include_header=header))
+
+
+def write_displaced_households(file_path, n_rows, seed=0, **kwargs):
+    """Writes a synthetic displaced_households.csv, i.e. displaced households
+    with only the columns of the data dictionary, as read by data.get_data"""
+    puf = generate_households(n_rows, seed=seed, displaced_rate=1.0, n_extra=0, **kwargs)
+    with open(file_path, "wb") as f:
+        write_csv(puf, f)
+    return file_path